@@ -5,11 +5,21 @@ from __future__ import print_function
 
 from tsf_nmt import attention
 from tsf_nmt import build_ops
+from tsf_nmt import cache_ops
 from tsf_nmt import cells
+from tsf_nmt import checkpoint_ops
 from tsf_nmt import content_functions
 from tsf_nmt import data_utils
 from tsf_nmt import decoders
 from tsf_nmt import encoders
+from tsf_nmt import eval_ops
+from tsf_nmt import loss_ops
 from tsf_nmt import nmt_models
+from tsf_nmt import profiling_ops
+from tsf_nmt import schedule_ops
+from tsf_nmt import server_ops
+from tsf_nmt import session_ops
+from tsf_nmt import shortlist_ops
+from tsf_nmt import telemetry_ops
 from tsf_nmt import train_ops
 from tsf_nmt import translate_ops
\ No newline at end of file
@@ -6,12 +6,15 @@ from tensorflow.python.ops import array_ops, math_ops, nn_ops
 from tensorflow.python.ops import variable_scope as vs
 
 import cells
-from content_functions import vinyals_kaiser
+from content_functions import content_keys, vinyals_kaiser
 
 GLOBAL = "global"
 LOCAL = "local"
 HYBRID = "hybrid"
 
+# graph collection with the keys computed by attention_keys
+ATTENTION_KEYS = "attention_keys"
+
 
 def get_attention_f(name):
     if name == LOCAL:
@@ -22,8 +25,90 @@ def get_attention_f(name):
         return global_attention
 
 
+def attention_keys(attention_f, hidden_attn, initializer, content_function=vinyals_kaiser):
+    """Project the encoder hidden states for the content function of attention_f, once.
+
+    The projection does not depend on the decoder state, so the decoders compute it before their
+    first step and pass it to attention_f (keys=...) at every step. The keys are also added to the
+    ATTENTION_KEYS collection, so the single step decoding graph can fetch them on the first step of
+    a sentence and feed them back on the others.
+
+    Parameters
+    ----------
+    attention_f : function
+        One of global_attention, local_attention or hybrid_attention.
+    hidden_attn : 4-D Tensor
+        Encoder hidden states, shape (?, timesteps, 1, attn_size).
+    initializer : function
+        Function to use when initializing variables within the variables context.
+    content_function : function
+        Content function used by attention_f. Default to 'vinyals_kaiser'.
+
+    Returns
+    -------
+    keys : 4-D Tensor, tuple or None
+        The keys to pass to attention_f - a pair (local keys, global keys) for hybrid attention -
+        or None if the content function has no projection to precompute.
+
+    """
+    if attention_f is global_attention:
+        scopes = ["AttentionGlobal"]
+    elif attention_f is local_attention:
+        scopes = ["AttentionLocal"]
+    elif attention_f is hybrid_attention:
+        scopes = ["AttentionLocal", "AttentionGlobal"]
+    else:
+        return None
+
+    keys = []
+    for scope in scopes:
+        # same variable scopes as the attention functions, so the variables are shared
+        with vs.variable_scope(scope, initializer=initializer):
+            k = content_keys(content_function, hidden_attn)
+        if k is None:
+            return None
+        tf.add_to_collection(ATTENTION_KEYS, k)
+        keys.append(k)
+
+    if attention_f is hybrid_attention:
+        return tuple(keys)
+
+    return keys[0]
+
+
+def sequence_mask(source_lengths, attn_length, dtype=tf.float32):
+    """Return a (batch_size, attn_length) Tensor with 1 on the positions that hold a source
+    token and 0 on the padded positions (the ones past the true length of the sentence).
+
+    Parameters
+    ----------
+    source_lengths : 1-D Tensor
+        Tensor of int32 with the true length of each source sentence in the batch.
+    attn_length : int
+        Number of (padded) time steps of the encoder hidden states.
+    dtype : tensorflow dtype
+        Type of the mask. Default to tf.float32
+
+    """
+    positions = tf.expand_dims(tf.range(0, attn_length), 0)
+    lengths = tf.expand_dims(tf.to_int32(source_lengths), 1)
+
+    return tf.cast(tf.less(positions, lengths), dtype)
+
+
+def _masked_softmax(s, mask):
+    """Softmax over the scores s that gives no weight to the positions where mask is 0."""
+    if mask is None:
+        return nn_ops.softmax(s)
+
+    # subtract the max before exponentiating so the masked normalization stays stable
+    e = math_ops.exp(s - math_ops.reduce_max(s, 1, keep_dims=True)) * mask
+
+    return e / (math_ops.reduce_sum(e, 1, keep_dims=True) + 1e-12)
+
+
 def hybrid_attention(decoder_hidden_state, hidden_attn, initializer, window_size=10,
-                     content_function=vinyals_kaiser, dtype=tf.float32):
+                     content_function=vinyals_kaiser, source_lengths=None, keys=None, dtype=tf.float32):
     """Put hybrid attention (mix of global and local attention) on hidden using decoder hidden states
     and the hidden states of encoder (hidden_attn).
 
@@ -44,6 +129,12 @@ def hybrid_attention(decoder_hidden_state, hidden_attn, initializer, window_size
         content_function : function
             Content function to score the decoder hidden states and encoder hidden states to extract their
             weights. Default to 'vinyals_kaiser'.
+        source_lengths : 1-D Tensor
+            True length of each source sentence. If given, no attention is put on the padded positions.
+            Default to None.
+        keys : tuple
+            Pair (local keys, global keys) returned by attention_keys. If None, the encoder states are
+            projected at this step. Default to None.
         dtype : tensorflow dtype
             Type of tensors. Default to tf.float32
 
@@ -58,15 +149,19 @@ def hybrid_attention(decoder_hidden_state, hidden_attn, initializer, window_size
 
     attention_vec_size = hidden_attn.get_shape()[3].value
 
+    local_keys, global_keys = keys if keys is not None else (None, None)
+
     local_attn = local_attention(decoder_hidden_state=decoder_hidden_state,
                                  hidden_attn=hidden_attn,
                                  content_function=content_function,
-                                 window_size=window_size, initializer=initializer, dtype=dtype)
+                                 window_size=window_size, initializer=initializer,
+                                 source_lengths=source_lengths, keys=local_keys, dtype=dtype)
 
     global_attn = global_attention(decoder_hidden_state=decoder_hidden_state,
                                    hidden_attn=hidden_attn,
                                    content_function=content_function,
-                                   window_size=window_size, initializer=initializer, dtype=dtype)
+                                   window_size=window_size, initializer=initializer,
+                                   source_lengths=source_lengths, keys=global_keys, dtype=dtype)
 
     with vs.variable_scope("FeedbackGate_%d" % 0, initializer=initializer):
         y = cells.linear(decoder_hidden_state, attention_vec_size, True)
@@ -86,7 +181,7 @@ def hybrid_attention(decoder_hidden_state, hidden_attn, initializer, window_size
 
 
 def global_attention(decoder_hidden_state, hidden_attn, initializer, window_size=10,
-                     content_function=vinyals_kaiser, dtype=tf.float32):
+                     content_function=vinyals_kaiser, source_lengths=None, keys=None, dtype=tf.float32):
 
     """Put global attention on hidden using decoder hidden states and the hidden states of encoder (hidden_attn).
 
@@ -107,6 +202,12 @@ def global_attention(decoder_hidden_state, hidden_attn, initializer, window_size
     content_function : function
         Content function to score the decoder hidden states and encoder hidden states to extract their
         weights. Default to 'vinyals_kaiser'.
+    source_lengths : 1-D Tensor
+        True length of each source sentence. If given, no attention is put on the padded positions.
+        Default to None.
+    keys : 4-D Tensor
+        Projection of hidden_attn returned by attention_keys. If None, it is computed at this step.
+        Default to None.
     dtype : tensorflow dtype
         Type of tensors. Default to tf.float32
 
@@ -125,9 +226,13 @@ def global_attention(decoder_hidden_state, hidden_attn, initializer, window_size
     with vs.variable_scope("AttentionGlobal", initializer=initializer):
 
         # apply content function to score the hidden states from the encoder
-        s = content_function(hidden_attn, decoder_hidden_state)
+        s = content_function(hidden_attn, decoder_hidden_state, keys=keys)
+
+        pad_mask = None
+        if source_lengths is not None:
+            pad_mask = sequence_mask(source_lengths, attn_length, dtype=dtype)
 
-        alpha = nn_ops.softmax(s)
+        alpha = _masked_softmax(s, pad_mask)
 
         _ = tf.histogram_summary('global_alpha_weights', alpha)
 
@@ -141,7 +246,7 @@ def global_attention(decoder_hidden_state, hidden_attn, initializer, window_size
 
 
 def local_attention(decoder_hidden_state, hidden_attn, initializer, window_size=10,
-                    content_function=vinyals_kaiser, dtype=tf.float32):
+                    content_function=vinyals_kaiser, source_lengths=None, keys=None, dtype=tf.float32):
     """Put local attention on hidden using decoder hidden states and the hidden states of encoder (hidden_attn).
 
     Parameters
@@ -161,6 +266,12 @@ def local_attention(decoder_hidden_state, hidden_attn, initializer, window_size=
     content_function : function
         Content function to score the decoder hidden states and encoder hidden states to extract their
         weights. Default to 'vinyals_kaiser'.
+    source_lengths : 1-D Tensor
+        True length of each source sentence. If given, no attention is put on the padded positions.
+        Default to None.
+    keys : 4-D Tensor
+        Projection of hidden_attn returned by attention_keys. If None, it is computed at this step.
+        Default to None.
     dtype : tensorflow dtype
         Type of tensors. Default to tf.float32
 
@@ -183,7 +294,7 @@ def local_attention(decoder_hidden_state, hidden_attn, initializer, window_size=
     with vs.variable_scope("AttentionLocal", initializer=initializer):
 
         # apply content function to score the hidden states from the encoder
-        s = content_function(hidden_attn, decoder_hidden_state)
+        s = content_function(hidden_attn, decoder_hidden_state, keys=keys)
 
         with vs.variable_scope("WindowPrediction", initializer=initializer):
             ht = cells.linear([decoder_hidden_state], attention_vec_size, True)
@@ -197,6 +308,9 @@ def local_attention(decoder_hidden_state, hidden_attn, initializer, window_size=
         # for each sentence in the batch - i.e., a tensor of shape batch x 1
         S = attn_length
         pt = math_ops.reduce_sum((vp * tanh), [2, 3])
+        # the window position is predicted over the true sentence length when we know it
+        if source_lengths is not None:
+            S = array_ops.reshape(tf.cast(source_lengths, dtype), array_ops.shape(pt))
         pt = math_ops.sigmoid(pt) * S
 
         # now we get only the integer part of the values
@@ -237,7 +351,12 @@ def local_attention(decoder_hidden_state, hidden_attn, initializer, window_size=
         # here we switch off all the values that fall outside the window
         # first we switch off those in the truncated normal
         alpha = s * mask
-        masked_soft = nn_ops.softmax(alpha)
+
+        pad_mask = None
+        if source_lengths is not None:
+            pad_mask = sequence_mask(source_lengths, attn_length, dtype=dtype)
+
+        masked_soft = _masked_softmax(alpha, pad_mask)
 
         _ = tf.histogram_summary('local_alpha_weights', alpha)
 
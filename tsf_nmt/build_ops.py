@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import functools
+import os
 import tensorflow as tf
 from tensorflow.python.platform import gfile
 
@@ -6,9 +8,20 @@ import attention
 import content_functions
 import decoders
 import nmt_models
+import profiling_ops
 
 
-def create_seq2seq_model(session, forward_only, model_path=None, use_best=False, FLAGS=None, buckets=None, translate=False):
+def _attach_profiler(model, FLAGS):
+    """Trace one in every FLAGS.trace_every train/decode steps of the model (0 turns it off)."""
+
+    if FLAGS.trace_every > 0:
+        trace_dir = FLAGS.trace_dir if FLAGS.trace_dir else os.path.join(FLAGS.train_dir, 'traces')
+        model.profiler = profiling_ops.StepProfiler(trace_dir, every_n=FLAGS.trace_every,
+                                                    attention_type=FLAGS.attention_type)
+
+
+def create_seq2seq_model(session, forward_only, model_path=None, use_best=False, FLAGS=None, buckets=None, translate=False,
+                         batch_size=None, eval_only=False):
     """Create translation model and initialize or load parameters in session."""
 
     assert FLAGS is not None
@@ -23,7 +36,9 @@ def create_seq2seq_model(session, forward_only, model_path=None, use_best=False,
         'Cannot decode from input AND from file. Please choose just one option.'
 
     # we should set batch to 1 when decoding
-    if decode_input or decode_file:
+    if batch_size is not None:
+        batch = batch_size
+    elif decode_input or decode_file:
         batch = 1
     else:
         batch = FLAGS.batch_size
@@ -44,6 +59,11 @@ def create_seq2seq_model(session, forward_only, model_path=None, use_best=False,
         else:
             decoder = decoders.attention_decoder_output
 
+    if FLAGS.dynamic_decoder:
+        # same decoder, run by a while loop instead of being unrolled for every bucket
+        decoder = functools.partial(decoders.dynamic_attention_decoder, informed=FLAGS.informed_decoder,
+                                    output_attention=FLAGS.output_attention != "None")
+
     attention_f = attention.get_attention_f(FLAGS.attention_type)
     content_function = content_functions.get_content_f(FLAGS.content_function)
     decoder_attention_f = content_functions.get_decoder_content_f(FLAGS.output_attention)
@@ -71,12 +91,21 @@ def create_seq2seq_model(session, forward_only, model_path=None, use_best=False,
                                     content_function=content_function,
                                     decoder_attention_f=decoder_attention_f,
                                     num_samples=FLAGS.num_samples_loss,
+                                    target_candidates=FLAGS.target_candidates,
+                                    fused_loss=FLAGS.fused_loss,
+                                    dynamic_decoder=FLAGS.dynamic_decoder,
+                                    sparse_updates=FLAGS.sparse_updates,
                                     forward_only=forward_only,
+                                    eval_only=eval_only,
+                                    lazy_buckets=FLAGS.lazy_buckets,
                                     max_len=FLAGS.max_len,
+                                    beam_size=FLAGS.beam_size,
                                     cpu_only=FLAGS.cpu_only,
                                     early_stop_patience=FLAGS.early_stop_patience,
                                     save_best_model=FLAGS.save_best_model,
-                                    log_tensorboard=FLAGS.log_tensorboard)
+                                    log_tensorboard=FLAGS.log_tensorboard and not eval_only)
+
+    _attach_profiler(model, FLAGS)
 
     if model_path is None:
 
@@ -89,6 +118,7 @@ def create_seq2seq_model(session, forward_only, model_path=None, use_best=False,
         if ckpt and gfile.Exists(ckpt.model_checkpoint_path):
             print('Reading model parameters from %s' % ckpt.model_checkpoint_path)
             model.saver.restore(session, ckpt.model_checkpoint_path)
+            model.checkpoint_path = ckpt.model_checkpoint_path
         else:
             print('Created model with fresh parameters.')
             session.run(tf.initialize_all_variables())
@@ -96,11 +126,13 @@ def create_seq2seq_model(session, forward_only, model_path=None, use_best=False,
     else:
         print('Reading model parameters from %s' % model_path)
         model.saver.restore(session, model_path)
+        model.checkpoint_path = model_path
 
     return model
 
 
-def create_nmt_model(session, forward_only, model_path=None, use_best=False, FLAGS=None, buckets=None, translate=False):
+def create_nmt_model(session, forward_only, model_path=None, use_best=False, FLAGS=None, buckets=None, translate=False,
+                     batch_size=None, eval_only=False):
     """Create translation model and initialize or load parameters in session."""
 
     assert FLAGS is not None
@@ -115,7 +147,9 @@ def create_nmt_model(session, forward_only, model_path=None, use_best=False, FLA
         'Cannot decode from input AND from file. Please choose just one option.'
 
     # we should set batch to 1 when decoding
-    if decode_input or decode_file:
+    if batch_size is not None:
+        batch = batch_size
+    elif decode_input or decode_file:
         batch = 1
     else:
         batch = FLAGS.batch_size
@@ -148,12 +182,21 @@ def create_nmt_model(session, forward_only, model_path=None, use_best=False, FLA
                                 content_function=content_function,
                                 decoder_attention_f=decoder_attention_f,
                                 num_samples=FLAGS.num_samples_loss,
+                                target_candidates=FLAGS.target_candidates,
+                                fused_loss=FLAGS.fused_loss,
+                                dynamic_decoder=FLAGS.dynamic_decoder,
+                                sparse_updates=FLAGS.sparse_updates,
                                 forward_only=forward_only,
+                                eval_only=eval_only,
+                                lazy_buckets=FLAGS.lazy_buckets,
                                 max_len=FLAGS.max_len,
+                                beam_size=FLAGS.beam_size,
                                 cpu_only=FLAGS.cpu_only,
                                 early_stop_patience=FLAGS.early_stop_patience,
                                 save_best_model=FLAGS.save_best_model)
 
+    _attach_profiler(model, FLAGS)
+
     if model_path is None:
 
         if use_best:
@@ -165,6 +208,7 @@ def create_nmt_model(session, forward_only, model_path=None, use_best=False, FLA
         if ckpt and gfile.Exists(ckpt.model_checkpoint_path):
             print('Reading model parameters from %s' % ckpt.model_checkpoint_path)
             model.saver.restore(session, ckpt.model_checkpoint_path)
+            model.checkpoint_path = ckpt.model_checkpoint_path
         else:
             print('Created model with fresh parameters.')
             session.run(tf.initialize_all_variables())
@@ -172,5 +216,6 @@ def create_nmt_model(session, forward_only, model_path=None, use_best=False, FLA
     else:
         print('Reading model parameters from %s' % model_path)
         model.saver.restore(session, model_path)
+        model.checkpoint_path = model_path
 
     return model
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+    Translation memory: the translations of the source sentences already seen, so exact repeats
+    (boilerplate, headers, legal text) skip the encoder and the beam search. An in-memory LRU
+    tier is backed by an optional on-disk tier (sqlite) that persists across runs.
+
+    Entries are keyed on the source token ids, the checkpoint of the model, the decoding
+    settings and the target vocabulary shortlist the sentence is decoded over (see
+    shortlist_ops), so a new checkpoint, other settings or another lexical table never return
+    stale translations.
+
+"""
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+
+
+def checkpoint_id(checkpoint_path):
+    """Identify a checkpoint by its path and modification time (the best model is overwritten
+    with the same name). Returns 'fresh' for a model that was not restored."""
+    if checkpoint_path is None:
+        return 'fresh'
+
+    for path in (checkpoint_path, checkpoint_path + '.index'):
+        if os.path.exists(path):
+            return '%s@%d' % (os.path.abspath(path), os.path.getmtime(path))
+
+    return checkpoint_path
+
+
+def decoding_settings(FLAGS, dump_remaining=True):
+    """The flags that change the translations of a model, as a string."""
+    if FLAGS.greedy_decoding:
+        search = 'greedy'
+    else:
+        search = 'beam%d' % FLAGS.beam_size
+        if dump_remaining:
+            search += '-dump'
+        if FLAGS.beam_early_stop:
+            # the best translation is the same, but not the other samples (unless the bound is not exact)
+            search += '-stop%g' % FLAGS.beam_length_ratio
+
+    return '%s-len%d-shortlist%d.%d' % (search, FLAGS.max_len, FLAGS.shortlist_top_k, FLAGS.shortlist_frequent)
+
+
+class TranslationCache(object):
+    """LRU cache of translations, with an optional sqlite file behind it."""
+
+    def __init__(self, model_id, settings, size=10000, path=None):
+        """
+
+        Parameters
+        ----------
+        model_id : string
+            Identifier of the model checkpoint (see checkpoint_id).
+        settings : string
+            Decoding settings (see decoding_settings).
+        size : int
+            Maximum number of translations kept in memory. If 0, only the disk is used.
+            Default to 10000.
+        path : string
+            Path to the sqlite file of the on-disk tier. If None, only the memory is used.
+
+        """
+        self.prefix = '%s|%s|' % (model_id, settings)
+        self.size = size
+        self.path = path
+
+        self._memory = collections.OrderedDict()
+        self._db = None
+        if path is not None:
+            # several decoding processes may share the file - and the server decodes in its own thread
+            self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, value TEXT)')
+            self._db.commit()
+
+        self.lookups = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+
+    def _key(self, token_ids, shortlist=None):
+        key = self.prefix + ' '.join(str(int(t)) for t in token_ids)
+        if shortlist is not None:
+            key += '|' + hashlib.sha1(' '.join(str(int(t)) for t in shortlist).encode('utf-8')).hexdigest()
+        return key
+
+    def _remember(self, key, translation):
+        if self.size <= 0:
+            return
+        self._memory[key] = translation
+        if len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+
+    def get(self, token_ids, shortlist=None):
+        """Return the translation (samples, scores) of the sentence decoded over the target ids of
+        shortlist (None for the whole target vocabulary), or None if not cached."""
+        self.lookups += 1
+        key = self._key(token_ids, shortlist)
+
+        if key in self._memory:
+            # most recently used goes to the end
+            translation = self._memory.pop(key)
+            self._memory[key] = translation
+            self.memory_hits += 1
+            return translation
+
+        if self._db is not None:
+            row = self._db.execute('SELECT value FROM translations WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                translation = tuple(json.loads(row[0]))
+                self._remember(key, translation)
+                self.disk_hits += 1
+                return translation
+
+        return None
+
+    def put(self, token_ids, translation, shortlist=None):
+        """Store the translation (samples, scores) of the sentence in both tiers."""
+        self.put_many([token_ids], [translation], [shortlist])
+
+    def put_many(self, batch_token_ids, translations, shortlists=None):
+        """Store the translations (samples, scores) of several sentences in both tiers, with a
+        single commit of the sqlite file (the decoding workers share its write lock)."""
+        if shortlists is None:
+            shortlists = [None] * len(batch_token_ids)
+
+        rows = []
+        for token_ids, (samples, scores), shortlist in zip(batch_token_ids, translations, shortlists):
+            translation = ([[int(w) for w in sample] for sample in samples], [float(score) for score in scores])
+
+            key = self._key(token_ids, shortlist)
+            self._remember(key, translation)
+            rows.append((key, json.dumps(translation)))
+
+        if self._db is not None and rows:
+            self._db.executemany('INSERT OR REPLACE INTO translations (key, value) VALUES (?, ?)', rows)
+            self._db.commit()
+
+    @property
+    def hits(self):
+        return self.memory_hits + self.disk_hits
+
+    def hit_rate(self):
+        return self.hits / max(self.lookups, 1)
+
+    def report(self):
+        return 'translation cache: %d lookups - hit rate %.3f (memory %d, disk %d)' % \
+               (self.lookups, self.hit_rate(), self.memory_hits, self.disk_hits)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def get_translation_cache(model, FLAGS, dump_remaining=True):
+    """Translation cache of the model with the decoding settings of FLAGS, or None if both
+    translation_cache_size and translation_cache_file are unset. The file lives in train_dir."""
+    if FLAGS.translation_cache_size <= 0 and not FLAGS.translation_cache_file:
+        return None
+
+    path = None
+    if FLAGS.translation_cache_file:
+        path = os.path.join(FLAGS.train_dir, FLAGS.translation_cache_file)
+
+    return TranslationCache(checkpoint_id(model.checkpoint_path),
+                            decoding_settings(FLAGS, dump_remaining),
+                            size=FLAGS.translation_cache_size,
+                            path=path)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+    Checkpoint manager that takes a snapshot of the model variables and writes it to disk
+    from a background thread, so the training loop does not wait on the checkpoint I/O.
+
+"""
+from __future__ import print_function
+
+import os
+import threading
+
+import tensorflow as tf
+from six.moves import queue
+
+
+class CheckpointManager(object):
+    """Write regular and best-model checkpoints without blocking the training loop.
+
+    Every save first copies the current value of all variables into host memory (a single
+    session.run), then hands the snapshot to a writer thread. The writer loads the snapshot
+    into a shadow graph living on the CPU and saves it with a tf.train.Saver that uses the
+    same variable names as the model, so the checkpoints can be restored by model.saver.
+
+    Saves are deduplicated by global step: asking twice for a checkpoint of the same step
+    (e.g., at the end of the last epoch) writes it only once. Only the last 'keep_last'
+    regular checkpoints and the last 'keep_best' best-model checkpoints are kept on disk.
+
+    """
+
+    def __init__(self, variables, train_dir, best_models_dir, model_name,
+                 keep_last=5, keep_best=5, asynchronous=True, max_pending=1):
+        """
+
+        Parameters
+        ----------
+        variables : list
+            List of tf.Variable to save (usually tf.all_variables()).
+        train_dir : string
+            Directory where the regular checkpoints are written.
+        best_models_dir : string
+            Directory where the best-model checkpoints are written.
+        model_name : string
+            Base name of the checkpoint files.
+        keep_last : int
+            Number of regular checkpoints to keep on disk. Default to 5.
+        keep_best : int
+            Number of best-model checkpoints to keep on disk. Default to 5.
+        asynchronous : boolean
+            Whether to write the checkpoints from a background thread. If False, the
+            snapshot is written before save returns. Default to True.
+        max_pending : int
+            Number of snapshots that may wait to be written. When the queue is full,
+            save blocks until the writer catches up, bounding the memory used by the
+            snapshots. Default to 1.
+
+        """
+        self.variables = list(variables)
+        self.train_path = os.path.join(train_dir, model_name)
+        self.best_path = os.path.join(best_models_dir, model_name + '-best')
+        self.asynchronous = asynchronous
+
+        self._last_step = {False: None, True: None}
+        self._error = None
+
+        # shadow graph - one variable per model variable, initialized from a placeholder so
+        # loading a snapshot is just running the initializers with the snapshot as feed
+        self._graph = tf.Graph()
+        self._placeholders = []
+        initializers = []
+        var_list = {}
+
+        with self._graph.as_default(), tf.device("/cpu:0"):
+
+            for v in self.variables:
+                plc = tf.placeholder(v.dtype.base_dtype, shape=v.get_shape())
+                shadow = tf.Variable(plc, trainable=False, collections=[])
+                self._placeholders.append(plc)
+                initializers.append(shadow.initializer)
+                var_list[v.op.name] = shadow
+
+            self._load_op = tf.group(*initializers)
+            self._saver = tf.train.Saver(var_list, max_to_keep=keep_last)
+            self._saver_best = tf.train.Saver(var_list, max_to_keep=keep_best)
+
+        self._session = tf.Session(graph=self._graph,
+                                   config=tf.ConfigProto(device_count={'GPU': 0}))
+
+        self._queue = queue.Queue(maxsize=max(1, max_pending))
+        self._thread = None
+
+        if asynchronous:
+            self._thread = threading.Thread(target=self._run, name='checkpoint_writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def save(self, session, global_step, best=False):
+        """Take a snapshot of the variables and schedule it to be written.
+
+        Parameters
+        ----------
+        session : tf.Session
+            Session holding the model variables.
+        global_step : int
+            Global step used to name the checkpoint file.
+        best : boolean
+            Whether this is a best-model checkpoint. Default to False.
+
+        Returns
+        -------
+        saved : boolean
+            False if a checkpoint for this global step had already been scheduled.
+
+        """
+        self._check_error()
+
+        global_step = int(global_step)
+
+        if self._last_step[best] == global_step:
+            return False
+
+        self._last_step[best] = global_step
+
+        values = session.run(self.variables)
+
+        if self.asynchronous:
+            self._queue.put((values, global_step, best))
+        else:
+            self._write(values, global_step, best)
+
+        return True
+
+    def wait(self):
+        """Block until every scheduled checkpoint is written."""
+        if self.asynchronous:
+            self._queue.join()
+        self._check_error()
+
+    def close(self):
+        """Flush the pending checkpoints and stop the writer thread."""
+        if self._thread is not None:
+            self._queue.join()
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._session.close()
+        self._check_error()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, values, global_step, best):
+        self._session.run(self._load_op, feed_dict=dict(zip(self._placeholders, values)))
+
+        if best:
+            self._saver_best.save(self._session, self.best_path, global_step=global_step)
+        else:
+            self._saver.save(self._session, self.train_path, global_step=global_step)
+
+    def _check_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
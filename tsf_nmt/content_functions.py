@@ -38,12 +38,101 @@ def get_content_f(name):
     else:
         return mod_vinyals_kayser
 
-def decoder_type_1(decoder_hidden, attn_size, initializer=None):
+
+def _keys(hidden, key_size, initializer=None):
+    # 1-by-1 convolution W1 * h_t over all the encoder states at once
+    attention_vec_size = hidden.get_shape()[3].value
+    k = vs.get_variable("AttnW_%d" % 0, [1, 1, attention_vec_size, key_size], initializer=initializer)
+    return nn_ops.conv2d(hidden, k, [1, 1, 1, 1], "SAME")
+
+
+def content_keys(content_function, hidden, initializer=None):
+    """Project the encoder hidden states the way content_function does before scoring them.
+
+    The projection does not depend on the decoder state, so it can be computed once per
+    sentence and passed to content_function (keys=...) at every decoder step. It uses the
+    same variables as content_function.
+
+    Parameters
+    ----------
+    content_function : function
+        One of the content functions of this module.
+    hidden : 4-D Tensor
+        Encoder hidden states, shape (?, timesteps, 1, attn_size).
+    initializer : function
+        Initializer of the projection. Default to None (the one of the variable scope).
+
+    Returns
+    -------
+    keys : 4-D Tensor
+        Projected hidden states, or None if content_function does not project them (luong_dot).
+
+    """
+    attention_vec_size = hidden.get_shape()[3].value
+
+    if content_function is vinyals_kaiser:
+        name, key_size = "vinyals_kaiser", attention_vec_size
+    elif content_function is luong_general:
+        name, key_size = "luong_general", attention_vec_size
+    elif content_function is bahdanau_nmt:
+        name, key_size = "bahdanau_nmt", attention_vec_size
+    elif content_function is mod_bahdanau:
+        name, key_size = "mod_bahdanau", 1
+    elif content_function is mod_vinyals_kayser:
+        name, key_size = "mod_vinyals_kayser", 1
+    else:
+        return None
+
+    with vs.variable_scope(name, initializer=initializer):
+        keys = _keys(hidden, key_size, initializer)
+
+    return keys
+
+
+def _decoder_keys(decoder_hidden, attn_size, key_size, initializer=None):
+    k = vs.get_variable("AttnDecW_%d" % 0, [1, 1, attn_size, key_size], initializer=initializer)
+    return nn_ops.conv2d(decoder_hidden, k, [1, 1, 1, 1], "SAME")
+
+
+def decoder_content_keys(decoder_attention_f, decoder_hidden, attn_size, initializer=None):
+    """Project the decoder states the way decoder_attention_f does before scoring them.
+
+    Each state only needs to be projected once, so when decoding step by step the keys of the past
+    states can be kept and only the key of the new state computed (see decoders.decoder_output_attention).
+
+    Parameters
+    ----------
+    decoder_attention_f : function
+        decoder_type_1 or decoder_type_2.
+    decoder_hidden : 4-D Tensor
+        Decoder states, shape (?, timesteps, 1, attn_size).
+    attn_size : int
+        Size of the decoder states.
+    initializer : function
+        Initializer of the projection. Default to None (the one of the variable scope).
+
+    Returns
+    -------
+    keys : 4-D Tensor
+        Projected decoder states, shape (?, timesteps, 1, key_size).
+
+    """
+    if decoder_attention_f is decoder_type_1:
+        name, key_size = "decoder_type_1", 1
+    else:
+        name, key_size = "decoder_type_2", attn_size
+
+    with vs.variable_scope(name, initializer=initializer):
+        keys = _decoder_keys(decoder_hidden, attn_size, key_size, initializer)
+
+    return keys
+
+
+def decoder_type_1(decoder_hidden, attn_size, initializer=None, keys=None):
 
     with vs.variable_scope("decoder_type_1", initializer=initializer):
 
-        k = vs.get_variable("AttnDecW_%d" % 0, [1, 1, attn_size, 1], initializer=initializer)
-        hidden_features = nn_ops.conv2d(decoder_hidden, k, [1, 1, 1, 1], "SAME")
+        hidden_features = keys if keys is not None else _decoder_keys(decoder_hidden, attn_size, 1, initializer)
 
         # s will be (?, timesteps)
         s = math_ops.reduce_sum(math_ops.tanh(hidden_features), [2, 3])
@@ -51,12 +140,12 @@ def decoder_type_1(decoder_hidden, attn_size, initializer=None):
     return s
 
 
-def decoder_type_2(decoder_hidden, attn_size, initializer=None):
+def decoder_type_2(decoder_hidden, attn_size, initializer=None, keys=None):
 
     with vs.variable_scope("decoder_type_2", initializer=initializer):
 
-        k = vs.get_variable("AttnDecW_%d" % 0, [1, 1, attn_size, attn_size], initializer=initializer)
-        hidden_features = nn_ops.conv2d(decoder_hidden, k, [1, 1, 1, 1], "SAME")
+        hidden_features = keys if keys is not None else _decoder_keys(decoder_hidden, attn_size, attn_size,
+                                                                      initializer)
         v = vs.get_variable("AttnDecV_%d" % 0, [attn_size])
 
         # s will be (?, timesteps)
@@ -65,15 +154,14 @@ def decoder_type_2(decoder_hidden, attn_size, initializer=None):
     return s
 
 
-def bahdanau_nmt(hidden, decoder_previous_state, initializer=None):
+def bahdanau_nmt(hidden, decoder_previous_state, initializer=None, keys=None):
     # size of decoder layers
     attention_vec_size = hidden.get_shape()[3].value
     decoder_size = decoder_previous_state.get_shape()[1].value
 
     with vs.variable_scope("bahdanau_nmt", initializer=initializer):
         # here we calculate the W_a * s_i-1 (W1 * h_1) part of the attention alignment
-        k = vs.get_variable("AttnW_%d" % 0, [1, 1, attention_vec_size, attention_vec_size], initializer=initializer)
-        hidden_features = nn_ops.conv2d(hidden, k, [1, 1, 1, 1], "SAME")
+        hidden_features = keys if keys is not None else _keys(hidden, attention_vec_size, initializer)
         va = vs.get_variable("AttnV_%d" % 0, [attention_vec_size], initializer=initializer)
 
         y = cells.linear(decoder_previous_state, decoder_size, True)
@@ -85,7 +173,7 @@ def bahdanau_nmt(hidden, decoder_previous_state, initializer=None):
     return s
 
 
-def luong_dot(hidden, decoder_hidden_state, initializer=None):
+def luong_dot(hidden, decoder_hidden_state, initializer=None, keys=None):
 
     with vs.variable_scope("luong_dot", initializer=initializer):
 
@@ -94,7 +182,7 @@ def luong_dot(hidden, decoder_hidden_state, initializer=None):
     return s
 
 
-def luong_general(hidden, decoder_hidden_state, initializer=None):
+def luong_general(hidden, decoder_hidden_state, initializer=None, keys=None):
 
     # size of decoder layers
     attention_vec_size = hidden.get_shape()[3].value
@@ -102,22 +190,20 @@ def luong_general(hidden, decoder_hidden_state, initializer=None):
     with vs.variable_scope("luong_general", initializer=initializer):
 
         # here we calculate the W_a * s_i-1 (W1 * h_1) part of the attention alignment
-        k = vs.get_variable("AttnW_%d" % 0, [1, 1, attention_vec_size, attention_vec_size], initializer=initializer)
-        hidden_features = nn_ops.conv2d(hidden, k, [1, 1, 1, 1], "SAME")
+        hidden_features = keys if keys is not None else _keys(hidden, attention_vec_size, initializer)
         s = math_ops.reduce_sum((hidden_features * decoder_hidden_state), [2, 3])
 
     return s
 
 
-def mod_bahdanau(hidden, decoder_hidden_state, initializer=None):
+def mod_bahdanau(hidden, decoder_hidden_state, initializer=None, keys=None):
 
     # size of decoder layers
     attention_vec_size = hidden.get_shape()[3].value
 
     with vs.variable_scope("mod_bahdanau", initializer=initializer):
 
-        k = vs.get_variable("AttnW_%d" % 0, [1, 1, attention_vec_size, 1], initializer=initializer)
-        hidden_features = nn_ops.conv2d(hidden, k, [1, 1, 1, 1], "SAME")
+        hidden_features = keys if keys is not None else _keys(hidden, 1, initializer)
 
         y = cells.linear(decoder_hidden_state, 1, True)
         y = array_ops.reshape(y, [-1, 1, 1, 1])
@@ -128,15 +214,14 @@ def mod_bahdanau(hidden, decoder_hidden_state, initializer=None):
     return s
 
 
-def mod_vinyals_kayser(hidden, decoder_hidden_state, initializer=None):
+def mod_vinyals_kayser(hidden, decoder_hidden_state, initializer=None, keys=None):
 
     # size of decoder layers
     attention_vec_size = hidden.get_shape()[3].value
 
     with vs.variable_scope("mod_vinyals_kayser", initializer=initializer):
 
-        k = vs.get_variable("AttnW_%d" % 0, [1, 1, attention_vec_size, 1], initializer=initializer)
-        hidden_features = nn_ops.conv2d(hidden, k, [1, 1, 1, 1], "SAME")
+        hidden_features = keys if keys is not None else _keys(hidden, 1, initializer)
 
         y = cells.linear(decoder_hidden_state, 1, True)
         y = array_ops.reshape(y, [-1, 1, 1, 1])
@@ -147,7 +232,7 @@ def mod_vinyals_kayser(hidden, decoder_hidden_state, initializer=None):
     return s
 
 
-def vinyals_kaiser(hidden, decoder_hidden_state, initializer=None):
+def vinyals_kaiser(hidden, decoder_hidden_state, initializer=None, keys=None):
 
     # size of decoder layers
     attention_vec_size = hidden.get_shape()[3].value
@@ -155,8 +240,7 @@ def vinyals_kaiser(hidden, decoder_hidden_state, initializer=None):
     with vs.variable_scope("vinyals_kaiser", initializer=initializer):
 
         # here we calculate the W_a * s_i-1 (W1 * h_1) part of the attention alignment
-        k = vs.get_variable("AttnW_%d" % 0, [1, 1, attention_vec_size, attention_vec_size], initializer=initializer)
-        hidden_features = nn_ops.conv2d(hidden, k, [1, 1, 1, 1], "SAME")
+        hidden_features = keys if keys is not None else _keys(hidden, attention_vec_size, initializer)
         va = vs.get_variable("AttnV_%d" % 0, [attention_vec_size], initializer=initializer)
 
         y = cells.linear(decoder_hidden_state, attention_vec_size, True)
@@ -218,9 +218,17 @@ def prepare_nmt_data(FLAGS):
             src_test_ids_path, tgt_test_ids_path)
 
 
-def read_nmt_data(source_path, target_path, FLAGS=None, buckets=None, max_size=None):
+def read_nmt_data(source_path, target_path, FLAGS=None, buckets=None, max_size=None, candidate_size=0):
     """Read data from source and target files and put into buckets.
 
+    If candidate_size > 0, the corpus is also split in consecutive partitions whose target
+    vocabulary (plus the special symbols) fits in candidate_size words, as in Jean et al. (2015)
+    "On Using Very Large Target Vocabulary for Neural Machine Translation". Each pair is then
+    tagged with the index of its partition, and the candidate set (sorted target ids) of every
+    partition is returned as well: when training, the softmax of a batch taken from a single
+    partition is computed only over that partition's candidates. The pairs whose own target
+    vocabulary does not fit in candidate_size words are skipped.
+
     Args:lse
       source_path: path to the files with token-ids for the source language.
       target_path: path to the file with token-ids for the target language;
@@ -228,12 +236,17 @@ def read_nmt_data(source_path, target_path, FLAGS=None, buckets=None, max_size=N
         output for n-th line from the source_path.
       max_size: maximum number of lines to read, all other will be ignored;
         if 0 or None, data files will be read completely (no limit).
+      candidate_size: maximum size of the target candidate set of each partition;
+        if 0, the corpus is not partitioned.
 
     Returns:
       data_set: a list of length len(_buckets); data_set[n] contains a list of
         (source, target) pairs read from the provided data files that fit
         into the n-th bucket, i.e., such that len(source) < _buckets[n][0] and
         len(target) < _buckets[n][1]; source and target are lists of token-ids.
+        If candidate_size > 0, the pairs are (source, target, partition) triples
+        and the pair (data_set, candidates) is returned, candidates[p] being the
+        sorted list of target ids of partition p.
     """
 
     assert FLAGS is not None
@@ -241,6 +254,10 @@ def read_nmt_data(source_path, target_path, FLAGS=None, buckets=None, max_size=N
 
     data_set = [[] for _ in buckets]
     counter = 0
+
+    candidates = []
+    oversize = 0
+    partition_vocab = set(range(len(_START_VOCAB)))
     with gfile.GFile(source_path, mode='r') as source_file:
         with gfile.GFile(target_path, mode='r') as target_file:
             source, target = source_file.readline(), target_file.readline()
@@ -256,7 +273,44 @@ def read_nmt_data(source_path, target_path, FLAGS=None, buckets=None, max_size=N
                 target_ids.append(EOS_ID)
                 for bucket_id, (source_size, target_size) in enumerate(buckets):
                     if len(source_ids) < source_size and len(target_ids) < target_size:
-                        data_set[bucket_id].append([source_ids, target_ids])
+                        if candidate_size > 0:
+                            if len(set(target_ids).union(range(len(_START_VOCAB)))) > candidate_size:
+                                # no partition can hold this pair
+                                oversize += 1
+                                break
+                            new_vocab = partition_vocab.union(target_ids)
+                            if len(new_vocab) > candidate_size and len(partition_vocab) > len(_START_VOCAB):
+                                # this pair does not fit - close the partition and start a new one
+                                candidates.append(sorted(partition_vocab))
+                                new_vocab = set(range(len(_START_VOCAB))).union(target_ids)
+                            partition_vocab = new_vocab
+                            data_set[bucket_id].append([source_ids, target_ids, len(candidates)])
+                        else:
+                            data_set[bucket_id].append([source_ids, target_ids])
                         break
                 source, target = source_file.readline(), target_file.readline()
+
+    if candidate_size > 0:
+        candidates.append(sorted(partition_vocab))
+        print('  %d target vocabulary partitions (candidate set size <= %d)' % (len(candidates), candidate_size))
+        if oversize > 0:
+            print('  %d pairs skipped, their target vocabulary is larger than the candidate set' % oversize)
+        return data_set, candidates
+
     return data_set
+
+
+def group_by_partition(data_set):
+    """Group the (source, target, partition) triples of each bucket of data_set by partition.
+
+    Returns:
+      a list of length len(data_set) in which each element is a dict mapping a
+      partition index to the list of triples of that bucket and partition.
+    """
+    grouped = []
+    for bucket in data_set:
+        partitions = collections.defaultdict(list)
+        for pair in bucket:
+            partitions[pair[2]].append(pair)
+        grouped.append(dict(partitions))
+    return grouped
@@ -1,19 +1,27 @@
 # -*- coding: utf-8 -*-
 from __future__ import division
 from __future__ import print_function
+import numpy
 import tensorflow as tf
 
 from tensorflow.python.framework import ops
-from tensorflow.python.ops import array_ops, embedding_ops, math_ops, nn_ops
+from tensorflow.python.ops import array_ops, control_flow_ops, embedding_ops, math_ops, nn_ops
+from tensorflow.python.ops import tensor_array_ops
 from tensorflow.python.ops import variable_scope as vs
 
 import cells
-from attention import global_attention
-from content_functions import decoder_type_2, vinyals_kaiser, mod_bahdanau
+from attention import attention_keys, global_attention
+from content_functions import decoder_content_keys, decoder_type_2, vinyals_kaiser, mod_bahdanau
 # from six.moves import xrange
 
 _SEED = 1234
 
+# tf.while_loop replaced control_flow_ops.While in later versions of tensorflow
+_while_loop = getattr(control_flow_ops, 'while_loop', None) or control_flow_ops.While
+
+# graph collection with the (past keys, all keys) pairs of the single step output attention decoders
+DECODER_KEYS = "decoder_keys"
+
 
 # TODO: finish pydocs
 
@@ -36,7 +44,7 @@ def _embed_inputs(decoder_inputs, num_symbols, input_size, input_feeding=False):
 def attention_decoder(decoder_inputs, initial_state, attention_states, cell, num_symbols,
                       attention_f=global_attention, window_size=10, content_function=vinyals_kaiser,
                       decoder_attention_f=decoder_type_2, combine_inp_attn=False, input_feeding=False,
-                      dropout=None, initializer=None, decoder_states=None, step_num=None,
+                      dropout=None, initializer=None, decoder_states=None, source_lengths=None,
                       dtype=tf.float32, scope=None):
     """
 
@@ -87,6 +95,11 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, cell, num
 
     content_function: string
 
+    source_lengths: tensor
+            1D int32 Tensor [batch_size] with the true length of each source sentence. If given,
+                attention is not put on the (padded) positions past the end of the sentence.
+                Default to None.
+
     dtype:
             The dtype to use for the RNN initial state (default: tf.float32).
 
@@ -139,6 +152,10 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, cell, num
         # To calculate W1 * h_t we use a 1-by-1 convolution, need to reshape before.
         hidden = array_ops.reshape(attention_states, [-1, attn_length, 1, attn_size])
 
+        # the projection of the encoder states used by the attention scores does not depend on the
+        # decoder, so it is computed once here instead of at every step
+        keys = attention_keys(attention_f, hidden, initializer, content_function=content_function)
+
         cell_states = initial_state
         cell_outputs = []
         outputs = []
@@ -177,7 +194,8 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, cell, num
 
             ct = attention_f(decoder_hidden_state=dt, hidden_attn=hidden,
                              initializer=initializer, window_size=window_size,
-                             content_function=content_function, dtype=dtype)
+                             content_function=content_function, source_lengths=source_lengths,
+                             keys=keys, dtype=dtype)
 
             #
             with vs.variable_scope("AttnOutputProjection", initializer=initializer):
@@ -195,7 +213,7 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, cell, num
 def attention_decoder_informed(decoder_inputs, initial_state, attention_states, cell, num_symbols,
                                attention_f=global_attention, window_size=10, content_function=vinyals_kaiser,
                                decoder_attention_f=decoder_type_2, combine_inp_attn=False, input_feeding=False,
-                               dropout=None, initializer=None, decoder_states=None, step_num=None,
+                               dropout=None, initializer=None, decoder_states=None, source_lengths=None,
                                dtype=tf.float32, scope=None):
     """
 
@@ -246,6 +264,11 @@ def attention_decoder_informed(decoder_inputs, initial_state, attention_states,
 
     content_function: string
 
+    source_lengths: tensor
+            1D int32 Tensor [batch_size] with the true length of each source sentence. If given,
+                attention is not put on the (padded) positions past the end of the sentence.
+                Default to None.
+
     dtype:
             The dtype to use for the RNN initial state (default: tf.float32).
 
@@ -296,6 +319,10 @@ def attention_decoder_informed(decoder_inputs, initial_state, attention_states,
         # To calculate W1 * h_t we use a 1-by-1 convolution, need to reshape before.
         hidden = array_ops.reshape(attention_states, [-1, attn_length, 1, attn_size])
 
+        # the projection of the encoder states used by the attention scores does not depend on the
+        # decoder, so it is computed once here instead of at every step
+        keys = attention_keys(attention_f, hidden, initializer, content_function=content_function)
+
         cell_states = initial_state
         cell_outputs = []
         outputs = []
@@ -334,7 +361,8 @@ def attention_decoder_informed(decoder_inputs, initial_state, attention_states,
 
             ct = attention_f(decoder_hidden_state=dt, hidden_attn=hidden,
                              initializer=initializer, window_size=window_size,
-                             content_function=content_function, dtype=dtype)
+                             content_function=content_function, source_lengths=source_lengths,
+                             keys=keys, dtype=dtype)
 
             #
             with vs.variable_scope("AttnOutputProjection", initializer=initializer):
@@ -361,7 +389,7 @@ def attention_decoder_informed(decoder_inputs, initial_state, attention_states,
 def attention_decoder_output(decoder_inputs, initial_state, attention_states, cell, num_symbols,
                              attention_f=global_attention, window_size=10, content_function=vinyals_kaiser,
                              decoder_attention_f=decoder_type_2, combine_inp_attn=False, input_feeding=False,
-                             dropout=None, initializer=None, decoder_states=None, step_num=None,
+                             dropout=None, initializer=None, decoder_states=None, source_lengths=None,
                              dtype=tf.float32, scope=None):
     """
 
@@ -409,6 +437,11 @@ def attention_decoder_output(decoder_inputs, initial_state, attention_states, ce
 
     content_function: string
 
+    source_lengths: tensor
+            1D int32 Tensor [batch_size] with the true length of each source sentence. If given,
+                attention is not put on the (padded) positions past the end of the sentence.
+                Default to None.
+
     dtype:
             The dtype to use for the RNN initial state (default: tf.float32).
 
@@ -459,6 +492,10 @@ def attention_decoder_output(decoder_inputs, initial_state, attention_states, ce
         # To calculate W1 * h_t we use a 1-by-1 convolution, need to reshape before.
         hidden = array_ops.reshape(attention_states, [-1, attn_length, 1, attn_size])
 
+        # the projection of the encoder states used by the attention scores does not depend on the
+        # decoder, so it is computed once here instead of at every step
+        keys = attention_keys(attention_f, hidden, initializer, content_function=content_function)
+
         cell_state = initial_state
 
         outputs = []
@@ -473,62 +510,57 @@ def attention_decoder_output(decoder_inputs, initial_state, attention_states, ce
         else:
             cell_outputs = decoder_states
 
+        decoder_scope = vs.get_variable_scope()
+        contexts = []
+
         for i in xrange(len(emb_inp)):
-            if i > 0:
-                vs.get_variable_scope().reuse_variables()
 
-            if input_feeding:
-                # if using input_feeding, concatenate previous attention with input to layers
-                inp = array_ops.concat(1, [emb_inp[i], ct])
-            else:
-                inp = emb_inp[i]
+            # the steps share the variables of the first one - the reuse is limited to the step, so the output
+            # attention computed after the loop can still create its variables
+            with vs.variable_scope(decoder_scope, reuse=True if i > 0 else None):
 
-            if combine_inp_attn:
-                # Merge input and previous attentions into one vector of the right size.
-                x = cells.linear([inp] + [ct], cell.input_size, True)
-            else:
-                x = inp
+                if input_feeding:
+                    # if using input_feeding, concatenate previous attention with input to layers
+                    inp = array_ops.concat(1, [emb_inp[i], ct])
+                else:
+                    inp = emb_inp[i]
 
-            # Run the RNN.
-            cell_output, new_state = cell(x, cell_state)
-            cell_state = new_state
+                if combine_inp_attn:
+                    # Merge input and previous attentions into one vector of the right size.
+                    x = cells.linear([inp] + [ct], cell.input_size, True)
+                else:
+                    x = inp
 
-            if decoder_states is None:
+                # Run the RNN.
+                cell_output, new_state = cell(x, cell_state)
+                cell_state = new_state
 
-                # states.append(new_state)  # new_state = dt#
-                cell_outputs.append(cell_output)
+                if decoder_states is None:
 
-            else:
-                reshaped = tf.reshape(cell_output, [-1, 1, 1, attn_size])
-                decoder_states = tf.concat(1, [decoder_states, reshaped])
+                    # states.append(new_state)  # new_state = dt#
+                    cell_outputs.append(cell_output)
 
-            # dt = new_state
-            if content_function is mod_bahdanau:
-                dt = cell_outputs[-2]
-            else:
-                dt = cell_output
+                else:
+                    reshaped = tf.reshape(cell_output, [-1, 1, 1, attn_size])
+                    decoder_states = tf.concat(1, [decoder_states, reshaped])
 
-            ct = attention_f(decoder_hidden_state=dt, hidden_attn=hidden,
-                             initializer=initializer, window_size=window_size,
-                             content_function=content_function, dtype=dtype)
+                # dt = new_state
+                if content_function is mod_bahdanau:
+                    dt = cell_outputs[-2]
+                else:
+                    dt = cell_output
 
-            with vs.variable_scope("AttnOutputProjection", initializer=initializer):
+                ct = attention_f(decoder_hidden_state=dt, hidden_attn=hidden,
+                                 initializer=initializer, window_size=window_size,
+                                 content_function=content_function, source_lengths=source_lengths,
+                                 keys=keys, dtype=dtype)
 
                 if decoder_states is None:
+                    # the output attention of the whole sequence is computed after the loop
+                    contexts.append(ct)
+                    continue
 
-                    shape1 = len(cell_outputs)
-
-                    top_states = [tf.reshape(o, [-1, 1, attn_size]) for o in cell_outputs]
-
-                    output_attention_states = tf.concat(1, top_states)
-
-                    decoder_hidden = array_ops.reshape(output_attention_states, [-1, shape1, 1, attn_size])
-
-                    ht_hat = decoder_output_attention(decoder_hidden,
-                                                      attn_size,
-                                                      decoder_attention_f,
-                                                      initializer=initializer)
-                else:
+                with vs.variable_scope("AttnOutputProjection", initializer=initializer):
 
                     decoder_hidden = decoder_states
 
@@ -536,13 +568,36 @@ def attention_decoder_output(decoder_inputs, initial_state, attention_states, ce
                                                       attn_size,
                                                       decoder_attention_f,
                                                       initializer=initializer,
-                                                      step_num=step_num)
+                                                      incremental=True)
+
+                    output = cells.linear([ct] + [ht_hat], output_size, True)
+
+                    output = tf.tanh(output)
+
+                outputs.append(output)
+
+        if decoder_states is None:
+
+            n_steps = len(cell_outputs)
+
+            top_states = [tf.reshape(o, [-1, 1, attn_size]) for o in cell_outputs]
+
+            decoder_hidden = array_ops.reshape(tf.concat(1, top_states), [-1, n_steps, 1, attn_size])
 
-                output = cells.linear([ct] + [ht_hat], output_size, True)
+            with vs.variable_scope("AttnOutputProjection", initializer=initializer):
+
+                # time-major (n_steps * batch) rows, like the contexts concatenated over axis 0
+                ht_hat = causal_decoder_output_attention(decoder_hidden,
+                                                         attn_size,
+                                                         decoder_attention_f,
+                                                         initializer=initializer)
+
+                # all the steps are projected at once
+                output = cells.linear([tf.concat(0, contexts)] + [ht_hat], output_size, True)
 
                 output = tf.tanh(output)
 
-            outputs.append(output)
+            outputs = array_ops.split(0, n_steps, output)
 
     if decoder_states is None:
 
@@ -557,13 +612,19 @@ def attention_decoder_output(decoder_inputs, initial_state, attention_states, ce
     return outputs, cell_state, cell_outputs
 
 
-def decoder_output_attention(decoder_hidden, attn_size, decoder_attention_f, initializer=None, step_num=None):
+def decoder_output_attention(decoder_hidden, attn_size, decoder_attention_f, initializer=None, incremental=False):
     """
 
     Parameters
     ----------
-    decoder_states
+    decoder_hidden : 4-D Tensor (?, timesteps, 1, attn_size) with the decoder states to attend to.
+        When decoding, timesteps is not known when building the graph and is taken from the
+        shape of the states fed at each step.
     attn_size
+    incremental : if True (single step decoding), the last of the decoder_hidden states is the new
+        one and the keys of the others are the ones returned by the previous step: the projection
+        of the past states is added to the DECODER_KEYS collection, followed by the keys of all the
+        states, so the decoding loop can fetch the latter and feed them back as the former.
 
     Returns
     -------
@@ -573,20 +634,38 @@ def decoder_output_attention(decoder_hidden, attn_size, decoder_attention_f, ini
 
     with vs.variable_scope("decoder_output_attention", initializer=initializer):
 
-        s = decoder_attention_f(decoder_hidden, attn_size)
+        keys = None
+
+        if incremental:
+
+            n_past = array_ops.shape(decoder_hidden)[1] - 1
+            past_hidden = array_ops.slice(decoder_hidden, [0, 0, 0, 0], array_ops.pack([-1, n_past, -1, -1]))
+            new_hidden = array_ops.slice(decoder_hidden, array_ops.pack([0, n_past, 0, 0]), [-1, 1, -1, -1])
+
+            # fed by the decoding loop after the first step - only the new state is projected then
+            past_keys = decoder_content_keys(decoder_attention_f, past_hidden, attn_size)
+            with vs.variable_scope(vs.get_variable_scope(), reuse=True):
+                new_keys = decoder_content_keys(decoder_attention_f, new_hidden, attn_size)
+
+            keys = tf.concat(1, [past_keys, new_keys])
+
+            tf.add_to_collection(DECODER_KEYS, past_keys)
+            tf.add_to_collection(DECODER_KEYS, keys)
+
+        s = decoder_attention_f(decoder_hidden, attn_size, keys=keys)
 
         # beta will be (?, timesteps)
         beta = nn_ops.softmax(s)
 
-        if step_num is None:  # step_num is None when training
+        timesteps = decoder_hidden.get_shape()[1].value
+
+        if timesteps is not None:  # the number of steps is static when training
 
-            shape = decoder_hidden.get_shape()
-            timesteps = shape[1].value
             b = array_ops.reshape(beta, [-1, timesteps, 1, 1])
 
         else:
 
-            b = array_ops.reshape(beta, tf.pack([-1, step_num, 1, 1]))
+            b = array_ops.reshape(beta, array_ops.pack([-1, array_ops.shape(decoder_hidden)[1], 1, 1]))
 
         # b  and decoder_hidden will be (?, timesteps, 1, 1)
         d = math_ops.reduce_sum(b * decoder_hidden, [1, 2])
@@ -600,10 +679,59 @@ def decoder_output_attention(decoder_hidden, attn_size, decoder_attention_f, ini
     return ds
 
 
+def causal_decoder_output_attention(decoder_hidden, attn_size, decoder_attention_f, initializer=None):
+    """Output attention of all the training steps at once: step i attends to the decoder states 0..i.
+
+    The scores of decoder_type_1 and decoder_type_2 only depend on the state being scored, so all the
+    states are projected and scored once, and each step takes the softmax of its prefix of the scores
+    through a causal mask. Gives the same result as calling decoder_output_attention at every step on
+    the states seen so far, with the same variables.
+
+    Parameters
+    ----------
+    decoder_hidden : 4-D Tensor (?, timesteps, 1, attn_size) with the decoder states of all the steps.
+        timesteps must be known when building the graph.
+    attn_size
+    decoder_attention_f
+    initializer
+
+    Returns
+    -------
+    ds : 2-D Tensor (timesteps * ?, attn_size) with the context of each step, time-major (the contexts
+        of the first step come first).
+
+    """
+    assert initializer is not None
+
+    timesteps = decoder_hidden.get_shape()[1].value
+
+    with vs.variable_scope("decoder_output_attention", initializer=initializer):
+
+        # s will be (?, timesteps)
+        s = decoder_attention_f(decoder_hidden, attn_size)
+
+        # mask[i, j] is 1 if step i can see the state j
+        mask = tf.constant(numpy.tril(numpy.ones((timesteps, timesteps))), dtype=s.dtype)
+
+        # scores seen by each step, (?, timesteps, timesteps) - the max of the prefix keeps the softmax stable
+        scores = array_ops.expand_dims(s, 1) + (mask - 1.0) * 1e30
+        e = math_ops.exp(scores - math_ops.reduce_max(scores, [2], keep_dims=True)) * mask
+        beta = e / math_ops.reduce_sum(e, [2], keep_dims=True)
+
+        # (?, timesteps, timesteps) x (?, timesteps, attn_size)
+        d = math_ops.batch_matmul(beta, array_ops.reshape(decoder_hidden, [-1, timesteps, attn_size]))
+
+        ds = array_ops.reshape(array_ops.transpose(d, [1, 0, 2]), [-1, attn_size])
+
+    _ = tf.histogram_summary('attention_decoder_context', ds)
+
+    return ds
+
+
 def attention_decoder_output_informed(decoder_inputs, initial_state, attention_states, cell, num_symbols,
                                       attention_f=global_attention, window_size=10, content_function=vinyals_kaiser,
                                       decoder_attention_f=decoder_type_2, combine_inp_attn=False, input_feeding=False,
-                                      dropout=None, initializer=None, decoder_states=None, step_num=None,
+                                      dropout=None, initializer=None, decoder_states=None, source_lengths=None,
                                       dtype=tf.float32, scope=None):
     """
 
@@ -651,6 +779,11 @@ def attention_decoder_output_informed(decoder_inputs, initial_state, attention_s
 
     content_function: string
 
+    source_lengths: tensor
+            1D int32 Tensor [batch_size] with the true length of each source sentence. If given,
+                attention is not put on the (padded) positions past the end of the sentence.
+                Default to None.
+
     dtype:
             The dtype to use for the RNN initial state (default: tf.float32).
 
@@ -700,6 +833,10 @@ def attention_decoder_output_informed(decoder_inputs, initial_state, attention_s
         # To calculate W1 * h_t we use a 1-by-1 convolution, need to reshape before.
         hidden = array_ops.reshape(attention_states, [-1, attn_length, 1, attn_size])
 
+        # the projection of the encoder states used by the attention scores does not depend on the
+        # decoder, so it is computed once here instead of at every step
+        keys = attention_keys(attention_f, hidden, initializer, content_function=content_function)
+
         cell_state = initial_state
 
         outputs = []
@@ -714,62 +851,59 @@ def attention_decoder_output_informed(decoder_inputs, initial_state, attention_s
         else:
             cell_outputs = decoder_states
 
+        decoder_scope = vs.get_variable_scope()
+        contexts = []
+        step_inputs = []
+
         for i in xrange(len(emb_inp)):
-            if i > 0:
-                vs.get_variable_scope().reuse_variables()
 
-            if input_feeding:
-                # if using input_feeding, concatenate previous attention with input to layers
-                inp = array_ops.concat(1, [emb_inp[i], ct])
-            else:
-                inp = emb_inp[i]
+            # the steps share the variables of the first one - the reuse is limited to the step, so the output
+            # attention computed after the loop can still create its variables
+            with vs.variable_scope(decoder_scope, reuse=True if i > 0 else None):
 
-            if combine_inp_attn:
-                # Merge input and previous attentions into one vector of the right size.
-                x = cells.linear([inp] + [ct], cell.input_size, True)
-            else:
-                x = inp
+                if input_feeding:
+                    # if using input_feeding, concatenate previous attention with input to layers
+                    inp = array_ops.concat(1, [emb_inp[i], ct])
+                else:
+                    inp = emb_inp[i]
 
-            # Run the RNN.
-            cell_output, new_state = cell(x, cell_state)
-            cell_state = new_state
+                if combine_inp_attn:
+                    # Merge input and previous attentions into one vector of the right size.
+                    x = cells.linear([inp] + [ct], cell.input_size, True)
+                else:
+                    x = inp
 
-            if decoder_states is None:
+                # Run the RNN.
+                cell_output, new_state = cell(x, cell_state)
+                cell_state = new_state
 
-                # states.append(new_state)  # new_state = dt#
-                cell_outputs.append(cell_output)
+                if decoder_states is None:
 
-            else:
-                reshaped = tf.reshape(cell_output, [-1, 1, 1, attn_size])
-                decoder_states = tf.concat(1, [decoder_states, reshaped])
+                    # states.append(new_state)  # new_state = dt#
+                    cell_outputs.append(cell_output)
 
-            # dt = new_state
-            if content_function is mod_bahdanau:
-                dt = cell_outputs[-2]
-            else:
-                dt = cell_output
+                else:
+                    reshaped = tf.reshape(cell_output, [-1, 1, 1, attn_size])
+                    decoder_states = tf.concat(1, [decoder_states, reshaped])
 
-            ct = attention_f(decoder_hidden_state=dt, hidden_attn=hidden,
-                             initializer=initializer, window_size=window_size,
-                             content_function=content_function, dtype=dtype)
+                # dt = new_state
+                if content_function is mod_bahdanau:
+                    dt = cell_outputs[-2]
+                else:
+                    dt = cell_output
 
-            with vs.variable_scope("AttnOutputProjection", initializer=initializer):
+                ct = attention_f(decoder_hidden_state=dt, hidden_attn=hidden,
+                                 initializer=initializer, window_size=window_size,
+                                 content_function=content_function, source_lengths=source_lengths,
+                                 keys=keys, dtype=dtype)
 
                 if decoder_states is None:
+                    # the output attention of the whole sequence is computed after the loop
+                    contexts.append(ct)
+                    step_inputs.append(x)
+                    continue
 
-                    shape1 = len(cell_outputs)
-
-                    top_states = [tf.reshape(o, [-1, 1, attn_size]) for o in cell_outputs]
-
-                    output_attention_states = tf.concat(1, top_states)
-
-                    decoder_hidden = array_ops.reshape(output_attention_states, [-1, shape1, 1, attn_size])
-
-                    ht_hat = decoder_output_attention(decoder_hidden,
-                                                      attn_size,
-                                                      decoder_attention_f,
-                                                      initializer=initializer)
-                else:
+                with vs.variable_scope("AttnOutputProjection", initializer=initializer):
 
                     decoder_hidden = decoder_states
 
@@ -777,26 +911,59 @@ def attention_decoder_output_informed(decoder_inputs, initial_state, attention_s
                                                       attn_size,
                                                       decoder_attention_f,
                                                       initializer=initializer,
-                                                      step_num=step_num)
+                                                      incremental=True)
 
+                    with vs.variable_scope("AttnOutputProjection_logit_lstm", initializer=initializer):
+
+                        # if we pass a list of tensors, linear will first concatenate them over axis 1
+                        logit_lstm = cells.linear([ht_hat], output_size, True)
+
+                    with vs.variable_scope("AttnOutputProjection_logit_ctx", initializer=initializer):
+
+                        # if we pass a list of tensors, linear will first concatenate them over axis 1
+                        logit_ctx = cells.linear([ct], output_size, True)
+
+                    with vs.variable_scope("AttnOutputProjection_logit_emb", initializer=initializer):
+
+                        # if we pass a list of tensors, linear will first concatenate them over axis 1
+                        logit_prev = cells.linear([x], output_size, True)
+
+                    output = tf.tanh(logit_lstm + logit_prev + logit_ctx)
+
+                outputs.append(output)
+
+        if decoder_states is None:
+
+            n_steps = len(cell_outputs)
+
+            top_states = [tf.reshape(o, [-1, 1, attn_size]) for o in cell_outputs]
+
+            decoder_hidden = array_ops.reshape(tf.concat(1, top_states), [-1, n_steps, 1, attn_size])
+
+            with vs.variable_scope("AttnOutputProjection", initializer=initializer):
+
+                # time-major (n_steps * batch) rows, like the contexts concatenated over axis 0
+                ht_hat = causal_decoder_output_attention(decoder_hidden,
+                                                         attn_size,
+                                                         decoder_attention_f,
+                                                         initializer=initializer)
+
+                # all the steps are projected at once
                 with vs.variable_scope("AttnOutputProjection_logit_lstm", initializer=initializer):
 
-                    # if we pass a list of tensors, linear will first concatenate them over axis 1
                     logit_lstm = cells.linear([ht_hat], output_size, True)
 
                 with vs.variable_scope("AttnOutputProjection_logit_ctx", initializer=initializer):
 
-                    # if we pass a list of tensors, linear will first concatenate them over axis 1
-                    logit_ctx = cells.linear([ct], output_size, True)
+                    logit_ctx = cells.linear([tf.concat(0, contexts)], output_size, True)
 
                 with vs.variable_scope("AttnOutputProjection_logit_emb", initializer=initializer):
 
-                    # if we pass a list of tensors, linear will first concatenate them over axis 1
-                    logit_prev = cells.linear([x], output_size, True)
+                    logit_prev = cells.linear([tf.concat(0, step_inputs)], output_size, True)
 
                 output = tf.tanh(logit_lstm + logit_prev + logit_ctx)
 
-            outputs.append(output)
+            outputs = array_ops.split(0, n_steps, output)
 
     if decoder_states is None:
 
@@ -814,7 +981,7 @@ def attention_decoder_output_informed(decoder_inputs, initial_state, attention_s
 def attention_decoder_nmt(decoder_inputs, initial_state, attention_states, cell, num_symbols,
                           attention_f=global_attention, window_size=10, content_function=vinyals_kaiser,
                           decoder_attention_f=decoder_type_2, combine_inp_attn=False, input_feeding=False,
-                          dropout=None, initializer=None, dtype=tf.float32, scope=None):
+                          dropout=None, initializer=None, source_lengths=None, dtype=tf.float32, scope=None):
     """
 
     Helper function implementing a RNN decoder with global, local or hybrid attention for the sequence-to-sequence
@@ -864,6 +1031,11 @@ def attention_decoder_nmt(decoder_inputs, initial_state, attention_states, cell,
 
     content_function: string
 
+    source_lengths: tensor
+            1D int32 Tensor [batch_size] with the true length of each source sentence. If given,
+                attention is not put on the (padded) positions past the end of the sentence.
+                Default to None.
+
     dtype:
             The dtype to use for the RNN initial state (default: tf.float32).
 
@@ -912,6 +1084,10 @@ def attention_decoder_nmt(decoder_inputs, initial_state, attention_states, cell,
         # To calculate W1 * h_t we use a 1-by-1 convolution, need to reshape before.
         hidden = array_ops.reshape(attention_states, [-1, attn_length, 1, attn_size])
 
+        # the projection of the encoder states used by the attention scores does not depend on the
+        # decoder, so it is computed once here instead of at every step
+        keys = attention_keys(attention_f, hidden, initializer, content_function=content_function)
+
         cell_states = initial_state
         initial_state_decoder = tf.zeros_like(initial_state)
         initial_state_decoder.set_shape([None, initial_state.get_shape()[1].value])
@@ -943,7 +1119,8 @@ def attention_decoder_nmt(decoder_inputs, initial_state, attention_states, cell,
 
             ct = attention_f(decoder_hidden_state=dt, hidden_attn=hidden,
                              initializer=initializer, window_size=window_size,
-                             content_function=content_function, dtype=dtype)
+                             content_function=content_function, source_lengths=source_lengths,
+                             keys=keys, dtype=dtype)
 
             # Run the RNN.
             cell_output, new_state = cell(x, cell_states, context=ct)
@@ -974,3 +1151,254 @@ def attention_decoder_nmt(decoder_inputs, initial_state, attention_states, cell,
             outputs.append(output)
 
     return outputs, cell_states
+
+
+def dynamic_attention_decoder(decoder_inputs, initial_state, attention_states, cell, num_symbols,
+                              attention_f=global_attention, window_size=10, content_function=vinyals_kaiser,
+                              decoder_attention_f=None, combine_inp_attn=False, input_feeding=False,
+                              dropout=None, initializer=None, decoder_states=None,
+                              source_lengths=None, informed=False, output_attention=False, nmt=False,
+                              n_steps=None, parallel_iterations=32, dtype=tf.float32, scope=None):
+    """
+
+    Same decoder as attention_decoder, attention_decoder_informed, attention_decoder_output,
+        attention_decoder_output_informed (chosen with output_attention and informed) and attention_decoder_nmt
+        (with nmt), but the time steps are run by a graph-level while loop instead of being unrolled in python:
+        the cell, attention and output projection ops are created once, and the number of steps is a tensor.
+        A single graph, built for the longest decoder inputs, then covers every target length. The variables
+        have the same names as in the unrolled decoders, so the models can be saved with one and restored with
+        the other.
+
+    When decoder_states is given (i.e., when translating one step at a time) or there is a single decoder
+        input, there is nothing to unroll and the matching static decoder is used.
+
+    Parameters
+    ----------
+
+    decoder_inputs, initial_state, attention_states, cell, num_symbols, attention_f, window_size,
+    content_function, decoder_attention_f, combine_inp_attn, input_feeding, dropout, initializer,
+    decoder_states, source_lengths, dtype:
+            see attention_decoder and attention_decoder_output.
+
+    informed: boolean
+            Whether to use the previous word embedding to compute the output (as the *_informed decoders).
+                Default to False.
+
+    output_attention: boolean
+            Whether to put attention on the decoder outputs with decoder_attention_f (as the *_output
+                decoders). Default to False.
+
+    nmt: boolean
+            Whether to run the steps of attention_decoder_nmt: the attention is computed from the previous
+                cell output and given to the cell as its context. informed and output_attention are ignored.
+                Default to False.
+
+    n_steps: tensor
+            Scalar int32 Tensor with the number of steps to run, e.g. the length of the longest target of the
+                batch; the decoder inputs past it are not used. Default to len(decoder_inputs).
+
+    parallel_iterations: int
+            Number of time steps the while loop may run in parallel. Default to 32.
+
+    scope:
+            VariableScope for the created subgraph; default: the one of the matching static decoder.
+
+    Returns
+    -------
+
+    outputs:
+            3D Tensor [n_steps x batch_size x output_size] with the outputs of the steps that were run (a list
+                of 2D Tensors when the static decoder is used).
+
+    state:
+            The state of the decoder cell after the last time step.
+
+    cell_outputs:
+            4D Tensor [batch_size x n_steps x 1 x cell.output_size] with the output of the decoder cell at
+                each time step when attention is put on the decoder outputs, None otherwise.
+
+    """
+    assert attention_f is not None
+
+    if nmt:
+        output_attention = False
+        default_scope = "embedding_attention_decoder"
+    elif not output_attention:
+        static_decoder = attention_decoder_informed if informed else attention_decoder
+        default_scope = "embedding_attention_decoder"
+    else:
+        static_decoder = attention_decoder_output_informed if informed else attention_decoder_output
+        default_scope = "attention_decoder"
+
+    if decoder_states is not None or len(decoder_inputs) == 1:
+        # one step at a time - nothing to unroll
+        if nmt:
+            outputs, state = attention_decoder_nmt(decoder_inputs, initial_state, attention_states, cell,
+                                                   num_symbols, attention_f=attention_f, window_size=window_size,
+                                                   content_function=content_function,
+                                                   decoder_attention_f=decoder_attention_f,
+                                                   combine_inp_attn=combine_inp_attn, input_feeding=input_feeding,
+                                                   dropout=dropout, initializer=initializer,
+                                                   source_lengths=source_lengths, dtype=dtype, scope=scope)
+            return outputs, state, None
+
+        return static_decoder(decoder_inputs, initial_state, attention_states, cell, num_symbols,
+                              attention_f=attention_f, window_size=window_size,
+                              content_function=content_function, decoder_attention_f=decoder_attention_f,
+                              combine_inp_attn=combine_inp_attn, input_feeding=input_feeding,
+                              dropout=dropout, initializer=initializer, decoder_states=decoder_states,
+                              source_lengths=source_lengths, dtype=dtype, scope=scope)
+
+    output_size = cell.output_size
+
+    if dropout is not None:
+
+        if nmt:
+            cell.input_keep_prob = 1.0 - dropout
+        else:
+            for c in cell._cells:
+                c.input_keep_prob = 1.0 - dropout
+
+    if initializer is None:
+        initializer = tf.random_uniform_initializer(minval=-0.1, maxval=0.1, seed=_SEED)
+
+    with vs.variable_scope(scope or default_scope, initializer=initializer):
+
+        # all the decoder inputs are embedded with a single lookup: [len(decoder_inputs) x batch_size x input_size]
+        emb_inp = _embed_inputs([array_ops.pack(decoder_inputs)], num_symbols, cell.input_size,
+                                input_feeding=input_feeding)[0]
+
+        if n_steps is None:
+            n_steps = array_ops.shape(emb_inp)[0]
+        else:
+            emb_inp = array_ops.slice(emb_inp, [0, 0, 0], array_ops.pack([n_steps, -1, -1]))
+
+        batch = array_ops.shape(emb_inp)[1]  # Needed for reshaping.
+        attn_length = attention_states.get_shape()[1].value
+        attn_size = attention_states.get_shape()[2].value
+
+        # To calculate W1 * h_t we use a 1-by-1 convolution, need to reshape before.
+        hidden = array_ops.reshape(attention_states, [-1, attn_length, 1, attn_size])
+
+        # the projection of the encoder states used by the attention scores does not depend on the
+        # decoder, so it is computed once here instead of at every step
+        keys = attention_keys(attention_f, hidden, initializer, content_function=content_function)
+
+        batch_attn_size = array_ops.pack([batch, attn_size])
+
+        # initial attention state
+        ct = array_ops.zeros(batch_attn_size, dtype=dtype)
+        ct.set_shape([None, attn_size])
+
+        # previous cell output (used by mod_bahdanau and by the nmt decoder) - zeros before the first step
+        prev_output = array_ops.zeros(array_ops.pack([batch, cell.output_size]), dtype=dtype)
+        prev_output.set_shape([None, cell.output_size])
+
+        # cell outputs seen so far, one slot per time step - used to put attention on the decoder outputs
+        history = array_ops.zeros(array_ops.pack([batch, n_steps, 1, attn_size]), dtype=dtype)
+        positions = math_ops.range(0, n_steps)
+
+        inp_shape = [None, emb_inp.get_shape()[2].value]
+        inputs_ta = tensor_array_ops.TensorArray(dtype=dtype, size=n_steps, tensor_array_name="decoder_inputs")
+        inputs_ta = inputs_ta.unpack(emb_inp)
+        outputs_ta = tensor_array_ops.TensorArray(dtype=dtype, size=n_steps, tensor_array_name="decoder_outputs")
+
+        time = array_ops.constant(0, dtype=tf.int32, name="time")
+
+        def _cond(time, *_):
+            return math_ops.less(time, n_steps)
+
+        def _step(time, cell_state, ct, prev_output, history, outputs_ta):
+
+            inp = inputs_ta.read(time)
+            inp.set_shape(inp_shape)
+
+            if input_feeding:
+                # if using input_feeding, concatenate previous attention with input to layers
+                inp = array_ops.concat(1, [inp, ct])
+
+            if combine_inp_attn:
+                # Merge input and previous attentions into one vector of the right size.
+                x = cells.linear([inp] + [ct], cell.input_size, True)
+            else:
+                x = inp
+
+            if nmt:
+
+                # attention from the previous cell output, given to the cell as its context
+                ct = attention_f(decoder_hidden_state=prev_output, hidden_attn=hidden,
+                                 initializer=initializer, window_size=window_size,
+                                 content_function=content_function, source_lengths=source_lengths,
+                                 keys=keys, dtype=dtype)
+                ct.set_shape([None, attn_size])
+
+                cell_output, new_state = cell(x, cell_state, context=ct)
+
+            else:
+
+                # Run the RNN.
+                cell_output, new_state = cell(x, cell_state)
+
+                if content_function is mod_bahdanau:
+                    dt = prev_output
+                else:
+                    dt = cell_output
+
+                ct = attention_f(decoder_hidden_state=dt, hidden_attn=hidden,
+                                 initializer=initializer, window_size=window_size,
+                                 content_function=content_function, source_lengths=source_lengths,
+                                 keys=keys, dtype=dtype)
+                ct.set_shape([None, attn_size])
+
+            with vs.variable_scope("AttnOutputProjection", initializer=initializer):
+
+                if output_attention:
+
+                    # write this step in its slot and attend over the steps seen so far
+                    slot = array_ops.reshape(math_ops.cast(math_ops.equal(positions, time), dtype), [1, -1, 1, 1])
+                    history += slot * array_ops.reshape(cell_output, [-1, 1, 1, attn_size])
+
+                    decoder_hidden = array_ops.slice(history, [0, 0, 0, 0], array_ops.pack([-1, time + 1, -1, -1]))
+                    decoder_hidden.set_shape([None, None, 1, attn_size])
+
+                    h = decoder_output_attention(decoder_hidden,
+                                                 attn_size,
+                                                 decoder_attention_f,
+                                                 initializer=initializer)
+                else:
+                    h = cell_output
+
+                if informed or nmt:
+
+                    with vs.variable_scope("AttnOutputProjection_logit_lstm", initializer=initializer):
+                        logit_lstm = cells.linear([h], output_size, True)
+
+                    with vs.variable_scope("AttnOutputProjection_logit_ctx", initializer=initializer):
+                        logit_ctx = cells.linear([ct], output_size, True)
+
+                    with vs.variable_scope("AttnOutputProjection_logit_emb", initializer=initializer):
+                        logit_prev = cells.linear([x], output_size, True)
+
+                    output = tf.tanh(logit_lstm + logit_prev + logit_ctx)
+
+                else:
+
+                    # if we pass a list of tensors, linear will first concatenate them over axis 1
+                    output = tf.tanh(cells.linear([ct] + [h], output_size, True))
+
+            outputs_ta = outputs_ta.write(time, output)
+
+            return time + 1, new_state, ct, cell_output, history, outputs_ta
+
+        _, cell_state, _, _, history, outputs_ta = _while_loop(
+            _cond, _step, [time, initial_state, ct, prev_output, history, outputs_ta],
+            parallel_iterations=parallel_iterations)
+
+        # the outputs stay stacked: the loss projects them at once (see loss_ops.stacked_sequence_loss)
+        outputs = outputs_ta.pack()
+        outputs.set_shape([None, None, output_size])
+
+    if not output_attention:
+        return outputs, cell_state, None
+
+    return outputs, cell_state, history
@@ -9,7 +9,7 @@ import cells
 
 
 def reverse_encoder(source, src_embedding, encoder_cell, batch_size,
-                    dropout=None, dtype=tf.float32):
+                    dropout=None, sequence_length=None, dtype=tf.float32):
     """
 
     Parameters
@@ -18,6 +18,9 @@ def reverse_encoder(source, src_embedding, encoder_cell, batch_size,
     src_embedding
     encoder_cell
     batch_size
+    sequence_length : true length of each source sentence; the steps past it are not computed
+        (the state is copied through and the outputs are zero). The sentences must be at the
+        beginning of the source list, followed by the padding.
     dtype
 
     Returns
@@ -38,6 +41,7 @@ def reverse_encoder(source, src_embedding, encoder_cell, batch_size,
     outputs, state = rnn.rnn(encoder_cell, emb_inp,
                               initial_state=initial_state,
                               dtype=dtype,
+                              sequence_length=sequence_length,
                               scope='reverse_encoder')
 
     hidden_states = outputs
@@ -55,7 +59,7 @@ def reverse_encoder(source, src_embedding, encoder_cell, batch_size,
 
 
 def bidirectional_encoder(source, src_embedding, encoder_cell_fw, encoder_cell_bw,
-                          dropout=None, dtype=tf.float32):
+                          dropout=None, sequence_length=None, dtype=tf.float32):
     """
 
     Parameters
@@ -64,6 +68,9 @@ def bidirectional_encoder(source, src_embedding, encoder_cell_fw, encoder_cell_b
     src_embedding
     encoder_cell
     batch_size
+    sequence_length : true length of each source sentence; the steps past it are not computed
+        (the state is copied through and the outputs are zero). The sentences must be at the
+        beginning of the source list, followed by the padding.
     dtype
 
     Returns
@@ -80,7 +87,8 @@ def bidirectional_encoder(source, src_embedding, encoder_cell_fw, encoder_cell_b
         encoder_cell_bw.input_keep_prob = 1.0 - dropout
 
     outputs, _, output_state_bw = cells.bidirectional_rnn(
-        encoder_cell_fw, encoder_cell_bw, emb_inp, dtype=dtype, scope='bidirectional_encoder'
+        encoder_cell_fw, encoder_cell_bw, emb_inp, dtype=dtype, sequence_length=sequence_length,
+        scope='bidirectional_encoder'
     )
 
     tf_version = pkg_resources.get_distribution("tensorflow").version
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+    Validation of translation models on the development set, either from the training loop
+    or from a separate evaluator process that watches the training directory for new
+    checkpoints, keeps the best models and signals early stop to the trainer.
+
+"""
+from __future__ import print_function
+
+import json
+import math
+import os
+import sys
+import time
+
+import tensorflow as tf
+from tensorflow.python.platform import gfile
+
+import build_ops
+import data_utils
+import session_ops
+from data_utils import read_nmt_data
+
+# files the evaluator shares with the trainer (inside train_dir)
+EARLY_STOP_FILE = 'EARLY_STOP'
+FINISHED_FILE = 'TRAINING_FINISHED'
+RESULTS_FILE = 'validation.jsonl'
+STATE_FILE = 'evaluator_state.json'
+# copy of the checkpoint being evaluated, so the trainer may delete the original meanwhile
+PENDING_CHECKPOINT = 'evaluator-pending'
+
+# attempts to read a checkpoint before it is skipped
+MAX_READ_ATTEMPTS = 3
+
+
+def evaluate_nmt(session, model, dev_set, buckets):
+    """Run the model forward over every bucket of the development set and print the perplexity
+    of each bucket. Returns the loss averaged over the buckets and the list of bucket losses
+    (None for the empty buckets, which are skipped)."""
+
+    total_eval_loss = 0.0
+    bucket_losses = []
+
+    print('\n')
+
+    # Run evals on development set and print their perplexity.
+    for bucket_id in xrange(len(buckets)):
+
+        if len(dev_set[bucket_id]) == 0:
+            print('  eval: empty bucket %d' % bucket_id)
+            bucket_losses.append(None)
+            continue
+
+        # the batches are sampled from the bucket, so a bucket smaller than a batch still gets one
+        n_steps = max(len(dev_set[bucket_id]) // model.batch_size, 1)
+
+        bucket_loss = 0.0
+
+        for _ in xrange(n_steps):
+            encoder_inputs, decoder_inputs, target_weights, _, source_lengths = model.get_train_batch(dev_set,
+                                                                                                      bucket_id)
+
+            _, eval_loss, _ = model.train_step(session=session, encoder_inputs=encoder_inputs,
+                                               decoder_inputs=decoder_inputs, target_weights=target_weights,
+                                               bucket_id=bucket_id, validation_step=True,
+                                               source_lengths=source_lengths)
+
+            bucket_loss += eval_loss
+
+        bucket_avg_loss = bucket_loss / n_steps
+        total_eval_loss += bucket_avg_loss
+        bucket_losses.append(bucket_avg_loss)
+
+        eval_ppx = math.exp(bucket_avg_loss) if bucket_avg_loss < 300 else float('inf')
+        print('  eval: bucket %d perplexity %.4f' % (bucket_id, eval_ppx))
+
+    n_evaluated = len([loss for loss in bucket_losses if loss is not None])
+    avg_eval_loss = total_eval_loss / max(n_evaluated, 1)
+    avg_ppx = math.exp(avg_eval_loss) if avg_eval_loss < 300 else float('inf')
+
+    if avg_ppx > 1000.0:
+        print('\n  eval: averaged perplexity > 1000.0')
+    else:
+        print('\n  eval: averaged perplexity %.8f' % avg_ppx)
+    print('  eval: averaged loss %.8f\n' % avg_eval_loss)
+
+    sys.stdout.flush()
+
+    return avg_eval_loss, bucket_losses
+
+
+def early_stop_requested(train_dir):
+    """Whether the evaluator asked the trainer of train_dir to stop."""
+    return os.path.exists(os.path.join(train_dir, EARLY_STOP_FILE))
+
+
+def reset_early_stop(train_dir):
+    """Forget the early stop of a previous run when training (re)starts: remove the EARLY_STOP
+    file and reset the early stop counter of the evaluator state (the best loss is kept)."""
+    path = os.path.join(train_dir, EARLY_STOP_FILE)
+    if os.path.exists(path):
+        os.remove(path)
+
+    state_path = os.path.join(train_dir, STATE_FILE)
+    if os.path.exists(state_path):
+        state = _load_state(state_path)
+        state['estop_counter'] = 0
+        _save_state(state_path, state)
+
+
+def read_validation_results(train_dir, offset=0):
+    """The validation records the evaluator appended to train_dir/validation.jsonl after the
+    byte offset, and the offset following the last complete record (a record still being
+    written is left for the next call)."""
+    path = os.path.join(train_dir, RESULTS_FILE)
+    records = []
+
+    if not os.path.exists(path):
+        return records, offset
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in iter(f.readline, b''):
+            if not line.endswith(b'\n'):
+                break
+            records.append(json.loads(line.decode('utf-8')))
+            offset += len(line)
+
+    return records, offset
+
+
+def mark_training_finished(train_dir, finished=True):
+    """Tell the evaluator that no more checkpoints will be written to train_dir (or, with
+    finished=False, that training is running again)."""
+    path = os.path.join(train_dir, FINISHED_FILE)
+    if finished:
+        with open(path, 'w') as f:
+            f.write('%f\n' % time.time())
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _load_state(path):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {'last_checkpoint': None, 'best_eval_loss': float('inf'), 'estop_counter': 0}
+
+
+def _save_state(path, state):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp_path, path)
+
+
+def _checkpoint_files(prefix):
+    """The files of the checkpoint prefix (a single file, or its index, data and meta files)."""
+    return [path for path in gfile.Glob(prefix + '*') if path == prefix or path.startswith(prefix + '.')]
+
+
+def _copy_checkpoint(prefix, new_prefix):
+    files = _checkpoint_files(prefix)
+    if not files:
+        raise IOError('no files found for checkpoint %s' % prefix)
+    for path in files:
+        gfile.Copy(path, new_prefix + path[len(prefix):], overwrite=True)
+
+
+def _promote_checkpoint(prefix, best_models_dir, best_model_path, global_step, keep=0):
+    """Copy the files of the checkpoint prefix to best_model_path-global_step - with every
+    variable of the trainer, optimizer slots included - and make it the latest checkpoint of
+    best_models_dir, which keeps the last keep best models (all of them if keep <= 0)."""
+    new_prefix = '%s-%d' % (best_model_path, global_step)
+    _copy_checkpoint(prefix, new_prefix)
+
+    ckpt = tf.train.get_checkpoint_state(best_models_dir)
+    paths = list(ckpt.all_model_checkpoint_paths) if ckpt else []
+    paths = [path for path in paths if path != new_prefix] + [new_prefix]
+
+    if keep > 0:
+        for old_prefix in paths[:-keep]:
+            for path in _checkpoint_files(old_prefix):
+                gfile.Remove(path)
+        paths = paths[-keep:]
+
+    tf.train.update_checkpoint_state(best_models_dir, new_prefix, paths)
+
+
+def watch_checkpoints(FLAGS=None, buckets=None):
+    """Evaluate every new checkpoint of FLAGS.train_dir on the development set.
+
+    Runs until the trainer marks the training as finished (and its last checkpoint has been
+    evaluated) or until early stop is triggered. The model is built once, without gradients,
+    with FLAGS.eval_batch_size sentences per batch; each new checkpoint is restored into it.
+
+    For each checkpoint, a JSON record is appended to train_dir/validation.jsonl. When the
+    validation loss improves, the checkpoint is promoted to FLAGS.best_models_dir. When it
+    does not improve for FLAGS.early_stop_patience evaluations (after
+    FLAGS.early_stop_after_epoch), the EARLY_STOP file is written to train_dir so the trainer
+    stops at its next validation interval.
+
+    Each checkpoint is copied before it is restored, so the trainer may delete it meanwhile
+    (see keep_checkpoints); a checkpoint that cannot be read is retried at the next poll, and
+    skipped after MAX_READ_ATTEMPTS attempts.
+    """
+    assert FLAGS is not None
+    assert buckets is not None
+
+    print('Preparing data in %s' % FLAGS.data_dir)
+    _, _, src_dev, tgt_dev, _, _ = data_utils.prepare_nmt_data(FLAGS)
+
+    results_path = os.path.join(FLAGS.train_dir, RESULTS_FILE)
+    state_path = os.path.join(FLAGS.train_dir, STATE_FILE)
+    best_model_path = os.path.join(FLAGS.best_models_dir, FLAGS.model_name + '-best')
+    pending_path = os.path.join(FLAGS.train_dir, PENDING_CHECKPOINT)
+
+    estop = FLAGS.early_stop_patience
+
+    with tf.Session(config=session_ops.get_session_config(FLAGS)) as sess:
+
+        print('Creating layers.')
+
+        # translate=True turns dropout off
+        if FLAGS.model == "seq2seq":
+            model = build_ops.create_seq2seq_model(sess, False, FLAGS=FLAGS, buckets=buckets, translate=True,
+                                                   batch_size=FLAGS.eval_batch_size, eval_only=True)
+        else:
+            model = build_ops.create_nmt_model(sess, False, FLAGS=FLAGS, buckets=buckets, translate=True,
+                                               batch_size=FLAGS.eval_batch_size, eval_only=True)
+
+        print('Reading development data.')
+        dev_set = read_nmt_data(src_dev, tgt_dev, FLAGS=FLAGS, buckets=buckets)
+
+        state = _load_state(state_path)
+        read_attempts = {}
+
+        print('Watching %s for new checkpoints...' % FLAGS.train_dir)
+        while True:
+
+            # read the marker before the checkpoint state, so the last checkpoint is never missed
+            finished = os.path.exists(os.path.join(FLAGS.train_dir, FINISHED_FILE))
+
+            ckpt = tf.train.get_checkpoint_state(FLAGS.train_dir)
+
+            if ckpt and ckpt.model_checkpoint_path != state['last_checkpoint'] \
+                    and gfile.Exists(ckpt.model_checkpoint_path):
+
+                checkpoint_path = ckpt.model_checkpoint_path
+
+                print('\nEvaluating %s' % checkpoint_path)
+                start_time = time.time()
+
+                try:
+                    _copy_checkpoint(checkpoint_path, pending_path)
+                    model.saver.restore(sess, pending_path)
+                except (tf.errors.OpError, IOError, OSError) as e:
+                    # removed by the retention of the trainer, or not completely written yet
+                    attempt = read_attempts[checkpoint_path] = read_attempts.get(checkpoint_path, 0) + 1
+                    print('Could not read %s (attempt %d): %s' % (checkpoint_path, attempt, e))
+                    if attempt >= MAX_READ_ATTEMPTS:
+                        print('Skipping %s' % checkpoint_path)
+                        state['last_checkpoint'] = checkpoint_path
+                        _save_state(state_path, state)
+                    sys.stdout.flush()
+                    time.sleep(FLAGS.eval_poll_secs)
+                    continue
+
+                global_step = int(model.global_step.eval())
+                epoch = int(model.epoch.eval())
+
+                avg_eval_loss, bucket_losses = evaluate_nmt(sess, model, dev_set, buckets)
+
+                is_best = avg_eval_loss < state['best_eval_loss']
+
+                if is_best:
+                    state['best_eval_loss'] = avg_eval_loss
+                    state['estop_counter'] = 0
+
+                    if FLAGS.save_best_model or estop > 0:
+                        print('Saving the best model so far...')
+                        _promote_checkpoint(pending_path, FLAGS.best_models_dir, best_model_path, global_step,
+                                            keep=FLAGS.keep_best_checkpoints)
+
+                # if FLAGS.early_stop_after_epoch is equal to 0, it will monitor from the beginning
+                elif estop > 0 and epoch >= FLAGS.early_stop_after_epoch:
+                    state['estop_counter'] += 1
+
+                state['last_checkpoint'] = checkpoint_path
+
+                record = {'time': time.time(), 'checkpoint': checkpoint_path, 'global_step': global_step,
+                          'epoch': epoch, 'loss': avg_eval_loss,
+                          'perplexity': math.exp(avg_eval_loss) if avg_eval_loss < 300 else float('inf'),
+                          'bucket_losses': bucket_losses, 'best': is_best,
+                          'best_eval_loss': state['best_eval_loss'], 'estop_counter': state['estop_counter'],
+                          'eval_time': time.time() - start_time}
+
+                with open(results_path, 'a') as f:
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+
+                _save_state(state_path, state)
+
+                print('\n   best valid. loss: %.8f' % state['best_eval_loss'])
+                if estop > 0:
+                    print('early stop patience: %d - max %d\n' % (state['estop_counter'], estop))
+
+                sys.stdout.flush()
+
+                if 0 < estop <= state['estop_counter']:
+                    print('\nEARLY STOP! Signalling the trainer.\n')
+                    with open(os.path.join(FLAGS.train_dir, EARLY_STOP_FILE), 'w') as f:
+                        f.write('%d\n' % global_step)
+                    break
+
+                # check for a newer checkpoint right away
+                continue
+
+            if finished:
+                print('\nTraining finished and last checkpoint evaluated.')
+                break
+
+            time.sleep(FLAGS.eval_poll_secs)
+
+        print('\n   best valid. loss: %.8f' % state['best_eval_loss'])
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+    Sequence loss computed in one pass over all the decoder time steps of a bucket: the
+    non-padded decoder outputs are packed into a single matrix, projected with one matmul
+    and scored with one softmax cross-entropy, instead of one projection and one softmax
+    per time step. stacked_sequence_loss does the same for the stacked outputs of the
+    dynamic decoder, with any row loss (e.g. sampled softmax).
+
+"""
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+
+def softmax_loss(proj_w, proj_b):
+    """Return the row loss function of the full softmax over the target vocabulary: a function
+    (inputs, labels) -> cross-entropy of each row of inputs, with the same signature as the
+    softmax_loss_function of the models.
+
+    Parameters
+    ----------
+    proj_w : Tensor
+        Output projection matrix (decoder_size, target_vocab_size).
+    proj_b : Tensor
+        Output projection bias (target_vocab_size).
+
+    """
+    def loss_function(inputs, labels):
+        logits = tf.matmul(inputs, proj_w) + proj_b
+        return tf.nn.sparse_softmax_cross_entropy_with_logits(logits, tf.to_int64(labels))
+
+    return loss_function
+
+
+def _packed_sequence_loss(packed_outputs, packed_targets, packed_weights, batch_size, row_loss_function,
+                          average_across_timesteps=True, average_across_batch=True):
+    """Weighted loss of time-major packed decoder outputs: row t * batch_size + i is the time
+    step t of sentence i. Only the rows whose weight is not zero are given to row_loss_function.
+    """
+    # only the positions that count for the loss are projected
+    keep = tf.reshape(tf.where(tf.greater(packed_weights, 0.0)), [-1])
+    kept_outputs = tf.gather(packed_outputs, keep)
+    kept_targets = tf.gather(packed_targets, keep)
+    kept_weights = tf.gather(packed_weights, keep)
+
+    crossent = row_loss_function(kept_outputs, kept_targets) * kept_weights
+
+    # sentence of each kept position
+    sentence_ids = tf.to_int32(tf.mod(keep, tf.to_int64(batch_size)))
+    cost_per_sentence = tf.unsorted_segment_sum(crossent, sentence_ids, batch_size)
+
+    if average_across_timesteps:
+        total_size = tf.reduce_sum(tf.reshape(packed_weights, tf.pack([-1, batch_size])), 0) + 1e-12
+        cost_per_sentence /= total_size
+
+    cost = tf.reduce_sum(cost_per_sentence)
+
+    if average_across_batch:
+        cost /= tf.cast(batch_size, cost.dtype)
+
+    return cost
+
+
+def fused_sequence_loss(outputs, targets, weights, proj_w, proj_b, average_across_timesteps=True,
+                        average_across_batch=True):
+    """Weighted cross-entropy of the projected decoder outputs, skipping the positions whose
+    weight is zero. Gives the same result as seq2seq.sequence_loss over the projected outputs.
+
+    Parameters
+    ----------
+    outputs : list
+        List of 2-D Tensors (batch_size, decoder_size) - the decoder outputs before the output
+        projection.
+    targets : list
+        List of 1-D int32 Tensors (batch_size) of the same length as outputs.
+    weights : list
+        List of 1-D float Tensors (batch_size) of the same length as outputs. Positions with
+        weight 0 (padding) are not projected.
+    proj_w : Tensor
+        Output projection matrix (decoder_size, target_vocab_size).
+    proj_b : Tensor
+        Output projection bias (target_vocab_size).
+    average_across_timesteps : boolean
+        If set, divide the cost of each sentence by the sum of its weights. Default to True.
+    average_across_batch : boolean
+        If set, divide the returned cost by the batch size. Default to True.
+
+    Returns
+    -------
+    cost : Tensor
+        Scalar with the (averaged) cross-entropy.
+
+    """
+    assert len(outputs) == len(targets) == len(weights)
+
+    with tf.op_scope(outputs + targets + weights, None, "fused_sequence_loss"):
+
+        batch_size = tf.shape(targets[0])[0]
+
+        # time-major packing: row t * batch_size + i is the time step t of sentence i
+        cost = _packed_sequence_loss(tf.concat(0, outputs), tf.concat(0, targets), tf.concat(0, weights),
+                                     batch_size, softmax_loss(proj_w, proj_b),
+                                     average_across_timesteps=average_across_timesteps,
+                                     average_across_batch=average_across_batch)
+
+    return cost
+
+
+def stacked_sequence_loss(outputs, targets, weights, row_loss_function, average_across_timesteps=True,
+                          average_across_batch=True):
+    """Same loss as fused_sequence_loss for the stacked outputs of decoders.dynamic_attention_decoder,
+    which may have fewer time steps than targets: the targets and weights past its steps are not used
+    (their weights must be zero).
+
+    Parameters
+    ----------
+    outputs : Tensor
+        3-D Tensor (n_steps, batch_size, decoder_size) - the decoder outputs before the output
+        projection.
+    targets : list
+        List of 1-D int32 Tensors (batch_size), at least n_steps of them.
+    weights : list
+        List of 1-D float Tensors (batch_size) of the same length as targets.
+    row_loss_function : function
+        Function (inputs, labels) -> loss of each row, e.g. softmax_loss(proj_w, proj_b) or the
+        sampled softmax loss of the model.
+    average_across_timesteps, average_across_batch : boolean
+        See fused_sequence_loss.
+
+    Returns
+    -------
+    cost : Tensor
+        Scalar with the (averaged) loss.
+
+    """
+    assert len(targets) == len(weights)
+
+    with tf.op_scope([outputs] + targets + weights, None, "stacked_sequence_loss"):
+
+        n_steps = tf.shape(outputs)[0]
+        batch_size = tf.shape(outputs)[1]
+        size = outputs.get_shape()[2].value
+
+        packed_targets = tf.slice(tf.pack(targets), [0, 0], tf.pack([n_steps, -1]))
+        packed_weights = tf.slice(tf.pack(weights), [0, 0], tf.pack([n_steps, -1]))
+
+        cost = _packed_sequence_loss(tf.reshape(outputs, [-1, size]), tf.reshape(packed_targets, [-1]),
+                                     tf.reshape(packed_weights, [-1]), batch_size, row_loss_function,
+                                     average_across_timesteps=average_across_timesteps,
+                                     average_across_batch=average_across_batch)
+
+    return cost
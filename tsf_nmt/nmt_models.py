@@ -7,8 +7,8 @@
     and support to buckets.
 
 """
-import copy
 import random
+import time
 import numpy
 import pkg_resources
 import tensorflow as tf
@@ -19,10 +19,14 @@ from tensorflow.python.framework import ops
 from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import variable_scope
 
+import attention
 import data_utils
 import cells
 import encoders
+import loss_ops
 import optimization_ops
+import profiling_ops
+import decoders
 from decoders import attention_decoder_nmt
 
 # from six.moves import xrange
@@ -78,31 +82,70 @@ def model_with_buckets(encoder_inputs, decoder_inputs, targets, weights,
     outputs = []
     with ops.op_scope(all_inputs, name, "model_with_buckets"):
         for j, bucket in enumerate(buckets):
-            with variable_scope.variable_scope(variable_scope.get_variable_scope(),
-                                               reuse=True if j > 0 else None):
-                bucket_outputs, _ = seq2seq_f(encoder_inputs[:bucket[0]],
-                                            decoder_inputs[:bucket[1]])
-                outputs.append(bucket_outputs)
-
-                if per_example_loss:
-                    losses.append(seq2seq.sequence_loss_by_example(
-                        outputs[-1], targets[:bucket[1]], weights[:bucket[1]],
-                        average_across_timesteps=True,
-                        softmax_loss_function=softmax_loss_function))
-                else:
-                    losses.append(seq2seq.sequence_loss(
-                        outputs[-1], targets[:bucket[1]], weights[:bucket[1]],
-                        average_across_timesteps=True,
-                        softmax_loss_function=softmax_loss_function))
+            bucket_outputs, bucket_loss = bucket_model(encoder_inputs, decoder_inputs, targets, weights,
+                                                       bucket, seq2seq_f,
+                                                       softmax_loss_function=softmax_loss_function,
+                                                       per_example_loss=per_example_loss, reuse=j > 0)
+            outputs.append(bucket_outputs)
+            losses.append(bucket_loss)
 
     return outputs, losses
 
 
+def bucket_model(encoder_inputs, decoder_inputs, targets, weights, bucket, seq2seq_f,
+                 softmax_loss_function=None, per_example_loss=False, reuse=False,
+                 sequence_loss_function=None):
+    """Create the sequence-to-sequence model and its loss for a single bucket.
+
+    Args:
+      encoder_inputs, decoder_inputs, targets, weights: the same lists given to
+        model_with_buckets; only the first bucket[0] (encoder) and bucket[1]
+        (decoder) elements are used.
+      bucket: a pair (input size, output size).
+      seq2seq_f, softmax_loss_function, per_example_loss: see model_with_buckets.
+      reuse: Boolean. Whether the variables of the model were already created
+        (by another bucket) and must be reused.
+      sequence_loss_function: if not None, function (outputs, targets, weights) -> loss
+        computing the loss of the whole bucket at once; it replaces the per time step
+        loss (and per_example_loss is ignored).
+
+    Returns:
+      A pair (outputs, loss) for this bucket.
+    """
+    with variable_scope.variable_scope(variable_scope.get_variable_scope(),
+                                       reuse=True if reuse else None):
+        outputs, _ = seq2seq_f(encoder_inputs[:bucket[0]],
+                               decoder_inputs[:bucket[1]])
+
+        if sequence_loss_function is not None:
+            loss = sequence_loss_function(outputs, targets[:bucket[1]], weights[:bucket[1]])
+        elif per_example_loss:
+            loss = seq2seq.sequence_loss_by_example(
+                outputs, targets[:bucket[1]], weights[:bucket[1]],
+                average_across_timesteps=True,
+                softmax_loss_function=softmax_loss_function)
+        else:
+            loss = seq2seq.sequence_loss(
+                outputs, targets[:bucket[1]], weights[:bucket[1]],
+                average_across_timesteps=True,
+                softmax_loss_function=softmax_loss_function)
+
+    return outputs, loss
+
+
+def get_source_lengths(encoder_inputs):
+    """Return the true length of each sentence of a batch-major list of encoder inputs, i.e.,
+    the number of positions that are not padding."""
+    return numpy.sum(numpy.array(encoder_inputs) != data_utils.PAD_ID, axis=0).astype(numpy.int32)
+
+
 class TranslationModel(object):
 
     def __init__(self):
         self.buckets = []
         self.encoder_inputs = []
+        self.source_lengths = None
+        self.target_candidates = None
         self.decoder_inputs = []
         self.target_weights = []
         self.dropout_feed = None
@@ -115,11 +158,34 @@ class TranslationModel(object):
         self.ret0, self.ret1, self.ret2 = [], [], []
         self.decoder_size = 100
         self.logits, self.states, self.decoder_states = [], [], []
-        self.step_num = None
+        self.top_log_probs, self.top_ids = None, None
+        self.best_log_probs, self.best_ids = None, None
+        self.shortlist, self.shortlist_lengths, self.shortlist_w, self.shortlist_b = None, None, None, None
+        self.hyp_sentences, self.hyp_positions = None, None
+        self.shortlist_top_log_probs, self.shortlist_top_ids = None, None
+        self.shortlist_best_log_probs, self.shortlist_best_ids = None, None
+        self.attn_keys = []
+        self.decoder_keys_in, self.decoder_keys = None, None
+        self.beam_size = 12
+        # checkpoint the parameters were restored from (None if fresh)
+        self.checkpoint_path = None
         self.decoder_init_plcholder = None
         self.attn_plcholder = None
         self.decoder_states_holders = None
         self.decoder_attention_f = None
+        self.profiler = None
+        self.outputs = None
+        self.gradients = None
+        self.optimizer = None
+        self.max_gradient_norm = 5.0
+        self.sparse_updates = False
+        self.loss_function = None
+        self.sequence_loss_function = None
+        self.dynamic_decoder = False
+        self.decoder_steps = None
+        self.targets = []
+        self.device = None
+        self.bucket_graph_stats = {}
 
     def inference(self, source, target):
         raise NotImplementedError
@@ -127,7 +193,124 @@ class TranslationModel(object):
     def encode(self, source, batch_size, translate=False):
         raise NotImplementedError
 
-    def get_train_batch(self, data, bucket_id, batch_size=None):
+    def _build_shortlist_outputs(self, decoder_output, n_best):
+        """Create the decoding outputs over the target words of a shortlist (see shortlist_ops).
+
+        Each sentence of the batch has its own shortlist, padded to the longest one, and its
+        hypotheses are only scored against the rows of the output projection of its shortlist:
+        the hypotheses of each sentence are grouped in a [n_sentences, n_slots, decoder_size]
+        tensor and multiplied with the [n_sentences, k, decoder_size] projection of the sentences
+        in a single batch_matmul. The padding columns get a -inf bias, so the translation of a
+        sentence does not depend on the other sentences of its batch.
+
+        shortlist_w and shortlist_b are computed on the first step and fed back on the others.
+        """
+        # padded shortlists of the sentences and their true lengths
+        self.shortlist = tf.placeholder(tf.int32, shape=[None, None], name="target_shortlist")
+        self.shortlist_lengths = tf.placeholder(tf.int32, shape=[None], name="target_shortlist_lengths")
+        # sentence of each hypothesis and its position among the hypotheses of that sentence
+        self.hyp_sentences = tf.placeholder(tf.int32, shape=[None], name="hyp_sentences")
+        self.hyp_positions = tf.placeholder(tf.int32, shape=[None], name="hyp_positions")
+
+        n_sentences = tf.shape(self.shortlist)[0]
+        k = tf.shape(self.shortlist)[1]
+
+        self.shortlist_w = tf.gather(tf.transpose(self.output_projection[0]), self.shortlist)
+        bias = tf.gather(self.output_projection[1], self.shortlist)
+        in_shortlist = tf.cast(attention.sequence_mask(self.shortlist_lengths, k), tf.bool)
+        self.shortlist_b = tf.select(in_shortlist, bias, tf.fill(tf.shape(bias), float('-inf')))
+
+        n_slots = tf.reduce_max(self.hyp_positions) + 1
+        slots = self.hyp_sentences * n_slots + self.hyp_positions
+        grouped = tf.unsorted_segment_sum(decoder_output, slots, n_sentences * n_slots)
+        grouped = tf.reshape(grouped, tf.pack([n_sentences, n_slots, tf.shape(decoder_output)[1]]))
+
+        logits = tf.batch_matmul(grouped, self.shortlist_w, adj_y=True) + tf.expand_dims(self.shortlist_b, 1)
+        shortlist_logits = nn_ops.log_softmax(tf.gather(tf.reshape(logits, tf.pack([-1, k])), slots))
+
+        # local indices are mapped back to target vocabulary ids, through the shortlist of each hypothesis
+        flat_shortlist = tf.reshape(self.shortlist, [-1])
+        offsets = self.hyp_sentences * k
+
+        self.shortlist_top_log_probs, shortlist_top_ids = tf.nn.top_k(shortlist_logits, n_best)
+        self.shortlist_top_ids = tf.gather(flat_shortlist, tf.expand_dims(offsets, 1) + shortlist_top_ids)
+        self.shortlist_best_log_probs = tf.reduce_max(shortlist_logits, 1)
+        self.shortlist_best_ids = tf.gather(flat_shortlist, offsets + tf.to_int32(tf.argmax(shortlist_logits, 1)))
+
+    def _build_bucket(self, bucket_id):
+        """Create the forward graph, loss and (when training) the gradients and update op of
+        one bucket, sharing the variables already created by the other buckets. With the
+        dynamic decoder, the graph of the largest bucket is built once and shared by all of them.
+
+        The time it takes and the number of graph nodes it adds are kept in
+        self.bucket_graph_stats and printed.
+        """
+        bucket = self.buckets[bucket_id]
+        last_bucket = len(self.buckets) - 1
+
+        if self.dynamic_decoder and bucket_id != last_bucket:
+            # the graph of the largest bucket runs as many decoder steps as the longest target
+            # of the batch, so every bucket uses it (fed with padding, see train_step)
+            if last_bucket not in self.bucket_graph_stats:
+                self._build_bucket(last_bucket)
+            for bucket_ops in (self.outputs, self.losses, self.gradients, self.gradient_norms, self.updates):
+                if bucket_ops is not None:
+                    bucket_ops[bucket_id] = bucket_ops[last_bucket]
+            self.bucket_graph_stats[bucket_id] = {'seconds': 0.0, 'nodes': 0}
+            print('Bucket %d %s shares the graph of bucket %d' % (bucket_id, str(bucket), last_bucket))
+            return
+
+        graph = tf.get_default_graph()
+        n_nodes = len(graph.get_operations())
+        start_time = time.time()
+
+        reuse = len(self.bucket_graph_stats) > 0
+
+        with tf.device(self.device):
+
+            if self.losses[bucket_id] is None:
+                with ops.op_scope([], None, "model_with_buckets"):
+                    self.outputs[bucket_id], self.losses[bucket_id] = bucket_model(
+                        self.encoder_inputs, self.decoder_inputs, self.targets, self.target_weights,
+                        bucket, self.inference, softmax_loss_function=self.loss_function, reuse=reuse,
+                        sequence_loss_function=self.sequence_loss_function)
+
+            if self.optimizer is not None:
+                # every trainable variable exists once the forward graph of a bucket is built
+                params = tf.trainable_variables()
+                grads = tf.gradients(self.losses[bucket_id], params)
+                if self.sparse_updates:
+                    # sum the repeated rows of the embedding gradients (one slice per time step)
+                    # before clipping, so the norm is the one of the actual update
+                    grads = optimization_ops.deduplicate_gradients(grads)
+                self.gradients[bucket_id] = grads
+                clipped_gradients, norm = tf.clip_by_global_norm(grads, self.max_gradient_norm)
+                self.gradient_norms[bucket_id] = norm
+                self.updates[bucket_id] = self.optimizer.apply_gradients(
+                    zip(clipped_gradients, params), global_step=self.global_step)
+
+        build_time = time.time() - start_time
+        n_nodes = len(graph.get_operations()) - n_nodes
+        self.bucket_graph_stats[bucket_id] = {'seconds': build_time, 'nodes': n_nodes}
+
+        print('Bucket %d %s built in %.2f sec - %d graph nodes' % (bucket_id, str(bucket), build_time, n_nodes))
+
+    def _run(self, session, fetches, feed_dict, trace=None):
+        """Run session.run, through the given StepTrace if this step is being profiled."""
+        if trace is None:
+            return session.run(fetches, feed_dict)
+        return trace.run(session, fetches, feed_dict)
+
+    def _start_trace(self, kind, bucket_id=None):
+        if self.profiler is None:
+            return None
+        return self.profiler.start(kind, bucket_id)
+
+    def _finish_trace(self, session, trace):
+        if trace is not None:
+            self.profiler.finish(trace, session.graph)
+
+    def get_train_batch(self, data, bucket_id, batch_size=None, partition=None):
         """Get a random batch of data from the specified bucket, prepare for step.
         To feed data in step(..) it must be a list of batch-major vectors, while
         data here contains single length-major cases. So the main logic of this
@@ -136,27 +319,37 @@ class TranslationModel(object):
           data: a tuple of size len(self.buckets) in which each element contains
             lists of pairs of input and output data that we use to create a batch.
           bucket_id: integer, which bucket to get the batch for.
+          partition: if not None, data is grouped by partition (see data_utils.group_by_partition)
+            and the whole batch is taken from this partition of the bucket.
         Returns:
-          The triple (encoder_inputs, decoder_inputs, target_weights) for
-          the constructed batch that has the proper format to call step(...) later.
+          The tuple (encoder_inputs, decoder_inputs, target_weights, n_target_words,
+          source_lengths) for the constructed batch that has the proper format to call
+          step(...) later.
         """
         encoder_size, decoder_size = self.buckets[bucket_id]
-        encoder_inputs, decoder_inputs = [], []
+        encoder_inputs, decoder_inputs, source_lengths = [], [], []
 
         n_target_words = 0
         #
         if batch_size is None:
             batch_size = self.batch_size
 
+        if partition is None:
+            pairs = data[bucket_id]
+        else:
+            pairs = data[bucket_id][partition]
+
         # Get a random batch of encoder and decoder inputs from data,
         # pad them if needed, reverse encoder inputs and add GO to decoder.
         for _ in xrange(batch_size):
             # encoder_input, _, decoder_input = random.choice(d)
-            encoder_input, decoder_input = random.choice(data[bucket_id])
+            pair = random.choice(pairs)
+            encoder_input, decoder_input = pair[0], pair[1]
 
-            # Encoder inputs are padded and then reversed.
+            # Encoder inputs are reversed and then padded, so the encoder can stop at their length.
             encoder_pad = [data_utils.PAD_ID] * (encoder_size - len(encoder_input))
-            encoder_inputs.append(list(reversed(encoder_input + encoder_pad)))
+            encoder_inputs.append(list(reversed(encoder_input)) + encoder_pad)
+            source_lengths.append(len(encoder_input))
 
             n_target_words += len(decoder_input)
 
@@ -193,9 +386,11 @@ class TranslationModel(object):
                     batch_weight[batch_idx] = 0.0
             batch_weights.append(batch_weight)
 
-        return batch_encoder_inputs, batch_decoder_inputs, batch_weights, n_target_words
+        return batch_encoder_inputs, batch_decoder_inputs, batch_weights, n_target_words, \
+            numpy.array(source_lengths, dtype=numpy.int32)
 
-    def train_step(self, session, encoder_inputs, decoder_inputs, target_weights, bucket_id, validation_step=False):
+    def train_step(self, session, encoder_inputs, decoder_inputs, target_weights, bucket_id, validation_step=False,
+                   source_lengths=None, target_candidates=None):
         """Run a step of the model feeding the given inputs.
         Args:
           session: tensorflow session to use.
@@ -204,6 +399,11 @@ class TranslationModel(object):
           target_weights: list of numpy float vectors to feed as target weights.
           bucket_id: which bucket of the model to use.
           validation_step: whether to do the backward step or only forward.
+          source_lengths: numpy int vector with the true length of each source sentence; if
+            None, it is computed from the padding in encoder_inputs.
+          target_candidates: numpy int vector with the target candidate set of the batch,
+            when the model was built with target_candidates; if None, the whole target
+            vocabulary is used.
           softmax: whether to apply softmax to the output_logits before returning them
         Returns:
           A triple consisting of gradient norm (or None if we did not do backward),
@@ -224,10 +424,21 @@ class TranslationModel(object):
             raise ValueError("Weights length must be equal to the one in bucket,"
                              " %d != %d." % (len(target_weights), decoder_size))
 
+        # with lazy_buckets, the subgraph of a bucket is only built the first time it is used
+        if self.losses[bucket_id] is None:
+            self._build_bucket(bucket_id)
+
         # Input feed: encoder inputs, decoder inputs, target_weights, as provided.
         input_feed = {}
         for l in xrange(encoder_size):
             input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
+        if source_lengths is None:
+            source_lengths = get_source_lengths(encoder_inputs)
+        input_feed[self.source_lengths.name] = source_lengths
+        if self.target_candidates is not None:
+            if target_candidates is None:
+                target_candidates = self._all_candidates
+            input_feed[self.target_candidates.name] = target_candidates
         for l in xrange(decoder_size):
             input_feed[self.decoder_inputs[l].name] = decoder_inputs[l]
             input_feed[self.target_weights[l].name] = target_weights[l]
@@ -236,6 +447,18 @@ class TranslationModel(object):
         last_target = self.decoder_inputs[decoder_size].name
         input_feed[last_target] = numpy.zeros([len(encoder_inputs[0])], dtype=numpy.int32)
 
+        if self.dynamic_decoder:
+            # the graph of the largest bucket is shared by all of them: the positions past this bucket
+            # are padding, which the encoder skips (source_lengths) and the decoder does not reach
+            pad = numpy.zeros([len(encoder_inputs[0])], dtype=numpy.int32) + data_utils.PAD_ID
+            no_weight = numpy.zeros([len(encoder_inputs[0])], dtype=numpy.float32)
+            max_encoder_size, max_decoder_size = self.buckets[-1]
+            for l in xrange(encoder_size, max_encoder_size):
+                input_feed[self.encoder_inputs[l].name] = pad
+            for l in xrange(decoder_size, max_decoder_size):
+                input_feed[self.decoder_inputs[l + 1].name] = pad
+                input_feed[self.target_weights[l].name] = no_weight
+
         # Output feed: depends on whether we do a backward step or not.
         if validation_step:
             input_feed[self.dropout_feed.name] = 0.0
@@ -247,7 +470,12 @@ class TranslationModel(object):
                            self.gradient_norms[bucket_id],  # Gradient norm.
                            self.losses[bucket_id]]  # Loss for this batch.
 
-        outputs = session.run(output_feed, feed_dict=input_feed)
+        trace = self._start_trace(profiling_ops.VALIDATION if validation_step else profiling_ops.TRAIN,
+                                  bucket_id)
+
+        outputs = self._run(session, output_feed, input_feed, trace)
+
+        self._finish_trace(session, trace)
 
         # function return: depends on whether we do a backward step or not.
         if validation_step:
@@ -258,7 +486,7 @@ class TranslationModel(object):
             # Gradient norm, loss, no outputs.
             return outputs[1], outputs[2], None
 
-    def get_translate_batch(self, data):
+    def get_translate_batch(self, data, in_order=False):
         """Get a random batch of data from the specified bucket, prepare for step.
         To feed data in step(..) it must be a list of batch-major vectors, while
         data here contains single length-major cases. So the main logic of this
@@ -266,23 +494,29 @@ class TranslationModel(object):
         Args:
           data: a tuple of size len(self.buckets) in which each element contains
             lists of pairs of input and output data that we use to create a batch.
-          bucket_id: integer, which bucket to get the batch for.
+          in_order: if True, the batch is made of all the pairs of data, in order,
+            instead of batch_size random pairs.
         Returns:
-          The triple (encoder_inputs, decoder_inputs, target_weights) for
+          The triple (encoder_inputs, decoder_inputs, source_lengths) for
           the constructed batch that has the proper format to call step(...) later.
         """
         encoder_size, decoder_size = (self.max_len, 1)
-        encoder_inputs, decoder_inputs = [], []
+        encoder_inputs, decoder_inputs, source_lengths = [], [], []
+
+        if in_order:
+            batch = data
+        else:
+            batch = [random.choice(data) for _ in xrange(self.batch_size)]
+        batch_size = len(batch)
 
         # Get a random batch of encoder and decoder inputs from data,
         # pad them if needed, reverse encoder inputs and add GO to decoder.
-        for _ in xrange(self.batch_size):
-            # encoder_input, _, decoder_input = random.choice(d)
-            encoder_input, decoder_input = random.choice(data)
+        for encoder_input, decoder_input in batch:
 
-            # Encoder inputs are padded and then reversed.
+            # Encoder inputs are reversed and then padded, so the encoder can stop at their length.
             encoder_pad = [data_utils.PAD_ID] * (encoder_size - len(encoder_input))
-            encoder_inputs.append(list(reversed(encoder_input + encoder_pad)))
+            encoder_inputs.append(list(reversed(encoder_input)) + encoder_pad)
+            source_lengths.append(len(encoder_input))
 
             # Decoder inputs get an extra "GO" symbol, and are padded then.
             decoder_pad_size = decoder_size - len(decoder_input) - 1
@@ -296,146 +530,401 @@ class TranslationModel(object):
         for length_idx in xrange(encoder_size):
             batch_encoder_inputs.append(
                 numpy.array([encoder_inputs[batch_idx][length_idx]
-                             for batch_idx in xrange(self.batch_size)], dtype=numpy.int32))
+                             for batch_idx in xrange(batch_size)], dtype=numpy.int32))
 
         # Batch decoder inputs are re-indexed decoder_inputs, we create weights.
         for length_idx in xrange(decoder_size):
             batch_decoder_inputs.append(
                 numpy.array([decoder_inputs[batch_idx][length_idx]
-                             for batch_idx in xrange(self.batch_size)], dtype=numpy.int32))
-
-        return batch_encoder_inputs, batch_decoder_inputs
-
-    def translation_step(self, session, token_ids, beam_size=5, normalize=True, dump_remaining=True):
-
-        sample = []
-        sample_score = []
+                             for batch_idx in xrange(batch_size)], dtype=numpy.int32))
 
-        live_hyp = 1
-        dead_hyp = 0
+        return batch_encoder_inputs, batch_decoder_inputs, numpy.array(source_lengths, dtype=numpy.int32)
 
-        hyp_samples = [[]] * live_hyp
-        hyp_scores = numpy.zeros(live_hyp).astype('float32')
+    def _encode_batch(self, session, batch_token_ids, trace=None):
+        """Encode a batch of sentences, in order, and return what the first decoding step needs:
+        (decoder_inputs, decoder_initial_states, attention_states, source_lengths)."""
 
-        # Get a 1-element batch to feed the sentence to the model
-        encoder_inputs, decoder_inputs = self.get_translate_batch([(token_ids, [])])
-        decoder_inputs = decoder_inputs[-1]
+        # one batch with all the sentences, in order
+        encoder_inputs, decoder_inputs, source_lengths = self.get_translate_batch(
+            [(token_ids, []) for token_ids in batch_token_ids], in_order=True)
 
-        # here we encode the input sentence
+        # here we encode the input sentences
         encoder_input_feed = {}
         for l in xrange(self.max_len):
             encoder_input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
+        encoder_input_feed[self.source_lengths.name] = source_lengths
 
         # we select the last element of ret0 to keep as it is a list of hidden_states
         encoder_output_feed = [self.ret0[-1], self.ret1, self.ret2]
 
         # get the return of encoding step: hidden_states, decoder_initial_states, attention_states
-        ret = session.run(encoder_output_feed, encoder_input_feed)
+        ret = self._run(session, encoder_output_feed, encoder_input_feed, trace)
+
+        return decoder_inputs[-1], ret[1], ret[2], source_lengths
+
+    def translation_step(self, session, token_ids, beam_size=5, normalize=True, dump_remaining=True,
+                         shortlist=None, early_stop=False, length_ratio=0.0):
+        """Beam search translation of a single sentence - the one sentence case of
+        translation_batch_step. Returns the pair (samples, scores), sorted from best to worst."""
+        return self.translation_batch_step(session, [token_ids], beam_size=beam_size, normalize=normalize,
+                                           dump_remaining=dump_remaining, shortlist=shortlist,
+                                           early_stop=early_stop, length_ratio=length_ratio)[0]
+
+    def _feed_shortlist(self, input_feed, shortlist, hyp_sentences):
+        """Feed the padded shortlists of the batch and, for each hypothesis, its sentence and its
+        position among the hypotheses of that sentence (the ones of a sentence are consecutive)."""
+        shortlist_ids, shortlist_lengths = shortlist
+        hyp_sentences = numpy.asarray(hyp_sentences, dtype=numpy.int32)
+
+        input_feed[self.shortlist.name] = shortlist_ids
+        input_feed[self.shortlist_lengths.name] = shortlist_lengths
+        input_feed[self.hyp_sentences.name] = hyp_sentences
+        input_feed[self.hyp_positions.name] = (numpy.arange(len(hyp_sentences)) -
+                                               numpy.searchsorted(hyp_sentences, hyp_sentences)).astype(numpy.int32)
+
+    def _check_shortlist(self, shortlist, n_best):
+        if shortlist is not None and numpy.min(shortlist[1]) < n_best:
+            raise ValueError('Each shortlist must have at least %d words, got %d.' %
+                             (n_best, numpy.min(shortlist[1])))
+
+    def _first_step_fetches(self, shortlist):
+        """Tensors computed on the first decoding step and fed back on the others: the projected
+        attention states and, when decoding over a shortlist, its rows of the output projection."""
+        if shortlist is None:
+            return list(self.attn_keys)
+        return self.attn_keys + [self.shortlist_w, self.shortlist_b]
+
+    def translation_batch_step(self, session, batch_token_ids, beam_size=5, normalize=True, dump_remaining=True,
+                               shortlist=None, early_stop=False, length_ratio=0.0):
+        """Beam search translation of several sentences at once.
+
+        The live hypotheses of all the sentences are packed in a single batch, so each decoder
+        step is one run for the whole batch instead of one run per sentence. Every sentence keeps
+        its own beam (at most beam_size hypotheses) and its own list of finished hypotheses, and
+        leaves the batch when none of its hypotheses is alive.
 
-        # here we get info to the decode step
-        attention_states = ret[2]
-        shape = ret[1][0].shape
-        # decoder_init = numpy.tile(ret[1][0].reshape(1, shape[0]), (12, 1))
-        decoder_init = ret[1][0].reshape(1, shape[0])
-        decoder_states = numpy.zeros((1, 1, 1, self.decoder_size))
+        Parameters
+        ----------
+        session : tf.Session
+        batch_token_ids : list
+            List of source sentences, each a list of token ids.
+        beam_size : int
+            Size of the beam of each sentence. Default to 5.
+        normalize : boolean
+            If set, the score of each hypothesis is divided by its length. Default to True.
+        dump_remaining : boolean
+            If set, the hypotheses still alive after max_len steps are added to the results.
+            Default to True.
+        shortlist : tuple
+            Padded shortlists and their lengths (see shortlist_ops.pad_shortlists), one per
+            sentence: the output projection of each sentence is restricted to the target ids of
+            its own shortlist. If None, the whole target vocabulary is used. Default to None.
+        early_stop : boolean
+            If set, a sentence stops as soon as none of its live hypotheses can beat its best
+            finished one. The cost of a hypothesis never decreases when it grows, so with
+            normalize its final score is at least cost / (longest length it can reach), and
+            without it at least its current cost. The best translation is then the same as
+            without early_stop, but the other samples are not, and the live hypotheses of the
+            stopped sentences are not dumped. Default to False.
+        length_ratio : float
+            If > 0, the longest length a hypothesis can reach is taken as length_ratio times
+            the source length (plus EOS) instead of max_len: a tighter but not exact bound, the
+            best translation may differ from the exhaustive search. Default to 0.0.
+
+        Returns
+        -------
+        list
+            One pair (samples, scores) per sentence, in the order of batch_token_ids, with the
+            samples sorted by score (negative log-probability, lower is better).
+
+        """
+        if beam_size > self.beam_size:
+            raise ValueError('The decoding graph returns the best %d words of each hypothesis, '
+                             'it cannot run a beam of size %d.' % (self.beam_size, beam_size))
+
+        self._check_shortlist(shortlist, min(self.beam_size, self.target_vocab_size))
+
+        n_sentences = len(batch_token_ids)
+
+        samples = [[] for _ in xrange(n_sentences)]
+        sample_scores = [[] for _ in xrange(n_sentences)]
+        dead_hyp = [0] * n_sentences
+
+        trace = self._start_trace(profiling_ops.DECODE)
+
+        decoder_inputs, decoder_init, attention_states, source_lengths = self._encode_batch(session, batch_token_ids,
+                                                                                            trace)
+
+        # the live hypotheses of all the sentences, one row each - we start with one per sentence
+        hyp_sentences = numpy.arange(n_sentences)
+        hyp_samples = [[] for _ in xrange(n_sentences)]
+        hyp_scores = numpy.zeros(n_sentences).astype('float32')
+
+        # for early stopping: the best (normalized) score of a finished hypothesis of each sentence and
+        # the longest length its hypotheses can reach
+        best_finished = numpy.inf * numpy.ones(n_sentences)
+        if length_ratio > 0:
+            final_lengths = numpy.minimum(numpy.ceil(length_ratio * source_lengths) + 1, self.max_len)
+        else:
+            final_lengths = self.max_len * numpy.ones(n_sentences)
+
+        decoder_states = numpy.zeros((n_sentences, 1, 1, self.decoder_size))
 
         # we must retrieve the last state to feed the decoder run
-        decoder_output_feed = [self.logits, self.states, self.decoder_states]
+        if shortlist is None:
+            decoder_output_feed = [self.top_log_probs, self.top_ids, self.states, self.decoder_states]
+        else:
+            decoder_output_feed = [self.shortlist_top_log_probs, self.shortlist_top_ids, self.states,
+                                   self.decoder_states]
+        first_step_fetches = self._first_step_fetches(shortlist)
+        if self.decoder_keys is not None:
+            decoder_output_feed.append(self.decoder_keys)
 
         for ii in xrange(self.max_len):
 
-            session.run(self.step_num.assign(ii + 2))
+            if n_sentences == 1:
+                # a single sentence: its attention states are broadcast over the hypotheses
+                hyp_attention_states = attention_states
+            else:
+                hyp_attention_states = attention_states[hyp_sentences]
 
             # we must feed decoder_initial_state and attention_states to run one decode step
             decoder_input_feed = {self.decoder_inputs[0].name: decoder_inputs,
                                   self.decoder_init_plcholder.name: decoder_init,
-                                  self.attn_plcholder.name: attention_states}
-            # print ii
+                                  self.attn_plcholder.name: hyp_attention_states,
+                                  # one length per live hypothesis, to mask the attention over padding
+                                  self.source_lengths.name: source_lengths[hyp_sentences]}
+
+            if shortlist is not None:
+                self._feed_shortlist(decoder_input_feed, shortlist, hyp_sentences)
+
             if self.decoder_attention_f:
-                # if ii == 1:
-                #     decoder_states = numpy.tile(decoder_states, (12, 1, 1, 1))
                 decoder_input_feed[self.decoder_states_holders.name] = decoder_states
 
-                # print "Step %d - States shape %s - Input shape %s" % (ii, decoder_states.shape, decoder_inputs.shape)
-
-            ret = session.run(decoder_output_feed, decoder_input_feed)
-
-            next_p = ret[0]
-            next_state = ret[1]
-            decoder_states = ret[2]
-
-            cand_scores = hyp_scores[:, None] - numpy.log(next_p)
-            cand_flat = cand_scores.flatten()
-            ranks_flat = cand_flat.argsort()[:(beam_size - dead_hyp)]
-
-            voc_size = next_p.shape[1]
-            trans_indices = ranks_flat / voc_size
-            word_indices = ranks_flat % voc_size
-            costs = cand_flat[ranks_flat]
-
-            new_hyp_samples = []
-            new_hyp_scores = numpy.zeros(beam_size - dead_hyp).astype('float32')
-            new_hyp_states = []
-            new_dec_states = []
-
-            for idx, [ti, wi] in enumerate(zip(trans_indices, word_indices)):
-                new_hyp_samples.append(hyp_samples[ti] + [wi])
-                new_hyp_scores[idx] = copy.copy(costs[ti])
-                new_hyp_states.append(copy.copy(next_state[ti]))
-                new_dec_states.append(copy.copy(decoder_states[ti]))
-
-            # check the finished samples
-            new_live_k = 0
-            hyp_samples = []
-            hyp_scores = []
-            hyp_states = []
-            dec_states = []
-
-            for idx in xrange(len(new_hyp_samples)):
-                if new_hyp_samples[idx][-1] == data_utils.EOS_ID:
-                    sample.append(new_hyp_samples[idx])
-                    sample_score.append(new_hyp_scores[idx])
-                    dead_hyp += 1
-                else:
-                    new_live_k += 1
-                    hyp_samples.append(new_hyp_samples[idx])
-                    hyp_scores.append(new_hyp_scores[idx])
-                    hyp_states.append(new_hyp_states[idx])
-                    dec_states.append(new_dec_states[idx])
+            if self.decoder_keys is not None and ii > 0:
+                # keys of the past decoder states, so they are not projected again
+                decoder_input_feed[self.decoder_keys_in.name] = decoder_keys
 
-            dec_states = [d.reshape(1, d.shape[0], d.shape[1], d.shape[2]) for d in dec_states]
-            dec_states = numpy.concatenate(dec_states, axis=0)
+            if ii == 0:
+                # the first step also returns the projected attention states of each sentence
+                # (and the shortlist rows of the output projection of each sentence)
+                ret = self._run(session, decoder_output_feed + first_step_fetches, decoder_input_feed, trace)
+                sentence_keys = ret[len(decoder_output_feed):len(decoder_output_feed) + len(self.attn_keys)]
+                shortlist_proj = ret[len(decoder_output_feed) + len(self.attn_keys):]
 
-            hyp_scores = numpy.array(hyp_scores)
-            live_hyp = new_live_k
-
-            if new_live_k < 1:
-                break
-            if dead_hyp >= beam_size:
+            else:
+                # feed them back so the encoder states are not projected again at every step
+                for key, value in zip(self.attn_keys, sentence_keys):
+                    decoder_input_feed[key.name] = value if n_sentences == 1 else value[hyp_sentences]
+                for proj, value in zip(first_step_fetches[len(self.attn_keys):], shortlist_proj):
+                    decoder_input_feed[proj.name] = value
+
+                ret = self._run(session, decoder_output_feed, decoder_input_feed, trace)
+
+            # the best words of each hypothesis and their log-probabilities
+            top_log_probs = ret[0]
+            top_ids = ret[1]
+            next_state = ret[2]
+            next_decoder_states = ret[3]
+            if self.decoder_keys is not None:
+                next_decoder_keys = ret[4]
+
+            cand_scores = hyp_scores[:, None] - top_log_probs
+            n_cands = top_ids.shape[1]
+
+            new_rows = []
+            new_sentences = []
+            new_samples = []
+            new_scores = []
+
+            # each sentence expands its own hypotheses, keeping the room left in its beam
+            for b in xrange(n_sentences):
+
+                rows = numpy.flatnonzero(hyp_sentences == b)
+                if len(rows) == 0:
+                    continue
+
+                # the best (beam_size - dead_hyp) expansions are among the best beam_size words of each
+                # hypothesis, so merging the candidates returned by the graph is enough
+                cand_flat = cand_scores[rows].flatten()
+                ranks_flat = cand_flat.argsort()[:(beam_size - dead_hyp[b])]
+
+                trans_indices = rows[ranks_flat // n_cands]
+                word_indices = top_ids[rows].flatten()[ranks_flat]
+                costs = cand_flat[ranks_flat]
+
+                # check the finished samples
+                for ti, wi, cost in zip(trans_indices, word_indices, costs):
+                    if wi == data_utils.EOS_ID:
+                        samples[b].append(hyp_samples[ti] + [wi])
+                        sample_scores[b].append(cost)
+                        dead_hyp[b] += 1
+                        score = cost / len(samples[b][-1]) if normalize else cost
+                        best_finished[b] = min(best_finished[b], score)
+                    else:
+                        new_rows.append(ti)
+                        new_sentences.append(b)
+                        new_samples.append(hyp_samples[ti] + [wi])
+                        new_scores.append(cost)
+
+            if early_stop and len(new_rows) > 0:
+                bounds = numpy.array(new_scores)
+                if normalize:
+                    bounds /= final_lengths[new_sentences]
+
+                # only the sentences whose live hypotheses may still beat their best finished one go on
+                open_sentences = set(b for b, bound in zip(new_sentences, bounds) if bound <= best_finished[b])
+                keep = [k for k, b in enumerate(new_sentences) if b in open_sentences]
+
+                new_rows = [new_rows[k] for k in keep]
+                new_sentences = [new_sentences[k] for k in keep]
+                new_samples = [new_samples[k] for k in keep]
+                new_scores = [new_scores[k] for k in keep]
+
+            hyp_sentences = numpy.array(new_sentences, dtype=numpy.int32)
+            hyp_samples = new_samples
+            hyp_scores = numpy.array(new_scores, dtype='float32')
+
+            # every beam is finished
+            if len(new_rows) == 0:
                 break
 
-            decoder_inputs = numpy.array([w[-1] for w in hyp_samples])
-            decoder_init = numpy.array(hyp_states)
-            decoder_states = dec_states
+            decoder_inputs = numpy.array([w[-1] for w in hyp_samples], dtype=numpy.int32)
+            decoder_init = next_state[new_rows]
+            decoder_states = next_decoder_states[new_rows]
+            if self.decoder_keys is not None:
+                # the keys follow their hypotheses, like the states
+                decoder_keys = next_decoder_keys[new_rows]
+
+        self._finish_trace(session, trace)
 
         # dump every remaining one
         if dump_remaining:
-            if live_hyp > 0:
-                for idx in xrange(live_hyp):
-                    sample.append(hyp_samples[idx])
-                    sample_score.append(hyp_scores[idx])
+            for b, hyp, score in zip(hyp_sentences, hyp_samples, hyp_scores):
+                samples[b].append(hyp)
+                sample_scores[b].append(score)
+
+        results = []
+        for sample, sample_score in zip(samples, sample_scores):
+
+            sample_score = numpy.array(sample_score, dtype='float32')
+
+            # normalize scores according to sequence lengths
+            if normalize and len(sample) > 0:
+                sample_score /= numpy.array([len(s) for s in sample])
+
+            # sort the samples by score (it is in log-scale, therefore lower is better)
+            sidx = numpy.argsort(sample_score)
+            results.append(([sample[i] for i in sidx], sample_score[sidx].tolist()))
+
+        return results
+
+    def greedy_translation_step(self, session, batch_token_ids, normalize=True, shortlist=None):
+        """Greedy translation of several sentences at once: each step takes the best word of every
+        sentence (argmax in the graph) and the sentences that emitted EOS leave the batch. Stops when
+        all of them are finished or after max_len steps.
+
+        Parameters
+        ----------
+        session : tf.Session
+        batch_token_ids : list
+            List of source sentences, each a list of token ids.
+        normalize : boolean
+            If set, the score of each translation is divided by its length. Default to True.
+        shortlist : tuple
+            Padded shortlists of the sentences, as in translation_batch_step. Default to None.
+
+        Returns
+        -------
+        list
+            One pair ([sample], [score]) per sentence, in the order of batch_token_ids - the same format
+            as translation_batch_step, with a single hypothesis.
+
+        """
+        self._check_shortlist(shortlist, 1)
+
+        n_sentences = len(batch_token_ids)
+
+        samples = [[] for _ in xrange(n_sentences)]
+        scores = numpy.zeros(n_sentences, dtype='float32')
+
+        trace = self._start_trace(profiling_ops.DECODE)
+
+        decoder_inputs, decoder_init, attention_states, source_lengths = self._encode_batch(session, batch_token_ids,
+                                                                                            trace)
 
-        # normalize scores according to sequence lengths
-        if normalize:
-            lengths = numpy.array([len(s) for s in sample])
-            sample_score = sample_score / lengths
+        # sentences still being translated, one row each
+        active = numpy.arange(n_sentences)
 
-        # sort the samples by score (it is in log-scale, therefore lower is better)
-        sidx = numpy.argsort(sample_score)
-        sample = numpy.array(sample)[sidx]
-        sample_score = numpy.array(sample_score)[sidx]
+        decoder_states = numpy.zeros((n_sentences, 1, 1, self.decoder_size))
 
-        return sample.tolist(), sample_score.tolist()
+        if shortlist is None:
+            decoder_output_feed = [self.best_log_probs, self.best_ids, self.states, self.decoder_states]
+        else:
+            decoder_output_feed = [self.shortlist_best_log_probs, self.shortlist_best_ids, self.states,
+                                   self.decoder_states]
+        first_step_fetches = self._first_step_fetches(shortlist)
+        if self.decoder_keys is not None:
+            decoder_output_feed.append(self.decoder_keys)
+
+        for ii in xrange(self.max_len):
+
+            decoder_input_feed = {self.decoder_inputs[0].name: decoder_inputs,
+                                  self.decoder_init_plcholder.name: decoder_init,
+                                  self.attn_plcholder.name: attention_states[active],
+                                  self.source_lengths.name: source_lengths[active]}
+
+            if shortlist is not None:
+                self._feed_shortlist(decoder_input_feed, shortlist, active)
+
+            if self.decoder_attention_f:
+                decoder_input_feed[self.decoder_states_holders.name] = decoder_states
+
+            if self.decoder_keys is not None and ii > 0:
+                decoder_input_feed[self.decoder_keys_in.name] = decoder_keys
+
+            if ii == 0:
+                ret = self._run(session, decoder_output_feed + first_step_fetches, decoder_input_feed, trace)
+                sentence_keys = ret[len(decoder_output_feed):len(decoder_output_feed) + len(self.attn_keys)]
+                shortlist_proj = ret[len(decoder_output_feed) + len(self.attn_keys):]
+
+            else:
+                for key, value in zip(self.attn_keys, sentence_keys):
+                    decoder_input_feed[key.name] = value[active]
+                for proj, value in zip(first_step_fetches[len(self.attn_keys):], shortlist_proj):
+                    decoder_input_feed[proj.name] = value
+
+                ret = self._run(session, decoder_output_feed, decoder_input_feed, trace)
+
+            best_log_probs = ret[0]
+            best_ids = ret[1]
+
+            for row, b in enumerate(active):
+                samples[b].append(int(best_ids[row]))
+                scores[b] -= best_log_probs[row]
+
+            # the sentences that emitted EOS are done
+            alive = numpy.flatnonzero(best_ids != data_utils.EOS_ID)
+            active = active[alive]
+
+            if len(active) == 0:
+                break
+
+            decoder_inputs = best_ids[alive].astype(numpy.int32)
+            decoder_init = ret[2][alive]
+            decoder_states = ret[3][alive]
+            if self.decoder_keys is not None:
+                decoder_keys = ret[4][alive]
+
+        self._finish_trace(session, trace)
+
+        results = []
+        for sample, score in zip(samples, scores):
+            if normalize and len(sample) > 0:
+                score /= len(sample)
+            results.append(([sample], [float(score)]))
+
+        return results
 
 
 class Seq2SeqModel(TranslationModel):
@@ -477,8 +966,15 @@ class Seq2SeqModel(TranslationModel):
                  content_function=None,
                  decoder_attention_f="None",
                  num_samples=512,
+                 target_candidates=0,
+                 fused_loss=False,
+                 dynamic_decoder=False,
+                 sparse_updates=False,
                  forward_only=False,
+                 eval_only=False,
+                 lazy_buckets=False,
                  max_len=100,
+                 beam_size=12,
                  cpu_only=False,
                  early_stop_patience=0,
                  save_best_model=True,
@@ -487,6 +983,16 @@ class Seq2SeqModel(TranslationModel):
         """Create the model.
         Args:
 
+          forward_only: build only the one-step decoding graph used for translation.
+          eval_only: build the bucket losses but not the gradients and update ops, for
+            models that only compute the validation loss.
+          lazy_buckets: build only the smallest bucket at construction time and the others
+            the first time train_step uses them.
+          dynamic_decoder: the decoder is decoders.dynamic_attention_decoder; a single graph,
+            built for the largest bucket, is then shared by every bucket.
+          beam_size: number of candidate words per hypothesis returned by the decoding
+            graph, i.e., the largest beam translation_step can use.
+
         """
         super(Seq2SeqModel, self).__init__()
         assert decoder is not None
@@ -519,6 +1025,11 @@ class Seq2SeqModel(TranslationModel):
             self.learning_rate = tf.Variable(float(learning_rate), trainable=False)
             self.learning_rate_decay_op = self.learning_rate.assign(self.learning_rate * learning_rate_decay_factor)
 
+            # learning rate scheduler state (see schedule_ops)
+            self.lr_best_eval_loss = tf.Variable(numpy.inf, trainable=False, name="lr_best_eval_loss")
+            self.lr_bad_evals = tf.Variable(0, trainable=False, name="lr_bad_evals")
+            self.lr_reductions = tf.Variable(0, trainable=False, name="lr_reductions")
+
             # epoch ops
             self.epoch = tf.Variable(0, trainable=False)
             self.epoch_update_op = self.epoch.assign(self.epoch + 1)
@@ -556,12 +1067,15 @@ class Seq2SeqModel(TranslationModel):
             self.input_feeding = input_feeding
 
             self.max_len = max_len
+            self.beam_size = beam_size
             self.dropout = dropout
             self.dropout_feed = tf.placeholder(tf.float32, name="dropout_rate")
-            self.step_num = tf.Variable(0, trainable=False)
 
             self.dtype = dtype
 
+            self.device = device
+            self.max_gradient_norm = max_gradient_norm
+
             # If we use sampled softmax, we need an output projection.
             loss_function = None
 
@@ -584,6 +1098,46 @@ class Seq2SeqModel(TranslationModel):
 
                 loss_function = sampled_loss
 
+            # Jean et al. (2015): the softmax of each batch is computed over the candidate set
+            # (the target vocabulary of its corpus partition) fed in target_candidates
+            if 0 < target_candidates < self.target_vocab_size:
+                self.sampled_softmax = True
+                self.target_candidates = tf.placeholder(tf.int32, shape=[None], name="target_candidates")
+                self._all_candidates = numpy.arange(self.target_vocab_size, dtype=numpy.int32)
+
+                def candidate_loss(inputs, labels):
+                    with tf.device("/cpu:0"):
+                        cand_w = tf.gather(w_t, self.target_candidates)
+                        cand_b = tf.gather(b, self.target_candidates)
+                        logits = tf.matmul(inputs, cand_w, transpose_b=True) + cand_b
+                        # position of each label in the candidate set
+                        labels = tf.reshape(labels, [-1, 1])
+                        hits = tf.to_int32(tf.equal(labels, tf.expand_dims(self.target_candidates, 0)))
+                        # a label outside the candidate set would silently be trained as the first candidate
+                        in_candidates = tf.assert_equal(tf.reduce_max(hits, 1), 1,
+                                                        message="label not in target_candidates")
+                        with tf.control_dependencies([in_candidates]):
+                            positions = tf.argmax(hits, 1)
+                        return tf.nn.sparse_softmax_cross_entropy_with_logits(logits, positions)
+
+                loss_function = candidate_loss
+
+            # the dynamic decoder returns the outputs of the steps it ran stacked in one tensor,
+            # which the loss projects at once (with the sampled or candidate loss if any)
+            self.dynamic_decoder = dynamic_decoder
+            if dynamic_decoder:
+                self.sampled_softmax = True
+                row_loss_function = loss_function or loss_ops.softmax_loss(w, b)
+                self.sequence_loss_function = lambda outputs, targets, weights: loss_ops.stacked_sequence_loss(
+                    outputs, targets, weights, row_loss_function)
+
+            # project all the non-padded decoder outputs of a bucket with a single matmul
+            elif fused_loss and not self.sampled_softmax:
+                # inference then returns the decoder outputs and the loss projects them
+                self.sampled_softmax = True
+                self.sequence_loss_function = lambda outputs, targets, weights: loss_ops.fused_sequence_loss(
+                    outputs, targets, weights, w, b)
+
             # create the embedding matrix - this must be done in the CPU for now
             with tf.device("/cpu:0"):
                 self.src_embedding = tf.Variable(
@@ -621,6 +1175,10 @@ class Seq2SeqModel(TranslationModel):
             for i in xrange(buckets[-1][0]):  # Last bucket is the biggest one.
                 self.encoder_inputs.append(tf.placeholder(tf.int32, shape=[None], name="encoder{0}".format(i)))
 
+            # true length of each source sentence - the encoder skips the padding after it and
+            # no attention is put there
+            self.source_lengths = tf.placeholder(tf.int32, shape=[None], name="source_lengths")
+
             for i in xrange(buckets[-1][1] + 1):
                 self.decoder_inputs.append(tf.placeholder(tf.int32, shape=[None, ], name="decoder{0}".format(i)))
                 self.target_weights.append(tf.placeholder(tf.float32, shape=[None], name="weight{0}".format(i)))
@@ -628,6 +1186,12 @@ class Seq2SeqModel(TranslationModel):
             # Our targets are decoder inputs shifted by one.
             targets = [self.decoder_inputs[i + 1]
                        for i in xrange(len(self.decoder_inputs) - 1)]
+            self.targets = targets
+            self.loss_function = loss_function
+
+            if dynamic_decoder and not forward_only:
+                # the decoder only runs as many steps as the longest target of the batch
+                self.decoder_steps = tf.to_int32(tf.reduce_max(tf.add_n(self.target_weights[:buckets[-1][1]])))
 
             self.decoder_states_holders = None
 
@@ -667,19 +1231,43 @@ class Seq2SeqModel(TranslationModel):
                                                                  name="decoder_state")
                 decoder_states = self.decoder_states_holders
 
+                n_keys = len(tf.get_collection(attention.ATTENTION_KEYS))
+                n_decoder_keys = len(tf.get_collection(decoders.DECODER_KEYS))
+
                 self.logits, self.states, self.decoder_states = decoder(
                     decoder_inputs=[self.decoder_inputs[0]], initial_state=self.decoder_init_plcholder,
+                    source_lengths=self.source_lengths,
                     attention_states=self.attn_plcholder, cell=self.decoder_cell,
                     num_symbols=target_vocab_size, attention_f=attention_f,
                     window_size=window_size, content_function=content_function,
                     decoder_attention_f=decoder_attention_f, combine_inp_attn=combine_inp_attn,
                     input_feeding=input_feeding, dropout=self.dropout_feed, initializer=None,
-                    decoder_states=decoder_states, step_num=self.step_num, dtype=dtype
+                    decoder_states=decoder_states, dtype=dtype
                 )
 
+                # projected attention states - computed on the first step of a sentence and fed afterwards
+                self.attn_keys = tf.get_collection(attention.ATTENTION_KEYS)[n_keys:]
+
+                # keys of the decoder states for the output attention - the ones of the past states are fed
+                # by translation_step, so each step only projects its new state
+                decoder_keys = tf.get_collection(decoders.DECODER_KEYS)[n_decoder_keys:]
+                if decoder_keys:
+                    self.decoder_keys_in, self.decoder_keys = decoder_keys
+
                 # If we use output projection, we need to project outputs for decoding.
-                self.logits = tf.nn.xw_plus_b(self.logits[-1], self.output_projection[0], self.output_projection[1])
-                self.logits = nn_ops.softmax(self.logits)
+                decoder_output = self.logits[-1]
+                self.logits = tf.nn.xw_plus_b(decoder_output, self.output_projection[0], self.output_projection[1])
+                self.logits = nn_ops.log_softmax(self.logits)
+
+                # the beam search only looks at the best beam_size words of each hypothesis
+                self.top_log_probs, self.top_ids = tf.nn.top_k(self.logits, min(beam_size, target_vocab_size))
+
+                # greedy decoding only needs the best one
+                self.best_log_probs = tf.reduce_max(self.logits, 1)
+                self.best_ids = tf.argmax(self.logits, 1)
+
+                # same outputs with the projection of each sentence restricted to its own shortlist
+                self._build_shortlist_outputs(decoder_output, min(beam_size, target_vocab_size))
 
             else:
 
@@ -694,27 +1282,27 @@ class Seq2SeqModel(TranslationModel):
 
                 else:
 
-                    self.outputs, self.losses = model_with_buckets(
-                        encoder_inputs=self.encoder_inputs, decoder_inputs=self.decoder_inputs,
-                        targets=targets, weights=self.target_weights, buckets=buckets,
-                        seq2seq_f=lambda x, y: seq2seq_f(x, y), softmax_loss_function=loss_function)
+                    # the bucket subgraphs are created by _build_bucket below
+                    self.outputs = [None] * len(buckets)
+                    self.losses = [None] * len(buckets)
 
-            # Gradients and SGD update operation for training the model.
-            params = tf.trainable_variables()
-            if not forward_only:
-                self.gradient_norms = []
-                self.updates = []
-                self.gradients = []
+            # Gradients and SGD update operation for training the model - not needed when the model
+            # is only used to compute the validation loss (eval_only)
+            if not forward_only and not eval_only:
+                self.gradient_norms = [None] * len(buckets)
+                self.updates = [None] * len(buckets)
+                self.gradients = [None] * len(buckets)
                 # opt = tf.train.GradientDescentOptimizer(self.learning_rate)
-                opt = optimization_ops.get_optimizer(optimizer, learning_rate)
-                for b in xrange(len(buckets)):
-                    grads = tf.gradients(self.losses[b], params)
-                    self.gradients.append(grads)
-                    clipped_gradients, norm = tf.clip_by_global_norm(grads,
-                                                                     max_gradient_norm)
-                    self.gradient_norms.append(norm)
-                    self.updates.append(opt.apply_gradients(
-                            zip(clipped_gradients, params), global_step=self.global_step))
+                # the optimizer reads the learning rate variable, so the decay and the scheduler apply
+                self.sparse_updates = sparse_updates
+                self.optimizer = optimization_ops.get_optimizer(optimizer, self.learning_rate, lazy=sparse_updates)
+
+            if not forward_only:
+                # with lazy_buckets we only build the smallest bucket now: it creates every variable
+                # (and optimizer slot), so the saver covers them all; the others are built on first use
+                for b in ([0] if lazy_buckets else xrange(len(buckets))):
+                    if b not in self.bucket_graph_stats:
+                        self._build_bucket(b)
 
             self.saver = tf.train.Saver(tf.all_variables())
             self.saver_best = tf.train.Saver(tf.all_variables())
@@ -725,9 +1313,12 @@ class Seq2SeqModel(TranslationModel):
                 _ = tf.histogram_summary('W_output_proj', self.output_projection[0])
                 _ = tf.histogram_summary('b_output_proj', self.output_projection[1])
 
-                _ = tf.histogram_summary('logits', self.outputs)
+                _ = tf.histogram_summary('logits', [o for o in self.outputs if o is not None])
 
                 for b in xrange(len(buckets)):
+                    if self.gradient_norms[b] is None:
+                        # not built yet (lazy_buckets)
+                        continue
                     _ = tf.histogram_summary('gradient_norm_bucket_{0}'.format(b), self.gradient_norms[b])
                     _ = tf.histogram_summary('update_bucket_{0}'.format(b), self.updates[b])
                     _ = tf.histogram_summary('gradient_bucket_{0}'.format(b), self.gradients[b])
@@ -760,15 +1351,19 @@ class Seq2SeqModel(TranslationModel):
         # encode source
         context, decoder_initial_state, attention_states = self.encode(source, b_size)
 
+        # the dynamic decoder stops after the longest target of the batch
+        decoder_args = {'n_steps': self.decoder_steps} if self.dynamic_decoder else {}
+
         # decode target - note that we pass decoder_states as None when training the model
         outputs, state, _ = self.decoder(
             decoder_inputs=target, initial_state=decoder_initial_state,
+            source_lengths=self.source_lengths,
             attention_states=attention_states, cell=self.decoder_cell,
             num_symbols=self.target_vocab_size, attention_f=self.attention_f,
             window_size=self.window_size,  content_function=self.content_function,
             decoder_attention_f=self.decoder_attention_f, combine_inp_attn=self.combine_inp_attn,
             input_feeding=self.input_feeding, dropout=self.dropout_feed,
-            initializer=None, decoder_states=None, step_num=self.step_num, dtype=self.dtype
+            initializer=None, decoder_states=None, dtype=self.dtype, **decoder_args
         )
 
         if self.sampled_softmax is False:
@@ -786,7 +1381,8 @@ class Seq2SeqModel(TranslationModel):
                 scope.reuse_variables()
             context, decoder_initial_state = encoders.reverse_encoder(
                     source, self.src_embedding, self.encoder_cell,
-                    batch_size, dropout=self.dropout_feed, dtype=self.dtype)
+                    batch_size, dropout=self.dropout_feed, sequence_length=self.source_lengths,
+                    dtype=self.dtype)
 
             # First calculate a concatenation of encoder outputs to put attention on.
             top_states = [
@@ -820,8 +1416,15 @@ class NMTModel(TranslationModel):
                  content_function=None,
                  decoder_attention_f="None",
                  num_samples=512,
+                 target_candidates=0,
+                 fused_loss=False,
+                 dynamic_decoder=False,
+                 sparse_updates=False,
                  forward_only=False,
+                 eval_only=False,
+                 lazy_buckets=False,
                  max_len=100,
+                 beam_size=12,
                  cpu_only=False,
                  early_stop_patience=0,
                  save_best_model=True,
@@ -854,6 +1457,11 @@ class NMTModel(TranslationModel):
             self.learning_rate = tf.Variable(float(learning_rate), trainable=False)
             self.learning_rate_decay_op = self.learning_rate.assign(self.learning_rate * learning_rate_decay_factor)
 
+            # learning rate scheduler state (see schedule_ops)
+            self.lr_best_eval_loss = tf.Variable(numpy.inf, trainable=False, name="lr_best_eval_loss")
+            self.lr_bad_evals = tf.Variable(0, trainable=False, name="lr_bad_evals")
+            self.lr_reductions = tf.Variable(0, trainable=False, name="lr_reductions")
+
             # epoch ops
             self.epoch = tf.Variable(0, trainable=False)
             self.epoch_update_op = self.epoch.assign(self.epoch + 1)
@@ -891,12 +1499,15 @@ class NMTModel(TranslationModel):
             self.input_feeding = input_feeding
 
             self.max_len = max_len
+            self.beam_size = beam_size
             self.dropout = dropout
             self.dropout_feed = tf.placeholder(tf.float32, name="dropout_rate")
-            self.step_num = tf.Variable(0, trainable=False)
 
             self.dtype = dtype
 
+            self.device = device
+            self.max_gradient_norm = max_gradient_norm
+
             # If we use sampled softmax, we need an output projection.
             loss_function = None
 
@@ -919,6 +1530,46 @@ class NMTModel(TranslationModel):
 
                 loss_function = sampled_loss
 
+            # Jean et al. (2015): the softmax of each batch is computed over the candidate set
+            # (the target vocabulary of its corpus partition) fed in target_candidates
+            if 0 < target_candidates < self.target_vocab_size:
+                self.sampled_softmax = True
+                self.target_candidates = tf.placeholder(tf.int32, shape=[None], name="target_candidates")
+                self._all_candidates = numpy.arange(self.target_vocab_size, dtype=numpy.int32)
+
+                def candidate_loss(inputs, labels):
+                    with tf.device("/cpu:0"):
+                        cand_w = tf.gather(w_t, self.target_candidates)
+                        cand_b = tf.gather(b, self.target_candidates)
+                        logits = tf.matmul(inputs, cand_w, transpose_b=True) + cand_b
+                        # position of each label in the candidate set
+                        labels = tf.reshape(labels, [-1, 1])
+                        hits = tf.to_int32(tf.equal(labels, tf.expand_dims(self.target_candidates, 0)))
+                        # a label outside the candidate set would silently be trained as the first candidate
+                        in_candidates = tf.assert_equal(tf.reduce_max(hits, 1), 1,
+                                                        message="label not in target_candidates")
+                        with tf.control_dependencies([in_candidates]):
+                            positions = tf.argmax(hits, 1)
+                        return tf.nn.sparse_softmax_cross_entropy_with_logits(logits, positions)
+
+                loss_function = candidate_loss
+
+            # the dynamic decoder returns the outputs of the steps it ran stacked in one tensor,
+            # which the loss projects at once (with the sampled or candidate loss if any)
+            self.dynamic_decoder = dynamic_decoder
+            if dynamic_decoder:
+                self.sampled_softmax = True
+                row_loss_function = loss_function or loss_ops.softmax_loss(w, b)
+                self.sequence_loss_function = lambda outputs, targets, weights: loss_ops.stacked_sequence_loss(
+                    outputs, targets, weights, row_loss_function)
+
+            # project all the non-padded decoder outputs of a bucket with a single matmul
+            elif fused_loss and not self.sampled_softmax:
+                # inference then returns the decoder outputs and the loss projects them
+                self.sampled_softmax = True
+                self.sequence_loss_function = lambda outputs, targets, weights: loss_ops.fused_sequence_loss(
+                    outputs, targets, weights, w, b)
+
             # create the embedding matrix - this must be done in the CPU for now
             with tf.device("/cpu:0"):
                 self.src_embedding = tf.Variable(
@@ -954,6 +1605,10 @@ class NMTModel(TranslationModel):
             for i in xrange(buckets[-1][0]):  # Last bucket is the biggest one.
                 self.encoder_inputs.append(tf.placeholder(tf.int32, shape=[None], name="encoder{0}".format(i)))
 
+            # true length of each source sentence - the encoder skips the padding after it and
+            # no attention is put there
+            self.source_lengths = tf.placeholder(tf.int32, shape=[None], name="source_lengths")
+
             for i in xrange(buckets[-1][1] + 1):
                 self.decoder_inputs.append(tf.placeholder(tf.int32, shape=[None, ], name="decoder{0}".format(i)))
                 self.target_weights.append(tf.placeholder(tf.float32, shape=[None], name="weight{0}".format(i)))
@@ -961,6 +1616,12 @@ class NMTModel(TranslationModel):
             # Our targets are decoder inputs shifted by one.
             targets = [self.decoder_inputs[i + 1]
                        for i in xrange(len(self.decoder_inputs) - 1)]
+            self.targets = targets
+            self.loss_function = loss_function
+
+            if dynamic_decoder and not forward_only:
+                # the decoder only runs as many steps as the longest target of the batch
+                self.decoder_steps = tf.to_int32(tf.reduce_max(tf.add_n(self.target_weights[:buckets[-1][1]])))
 
             self.decoder_states_holders = None
 
@@ -992,8 +1653,11 @@ class NMTModel(TranslationModel):
                                                                  name="decoder_state")
                 decoder_states = self.decoder_states_holders
 
+                n_keys = len(tf.get_collection(attention.ATTENTION_KEYS))
+
                 self.logits, self.states = attention_decoder_nmt(
                     decoder_inputs=[self.decoder_inputs[0]], initial_state=self.decoder_init_plcholder,
+                    source_lengths=self.source_lengths,
                     attention_states=self.attn_plcholder, cell=self.decoder_cell,
                     num_symbols=target_vocab_size, attention_f=attention_f,
                     window_size=window_size, content_function=content_function,
@@ -1002,9 +1666,23 @@ class NMTModel(TranslationModel):
                     dtype=dtype
                 )
 
+                # projected attention states - computed on the first step of a sentence and fed afterwards
+                self.attn_keys = tf.get_collection(attention.ATTENTION_KEYS)[n_keys:]
+
                 # If we use output projection, we need to project outputs for decoding.
-                self.logits = tf.nn.xw_plus_b(self.logits[-1], self.output_projection[0], self.output_projection[1])
-                self.logits = nn_ops.softmax(self.logits)
+                decoder_output = self.logits[-1]
+                self.logits = tf.nn.xw_plus_b(decoder_output, self.output_projection[0], self.output_projection[1])
+                self.logits = nn_ops.log_softmax(self.logits)
+
+                # the beam search only looks at the best beam_size words of each hypothesis
+                self.top_log_probs, self.top_ids = tf.nn.top_k(self.logits, min(beam_size, target_vocab_size))
+
+                # greedy decoding only needs the best one
+                self.best_log_probs = tf.reduce_max(self.logits, 1)
+                self.best_ids = tf.argmax(self.logits, 1)
+
+                # same outputs with the projection of each sentence restricted to its own shortlist
+                self._build_shortlist_outputs(decoder_output, min(beam_size, target_vocab_size))
 
             else:
 
@@ -1019,25 +1697,27 @@ class NMTModel(TranslationModel):
 
                 else:
 
-                    self.outputs, self.losses = model_with_buckets(
-                        encoder_inputs=self.encoder_inputs, decoder_inputs=self.decoder_inputs,
-                        targets=targets, weights=self.target_weights, buckets=buckets,
-                        seq2seq_f=lambda x, y: seq2seq_f(x, y), softmax_loss_function=loss_function)
+                    # the bucket subgraphs are created by _build_bucket below
+                    self.outputs = [None] * len(buckets)
+                    self.losses = [None] * len(buckets)
 
-            # Gradients and SGD update operation for training the model.
-            params = tf.trainable_variables()
-            if not forward_only:
-                self.gradient_norms = []
-                self.updates = []
+            # Gradients and SGD update operation for training the model - not needed when the model
+            # is only used to compute the validation loss (eval_only)
+            if not forward_only and not eval_only:
+                self.gradient_norms = [None] * len(buckets)
+                self.updates = [None] * len(buckets)
+                self.gradients = [None] * len(buckets)
                 # opt = tf.train.GradientDescentOptimizer(self.learning_rate)
-                opt = optimization_ops.get_optimizer(optimizer, learning_rate)
-                for b in xrange(len(buckets)):
-                    gradients = tf.gradients(self.losses[b], params)
-                    clipped_gradients, norm = tf.clip_by_global_norm(gradients,
-                                                                     max_gradient_norm)
-                    self.gradient_norms.append(norm)
-                    self.updates.append(opt.apply_gradients(
-                        zip(clipped_gradients, params), global_step=self.global_step))
+                # the optimizer reads the learning rate variable, so the decay and the scheduler apply
+                self.sparse_updates = sparse_updates
+                self.optimizer = optimization_ops.get_optimizer(optimizer, self.learning_rate, lazy=sparse_updates)
+
+            if not forward_only:
+                # with lazy_buckets we only build the smallest bucket now: it creates every variable
+                # (and optimizer slot), so the saver covers them all; the others are built on first use
+                for b in ([0] if lazy_buckets else xrange(len(buckets))):
+                    if b not in self.bucket_graph_stats:
+                        self._build_bucket(b)
 
             self.saver = tf.train.Saver(tf.all_variables())
             self.saver_best = tf.train.Saver(tf.all_variables())
@@ -1066,9 +1746,9 @@ class NMTModel(TranslationModel):
         # encode source
         context, decoder_initial_state, attention_states = self.encode(source, b_size)
 
-        # decode target - note that we pass decoder_states as None when training the model
-        outputs, state = attention_decoder_nmt(
+        decoder_args = dict(
             decoder_inputs=target, initial_state=decoder_initial_state,
+            source_lengths=self.source_lengths,
             attention_states=attention_states, cell=self.decoder_cell,
             num_symbols=self.target_vocab_size, attention_f=self.attention_f,
             window_size=self.window_size, content_function=self.content_function,
@@ -1077,6 +1757,14 @@ class NMTModel(TranslationModel):
             initializer=None, dtype=self.dtype
         )
 
+        # decode target - note that we pass decoder_states as None when training the model
+        if self.dynamic_decoder:
+            # same steps run by a while loop, stopping after the longest target of the batch
+            outputs, state, _ = decoders.dynamic_attention_decoder(nmt=True, n_steps=self.decoder_steps,
+                                                                   **decoder_args)
+        else:
+            outputs, state = attention_decoder_nmt(**decoder_args)
+
         if self.sampled_softmax is False:
             outputs = [tf.nn.xw_plus_b(o, self.output_projection[0], self.output_projection[1]) for o in outputs]
 
@@ -1092,7 +1780,7 @@ class NMTModel(TranslationModel):
                 scope.reuse_variables()
             context, decoder_initial_state = encoders.bidirectional_encoder(
                 source, self.src_embedding, self.encoder_cell_fw, self.encoder_cell_bw,
-                dropout=self.dropout_feed, dtype=self.dtype)
+                dropout=self.dropout_feed, sequence_length=self.source_lengths, dtype=self.dtype)
 
             # First calculate a concatenation of encoder outputs to put attention on.
             top_states = [
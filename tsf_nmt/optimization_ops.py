@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 import tensorflow as tf
+from tensorflow.python.framework import ops
+from tensorflow.python.ops import control_flow_ops, math_ops
 
 
-def get_optimizer(name='sgd', lr_rate=0.1, decay=0.9):
+def get_optimizer(name='sgd', lr_rate=0.1, decay=0.9, lazy=False):
     """
 
     Parameters
@@ -10,20 +12,106 @@ def get_optimizer(name='sgd', lr_rate=0.1, decay=0.9):
     name
     lr_rate
     decay
+    lazy : if True, adam only updates the slots of the rows present in sparse gradients
+        (see LazyAdamOptimizer)
 
     Returns
     -------
 
     """
     optimizer = None
-    if name is 'sgd':
+    if name == 'sgd':
         optimizer = tf.train.GradientDescentOptimizer(lr_rate)
-    elif name is 'adagrad':
+    elif name == 'adagrad':
         optimizer = tf.train.AdagradOptimizer(lr_rate)
-    elif name is 'adam':
-        optimizer = tf.train.AdamOptimizer(lr_rate, epsilon=1e-8)
-    elif name is 'rmsprop':
+    elif name == 'adam':
+        if lazy:
+            optimizer = LazyAdamOptimizer(lr_rate, epsilon=1e-8)
+        else:
+            optimizer = tf.train.AdamOptimizer(lr_rate, epsilon=1e-8)
+    elif name == 'rmsprop':
         optimizer = tf.train.RMSPropOptimizer(lr_rate, decay)
     else:
         raise ValueError('Optimizer not found.')
-    return optimizer
\ No newline at end of file
+    return optimizer
+
+
+def deduplicate_indexed_slices(values, indices):
+    """Sum the values of repeated indices of a sparse gradient.
+
+    Parameters
+    ----------
+    values : Tensor
+        Values of the IndexedSlices, one row per index.
+    indices : Tensor
+        1-D Tensor of indices, possibly repeated.
+
+    Returns
+    -------
+    summed_values, unique_indices : Tensors
+        One row of summed values per unique index.
+
+    """
+    unique_indices, positions = tf.unique(indices)
+    summed_values = tf.unsorted_segment_sum(values, positions, tf.shape(unique_indices)[0])
+
+    return summed_values, unique_indices
+
+
+def deduplicate_gradients(grads):
+    """Deduplicate the indices of every sparse gradient (IndexedSlices) in grads.
+
+    The gradient of a matrix gathered at every time step (e.g., an embedding) is the
+    concatenation of the slices of all steps, so the same row shows up many times.
+    Dense gradients (and None) are returned unchanged.
+    """
+    deduplicated = []
+    for g in grads:
+        if isinstance(g, ops.IndexedSlices):
+            values, indices = deduplicate_indexed_slices(g.values, g.indices)
+            g = ops.IndexedSlices(values, indices, g.dense_shape)
+        deduplicated.append(g)
+
+    return deduplicated
+
+
+class LazyAdamOptimizer(tf.train.AdamOptimizer):
+    """Adam that applies sparse gradients lazily: the moment slots and the variable are only
+    updated on the rows present in the gradient, instead of decaying the whole slots at every
+    step. Dense gradients are applied as in tf.train.AdamOptimizer.
+
+    The cost of a step on an embedding matrix then depends on the number of distinct tokens
+    of the batch, not on the vocabulary size. Rows not seen in a step keep their moments
+    unchanged (they are not decayed), which is the usual lazy Adam approximation.
+
+    The indices of the sparse gradients must be unique (see deduplicate_gradients, applied by
+    the models before clipping): the slots are updated with scatter_update.
+    """
+
+    def _apply_sparse(self, grad, var):
+        values, indices = grad.values, grad.indices
+
+        dtype = var.dtype.base_dtype
+        beta1_power = math_ops.cast(self._beta1_power, dtype)
+        beta2_power = math_ops.cast(self._beta2_power, dtype)
+        lr_t = math_ops.cast(self._lr_t, dtype)
+        beta1_t = math_ops.cast(self._beta1_t, dtype)
+        beta2_t = math_ops.cast(self._beta2_t, dtype)
+        epsilon_t = math_ops.cast(self._epsilon_t, dtype)
+
+        lr = lr_t * math_ops.sqrt(1 - beta2_power) / (1 - beta1_power)
+
+        # m_t = beta1 * m + (1 - beta1) * g_t - only on the rows of the gradient
+        m = self.get_slot(var, "m")
+        m_t = beta1_t * tf.gather(m, indices) + (1 - beta1_t) * values
+        m_update = tf.scatter_update(m, indices, m_t, use_locking=self._use_locking)
+
+        # v_t = beta2 * v + (1 - beta2) * (g_t * g_t)
+        v = self.get_slot(var, "v")
+        v_t = beta2_t * tf.gather(v, indices) + (1 - beta2_t) * math_ops.square(values)
+        v_update = tf.scatter_update(v, indices, v_t, use_locking=self._use_locking)
+
+        var_update = tf.scatter_sub(var, indices, lr * m_t / (math_ops.sqrt(v_t) + epsilon_t),
+                                    use_locking=self._use_locking)
+
+        return control_flow_ops.group(var_update, m_update, v_update)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+    Sampled execution tracing of the train and decode steps.
+
+    One in every N calls of train_step/translation_step is run with full tracing. The step
+    stats of the traced call are written as a Chrome trace (open it in chrome://tracing) and
+    accumulated in a table of the most expensive ops per step kind, attention type and bucket.
+
+"""
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import tensorflow as tf
+from tensorflow.core.framework import step_stats_pb2
+from tensorflow.python.client import timeline
+
+TRAIN = 'train'
+VALIDATION = 'validation'
+DECODE = 'decode'
+
+
+class StepTrace(object):
+    """Collects the run metadata of every session.run made during one traced step."""
+
+    def __init__(self, kind, bucket_id, call_id):
+        self.kind = kind
+        self.bucket_id = bucket_id
+        self.call_id = call_id
+        self.step_stats = step_stats_pb2.StepStats()
+
+    def run(self, session, fetches, feed_dict=None):
+        """Same as session.run(fetches, feed_dict), but traced."""
+        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+
+        ret = session.run(fetches, feed_dict, options=options, run_metadata=run_metadata)
+
+        self.step_stats.MergeFrom(run_metadata.step_stats)
+
+        return ret
+
+
+class StepProfiler(object):
+    """Decide which steps to trace, write their Chrome traces and aggregate op costs."""
+
+    def __init__(self, trace_dir, every_n=100, attention_type='global', top_n=20, show_memory=True):
+        """
+
+        Parameters
+        ----------
+        trace_dir : string
+            Directory where the traces and the op summary are written.
+        every_n : int
+            Trace one in every 'every_n' calls of each step kind. Default to 100.
+        attention_type : string
+            Attention type of the model (global, local or hybrid), used to label the
+            aggregated table.
+        top_n : int
+            Number of ops to show per group in the summary table. Default to 20.
+        show_memory : boolean
+            Whether to include the memory allocations in the Chrome traces. Default to True.
+
+        """
+        assert every_n > 0
+
+        self.trace_dir = trace_dir
+        self.every_n = every_n
+        self.attention_type = attention_type
+        self.top_n = top_n
+        self.show_memory = show_memory
+
+        self._calls = {}
+        self._op_types = None
+        # (kind, attention_type, bucket_id) -> {(op type, device): [count, micros, bytes]}
+        self.op_stats = {}
+
+        if not os.path.exists(trace_dir):
+            os.makedirs(trace_dir)
+
+    def start(self, kind, bucket_id=None):
+        """Count one call of the given kind and return a StepTrace if it must be traced,
+        or None otherwise."""
+        call_id = self._calls.get(kind, 0)
+        self._calls[kind] = call_id + 1
+
+        if call_id % self.every_n != 0:
+            return None
+
+        return StepTrace(kind, bucket_id, call_id)
+
+    def finish(self, trace, graph):
+        """Write the Chrome trace of a finished step and add its ops to the summary."""
+        if trace is None:
+            return
+
+        tl = timeline.Timeline(trace.step_stats, graph=graph)
+        chrome_trace = tl.generate_chrome_trace_format(show_memory=self.show_memory)
+
+        bucket = 'all' if trace.bucket_id is None else 'bucket%d' % trace.bucket_id
+        file_name = '%s_%s_%s_call%d.trace.json' % (trace.kind, self.attention_type, bucket, trace.call_id)
+
+        with open(os.path.join(self.trace_dir, file_name), 'w') as f:
+            f.write(chrome_trace)
+
+        self._aggregate(trace, graph)
+        self.write_summary()
+
+    def _op_type(self, graph, node_name):
+        if self._op_types is None:
+            self._op_types = dict((op.name, op.type) for op in graph.get_operations())
+
+        op_type = self._op_types.get(node_name)
+
+        if op_type is None:
+            try:
+                op_type = graph.get_operation_by_name(node_name).type
+            except (KeyError, ValueError):
+                # internal nodes such as _SOURCE or _recv_* are not part of the graph
+                op_type = node_name.split(':')[0]
+            self._op_types[node_name] = op_type
+
+        return op_type
+
+    def _aggregate(self, trace, graph):
+        key = (trace.kind, self.attention_type, trace.bucket_id)
+        stats = self.op_stats.setdefault(key, {})
+
+        for dev_stats in trace.step_stats.dev_stats:
+            for node in dev_stats.node_stats:
+                op_type = self._op_type(graph, node.node_name)
+
+                mem = 0
+                for m in getattr(node, 'memory', []):
+                    mem += getattr(m, 'total_bytes', 0)
+
+                s = stats.setdefault((op_type, dev_stats.device), [0, 0, 0])
+                s[0] += 1
+                s[1] += node.all_end_rel_micros
+                s[2] += mem
+
+    def summary(self):
+        """Return the table of the most expensive ops per step kind, attention type and bucket."""
+        lines = []
+
+        for key in sorted(self.op_stats, key=lambda k: (k[0], k[1], -1 if k[2] is None else k[2])):
+            kind, attention_type, bucket_id = key
+            stats = self.op_stats[key]
+            total = sum(s[1] for s in stats.values()) or 1
+
+            bucket = 'all' if bucket_id is None else str(bucket_id)
+            lines.append('%s - %s attention - bucket %s - %d ops - %.3f ms traced' %
+                         (kind, attention_type, bucket, len(stats), total / 1000.0))
+            lines.append('  %-28s %-30s %8s %12s %7s %12s' %
+                         ('op type', 'device', 'count', 'time (ms)', '%', 'memory (MB)'))
+
+            ranked = sorted(stats.items(), key=lambda x: -x[1][1])[:self.top_n]
+
+            for (op_type, device), (count, micros, mem) in ranked:
+                lines.append('  %-28s %-30s %8d %12.3f %6.2f%% %12.3f' %
+                             (op_type, device[-30:], count, micros / 1000.0, 100.0 * micros / total,
+                              mem / (1024.0 * 1024.0)))
+            lines.append('')
+
+        return '\n'.join(lines)
+
+    def write_summary(self):
+        """Write the summary table (text) and the raw aggregated stats (JSON) to trace_dir."""
+        with open(os.path.join(self.trace_dir, 'op_summary.txt'), 'w') as f:
+            f.write(self.summary())
+
+        raw = []
+        for (kind, attention_type, bucket_id), stats in self.op_stats.items():
+            for (op_type, device), (count, micros, mem) in stats.items():
+                raw.append({'kind': kind, 'attention_type': attention_type, 'bucket_id': bucket_id,
+                            'op_type': op_type, 'device': device, 'count': count,
+                            'micros': micros, 'bytes': mem})
+
+        with open(os.path.join(self.trace_dir, 'op_summary.json'), 'w') as f:
+            json.dump(raw, f, indent=1, sort_keys=True)
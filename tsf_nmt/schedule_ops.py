@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+    Learning rate scheduler driven by the validation loss: linear warmup over the first steps,
+    then the learning rate is reduced each time the validation loss stops improving for
+    'patience' validations (reduce-on-plateau), never going below a floor.
+
+    The state of the scheduler lives in variables of the model (lr_best_eval_loss, lr_bad_evals
+    and lr_reductions, besides learning_rate), so it is saved with the checkpoints and training
+    resumes with the same schedule.
+
+"""
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+WARMUP = 'warmup'
+IMPROVED = 'improved'
+PATIENCE = 'patience'
+REDUCED = 'reduced'
+FLOOR = 'floor'
+DISABLED = 'disabled'
+
+
+class PlateauScheduler(object):
+    """Warmup and reduce-on-plateau schedule for model.learning_rate."""
+
+    def __init__(self, model, base_lr, patience=3, factor=0.5, min_lr=0.0, warmup_steps=0, threshold=0.0):
+        """
+
+        Parameters
+        ----------
+        model : TranslationModel
+            Model whose learning_rate is scheduled.
+        base_lr : float
+            Learning rate reached at the end of the warmup.
+        patience : int
+            Number of validations without improvement before the learning rate is reduced.
+            If 0, the learning rate is never reduced (only the warmup is applied). Default to 3.
+        factor : float
+            The learning rate is multiplied by this factor when reduced. A factor >= 1 never
+            reduces it. Default to 0.5.
+        min_lr : float
+            Floor of the learning rate. Default to 0.0.
+        warmup_steps : int
+            Number of steps over which the learning rate grows linearly up to base_lr.
+            Default to 0 (no warmup).
+        threshold : float
+            Relative improvement of the validation loss needed to reset the patience.
+            Default to 0.0.
+
+        """
+        self.model = model
+        self.base_lr = base_lr
+        self.patience = patience
+        self.factor = factor
+        self.min_lr = min_lr
+        self.warmup_steps = warmup_steps
+        self.threshold = threshold
+
+        # ops only - the variables were created with the model, before its saver
+        self._lr_plcholder = tf.placeholder(tf.float32, shape=[], name="lr_schedule_value")
+        self._lr_set_op = model.learning_rate.assign(self._lr_plcholder)
+        self._best_plcholder = tf.placeholder(tf.float32, shape=[], name="lr_schedule_best")
+        self._best_set_op = model.lr_best_eval_loss.assign(self._best_plcholder)
+        self._bad_update_op = model.lr_bad_evals.assign_add(1)
+        self._bad_reset_op = model.lr_bad_evals.assign(0)
+        self._reductions_update_op = model.lr_reductions.assign_add(1)
+
+    def _set_lr(self, session, lr):
+        session.run(self._lr_set_op, feed_dict={self._lr_plcholder: lr})
+
+    def in_warmup(self, global_step):
+        return global_step <= self.warmup_steps
+
+    def step(self, session, global_step):
+        """Update the learning rate after a training step - only does something during warmup.
+
+        Returns the new learning rate, or None if it did not change.
+        """
+        if not self.in_warmup(global_step):
+            return None
+
+        lr = self.base_lr * max(global_step, 1) / max(self.warmup_steps, 1)
+        self._set_lr(session, lr)
+
+        return lr
+
+    def validate(self, session, global_step, eval_loss):
+        """Feed the result of a validation to the scheduler and reduce the learning rate if the
+        loss did not improve for 'patience' validations.
+
+        Returns a pair (decision, learning rate), where decision is one of WARMUP, IMPROVED,
+        PATIENCE, REDUCED, FLOOR (the learning rate cannot go lower) or DISABLED (patience is 0).
+        The decision is also printed to the training log.
+        """
+        model = self.model
+        lr = float(model.learning_rate.eval())
+        best = float(model.lr_best_eval_loss.eval())
+
+        if eval_loss < best * (1.0 - self.threshold):
+            session.run(self._best_set_op, feed_dict={self._best_plcholder: eval_loss})
+            session.run(self._bad_reset_op)
+            decision = IMPROVED
+
+        elif self.patience <= 0:
+            # reduce-on-plateau is off
+            decision = DISABLED
+
+        elif self.in_warmup(global_step):
+            # do not count the validations made while the learning rate is still growing
+            decision = WARMUP
+
+        else:
+            bad_evals = session.run(self._bad_update_op)
+
+            if bad_evals < self.patience:
+                decision = PATIENCE
+
+            elif lr <= self.min_lr or lr * self.factor >= lr:
+                # reducing would not lower the learning rate
+                decision = FLOOR
+
+            else:
+                lr = max(lr * self.factor, self.min_lr)
+                self._set_lr(session, lr)
+                session.run(self._bad_reset_op)
+                session.run(self._reductions_update_op)
+                decision = REDUCED
+
+        print('lr scheduler: %s - lr.rate %.8f - best valid. loss %.8f - no improvement for %d/%d - %d reductions' %
+              (decision, lr, model.lr_best_eval_loss.eval(), int(model.lr_bad_evals.eval()), self.patience,
+               int(model.lr_reductions.eval())))
+
+        return decision, lr
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+    Local translation server: requests are queued and a single decoding thread groups them in
+    micro-batches, bounded by a maximum batch size and by the time the first request of a batch
+    may wait for others, and translates each micro-batch with one batched beam search.
+
+    The server speaks HTTP: POST a json object {"text": "source sentence"} and get back
+    {"translation": ..., "score": ..., "batch_size": ..., "queue_ms": ..., "compute_ms": ...}.
+
+"""
+from __future__ import division
+from __future__ import print_function
+
+import json
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from Queue import Queue, Empty
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from queue import Queue, Empty
+    from socketserver import ThreadingMixIn
+
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
+
+class _Request(object):
+
+    def __init__(self, item):
+        self.item = item
+        self.enqueued = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.batch_size = 0
+        self.queue_time = 0.0
+        self.compute_time = 0.0
+
+
+class MicroBatcher(object):
+    """Group the items submitted by several threads in batches handled by one worker thread."""
+
+    def __init__(self, translate_fn, max_batch_size=16, max_wait=0.01):
+        """
+
+        Parameters
+        ----------
+        translate_fn : function
+            Called by the worker thread with a list of items, returns the list of their results.
+        max_batch_size : int
+            Maximum number of items of a batch. Default to 16.
+        max_wait : float
+            Maximum time, in seconds, the first item of a batch waits for others. Default to 0.01.
+
+        """
+        self.translate_fn = translate_fn
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_wait = max_wait
+
+        self._queue = Queue()
+        self._thread = threading.Thread(target=self._loop, name='micro_batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = batch[0].enqueued + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    # past the deadline, only take the requests that are already waiting
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            start = time.time()
+
+            try:
+                results = self.translate_fn([request.item for request in batch])
+                errors = [None] * len(batch)
+            except Exception:
+                # translate the items one at a time, so only the ones that fail get the error
+                results, errors = self._one_by_one(batch)
+
+            compute_time = time.time() - start
+
+            for request, result, error in zip(batch, results, errors):
+                request.result = result
+                request.error = error
+                request.batch_size = len(batch)
+                request.queue_time = start - request.enqueued
+                request.compute_time = compute_time
+                request.done.set()
+
+    def _one_by_one(self, batch):
+        results, errors = [], []
+        for request in batch:
+            try:
+                results.append(self.translate_fn([request.item])[0])
+                errors.append(None)
+            except Exception as e:
+                results.append(None)
+                errors.append(e)
+        return results, errors
+
+    def submit(self, item):
+        """Queue the item and wait for its result. Returns the finished request, whose result,
+        batch_size, queue_time and compute_time (seconds) are set."""
+        request = _Request(item)
+        self._queue.put(request)
+        request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+
+        return request
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _handler(batcher, translate_request):
+
+    class TranslationHandler(BaseHTTPRequestHandler):
+
+        def _reply(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                text = json.loads(self.rfile.read(length).decode('utf-8'))['text']
+                if not isinstance(text, _string_types):
+                    raise TypeError('text is not a string')
+            except (ValueError, KeyError, TypeError):
+                self._reply(400, {'error': 'expected a json object with a string "text" field'})
+                return
+
+            try:
+                request = batcher.submit(text)
+                body = translate_request(request.result)
+                body.update(batch_size=request.batch_size,
+                            queue_ms=1000.0 * request.queue_time,
+                            compute_ms=1000.0 * request.compute_time)
+            except Exception as e:
+                self._reply(500, {'error': str(e)})
+                return
+
+            self._reply(200, body)
+
+    return TranslationHandler
+
+
+def serve(batcher, host='127.0.0.1', port=8080, translate_request=None):
+    """Serve the translations of batcher over HTTP until interrupted.
+
+    Parameters
+    ----------
+    batcher : MicroBatcher
+        Batcher whose items are the source texts.
+    host : string
+        Address to listen on. Default to 127.0.0.1 (local connections only).
+    port : int
+        Port to listen on. Default to 8080.
+    translate_request : function
+        Turns the result of a text into the (json) dict of the reply. Default to {"translation": result}.
+
+    """
+    if translate_request is None:
+        translate_request = lambda result: {'translation': result}
+
+    server = _ThreadingHTTPServer((host, port), _handler(batcher, translate_request))
+    print('Translation server listening on http://%s:%d' % (host, port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
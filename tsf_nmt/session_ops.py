@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+    Session configuration (intra-op and inter-op thread pools) and a small autotuner that
+    benchmarks train_step and translation_step on synthetic data over a grid of thread
+    settings and stores the best ones for the current host.
+
+"""
+from __future__ import division
+from __future__ import print_function
+
+import json
+import multiprocessing
+import os
+import socket
+import time
+
+import numpy
+import tensorflow as tf
+
+import build_ops
+import data_utils
+
+TRAIN = 'train'
+DECODE = 'decode'
+
+
+def _threads_path(FLAGS):
+    if not FLAGS.threads_file:
+        return None
+    return os.path.join(FLAGS.train_dir, FLAGS.threads_file)
+
+
+def load_tuned_threads(FLAGS, mode=TRAIN):
+    """Return the (intra_op, inter_op) pair tuned for this host and mode, or None."""
+    path = _threads_path(FLAGS)
+
+    if path is None or not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        tuned = json.load(f)
+
+    host = tuned.get(socket.gethostname(), {})
+    if mode not in host:
+        return None
+
+    return host[mode]['intra_op'], host[mode]['inter_op']
+
+
+def get_session_config(FLAGS, mode=TRAIN, **kwargs):
+    """Return the ConfigProto used by the sessions of the given mode (TRAIN or DECODE).
+
+    The thread pool sizes come from the intra_op_threads/inter_op_threads flags; when a
+    flag is 0, the value tuned for this host by autotune_threads is used, if any, and the
+    tensorflow default otherwise.
+
+    Parameters
+    ----------
+    FLAGS : object
+        Flags of the entry point.
+    mode : string
+        TRAIN or DECODE. Default to TRAIN.
+    kwargs : dict
+        Other fields of the ConfigProto (e.g., log_device_placement).
+
+    """
+    intra_op, inter_op = FLAGS.intra_op_threads, FLAGS.inter_op_threads
+
+    tuned = load_tuned_threads(FLAGS, mode)
+    if tuned is not None:
+        if intra_op == 0:
+            intra_op = tuned[0]
+        if inter_op == 0:
+            inter_op = tuned[1]
+
+    return tf.ConfigProto(allow_soft_placement=True,
+                          intra_op_parallelism_threads=intra_op,
+                          inter_op_parallelism_threads=inter_op,
+                          **kwargs)
+
+
+def _thread_grid():
+    n_cpus = multiprocessing.cpu_count()
+
+    intra = []
+    n = 1
+    while n < n_cpus:
+        intra.append(n)
+        n *= 2
+    intra.append(n_cpus)
+
+    inter = [n for n in (1, 2, 4) if n <= n_cpus]
+
+    return [(a, b) for a in intra for b in inter]
+
+
+def _synthetic_data(FLAGS, bucket, n_pairs=256):
+    src_len, tgt_len = bucket
+    rand = numpy.random.RandomState(1234)
+    pairs = []
+    for _ in xrange(n_pairs):
+        source = rand.randint(len(data_utils._START_VOCAB), FLAGS.src_vocab_size, src_len - 1).tolist()
+        # the target gets an EOS when read from the files - leave room for it and GO
+        target = rand.randint(len(data_utils._START_VOCAB), FLAGS.tgt_vocab_size, tgt_len - 2).tolist()
+        pairs.append([source, target + [data_utils.EOS_ID]])
+    return pairs
+
+
+def _benchmark(graph, config, run_step, steps):
+    with tf.Session(graph=graph, config=config) as sess:
+        with graph.as_default():
+            sess.run(tf.initialize_all_variables())
+
+        # the first steps pay for the memory allocations (and lazy bucket building)
+        for _ in xrange(2):
+            run_step(sess)
+
+        start = time.time()
+        for _ in xrange(steps):
+            run_step(sess)
+
+    return (time.time() - start) / steps
+
+
+def _tune(name, graph, run_step, steps):
+    results = []
+
+    for intra_op, inter_op in _thread_grid():
+        config = tf.ConfigProto(allow_soft_placement=True,
+                                intra_op_parallelism_threads=intra_op,
+                                inter_op_parallelism_threads=inter_op)
+
+        step_time = _benchmark(graph, config, run_step, steps)
+        results.append({'intra_op': intra_op, 'inter_op': inter_op, 'step_time': step_time})
+
+        print('%s - intra_op %d - inter_op %d - %.4f sec/step' % (name, intra_op, inter_op, step_time))
+
+    return min(results, key=lambda r: r['step_time'])
+
+
+def autotune_threads(FLAGS=None, buckets=None):
+    """Benchmark train_step and translation_step on synthetic data for a grid of thread pool
+    sizes and write the fastest setting of each mode for this host to train_dir/threads_file."""
+
+    assert FLAGS is not None
+    assert buckets is not None
+
+    path = _threads_path(FLAGS)
+    assert path is not None, 'Set threads_file to write the tuned configuration.'
+
+    steps = FLAGS.autotune_steps
+    bucket_id = len(buckets) // 2
+    best = {}
+
+    create_model = build_ops.create_seq2seq_model if FLAGS.model == "seq2seq" else build_ops.create_nmt_model
+
+    # training step on a batch of the middle bucket
+    train_graph = tf.Graph()
+    with train_graph.as_default():
+        with tf.Session() as sess:
+            model = create_model(sess, False, FLAGS=FLAGS, buckets=buckets)
+
+    data = [[] for _ in buckets]
+    data[bucket_id] = _synthetic_data(FLAGS, buckets[bucket_id])
+    encoder_inputs, decoder_inputs, target_weights, _, source_lengths = model.get_train_batch(data, bucket_id)
+
+    def train_step(sess):
+        with train_graph.as_default():
+            model.train_step(sess, encoder_inputs, decoder_inputs, target_weights, bucket_id,
+                             source_lengths=source_lengths)
+
+    best[TRAIN] = _tune(TRAIN, train_graph, train_step, steps)
+
+    # decoding - only the seq2seq model has the single step decoder used by translation_step
+    if FLAGS.model == "seq2seq":
+
+        decode_graph = tf.Graph()
+        with decode_graph.as_default():
+            with tf.Session() as sess:
+                decoder = build_ops.create_seq2seq_model(sess, True, FLAGS=FLAGS, buckets=buckets, translate=True,
+                                                         batch_size=1)
+
+        token_ids = data[bucket_id][0][0]
+
+        def decode_step(sess):
+            decoder.translation_step(sess, token_ids, beam_size=FLAGS.beam_size)
+
+        best[DECODE] = _tune(DECODE, decode_graph, decode_step, max(1, steps // 4))
+
+    tuned = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            tuned = json.load(f)
+
+    tuned[socket.gethostname()] = best
+
+    with open(path, 'w') as f:
+        json.dump(tuned, f, indent=1, sort_keys=True)
+
+    for mode in sorted(best):
+        print('Best %s setting: intra_op %d - inter_op %d (%.4f sec/step)' %
+              (mode, best[mode]['intra_op'], best[mode]['inter_op'], best[mode]['step_time']))
+    print('Written to %s' % path)
+
+    return best
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+    Per-sentence target vocabulary shortlists for decoding: a lexical table built from the
+    training corpus gives the most likely translations (target ids) of each source word, and
+    the shortlist of a sentence is the union of the translations of its words, the most
+    frequent target words and the special symbols. The decoder then projects its states only
+    onto the words of the shortlist instead of the whole target vocabulary. The sentences of a
+    batch keep their own shortlists (padded to the longest one, see pad_shortlists), so the
+    translation of a sentence does not depend on the batch it is decoded in.
+
+    The translations of a source word are the target words with the best Dice coefficient
+    2 * c(s, t) / (c(s) + c(t)), counting the sentence pairs in which the words co-occur.
+
+"""
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import sys
+
+import numpy
+from tensorflow.python.platform import gfile
+
+import data_utils
+
+FREQUENT = 'frequent'
+TRANSLATIONS = 'translations'
+
+
+def _merge_counts(codes, counts):
+    codes, positions = numpy.unique(codes, return_inverse=True)
+    return codes, numpy.bincount(positions, weights=counts).astype(numpy.int64)
+
+
+def _chunk_counts(chunk):
+    codes = numpy.concatenate(chunk)
+    return codes, numpy.ones_like(codes)
+
+
+def build_lexical_table(source_path, target_path, tgt_vocab_size, top_k=10, n_frequent=100, max_size=None,
+                        chunk_size=10000):
+    """Build the lexical table of the token-ids files source_path and target_path.
+
+    Parameters
+    ----------
+    source_path : string
+        Path to the token-ids of the source training data.
+    target_path : string
+        Path to the token-ids of the target training data, aligned with source_path.
+    tgt_vocab_size : int
+        Size of the target vocabulary.
+    top_k : int
+        Number of translations kept for each source word. Default to 10.
+    n_frequent : int
+        Number of most frequent target words, always part of the shortlists. Default to 100.
+    max_size : int
+        Maximum number of sentence pairs read; if 0 or None, the files are read completely.
+    chunk_size : int
+        Number of sentence pairs whose co-occurrences are counted at once. Default to 10000.
+
+    Returns
+    -------
+    table : dict
+        FREQUENT is the list of the n_frequent most frequent target ids and TRANSLATIONS maps
+        each source id to the list of its top_k translations, best first.
+
+    """
+    special = len(data_utils._START_VOCAB)
+
+    # co-occurrences are coded as source_id * tgt_vocab_size + target_id
+    codes, counts = numpy.zeros([0], dtype=numpy.int64), numpy.zeros([0], dtype=numpy.int64)
+    chunk = []
+    source_counts = {}
+    target_counts = numpy.zeros([tgt_vocab_size], dtype=numpy.int64)
+    target_freqs = numpy.zeros([tgt_vocab_size], dtype=numpy.int64)
+
+    counter = 0
+    with gfile.GFile(source_path, mode='r') as source_file:
+        with gfile.GFile(target_path, mode='r') as target_file:
+            source, target = source_file.readline(), target_file.readline()
+
+            while source and target and (not max_size or counter < max_size):
+                counter += 1
+                if counter % 100000 == 0:
+                    print('  counting co-occurrences line %d' % counter)
+                    sys.stdout.flush()
+
+                source_ids = numpy.unique(numpy.array([int(x) for x in source.split()], dtype=numpy.int64))
+                target_ids = numpy.array([int(x) for x in target.split()], dtype=numpy.int64)
+                target_freqs += numpy.bincount(target_ids, minlength=tgt_vocab_size)[:tgt_vocab_size]
+                target_ids = numpy.unique(target_ids)
+
+                # the special symbols are always in the shortlists - do not count them
+                source_ids = source_ids[source_ids >= special]
+                target_ids = target_ids[target_ids >= special]
+
+                for s in source_ids:
+                    source_counts[s] = source_counts.get(s, 0) + 1
+                target_counts[target_ids] += 1
+
+                chunk.append((source_ids[:, None] * tgt_vocab_size + target_ids[None, :]).ravel())
+
+                if len(chunk) == chunk_size:
+                    chunk_codes, chunk_counts = _merge_counts(*_chunk_counts(chunk))
+                    codes, counts = _merge_counts(numpy.concatenate([codes, chunk_codes]),
+                                                  numpy.concatenate([counts, chunk_counts]))
+                    chunk = []
+
+                source, target = source_file.readline(), target_file.readline()
+
+    if chunk:
+        chunk_codes, chunk_counts = _merge_counts(*_chunk_counts(chunk))
+        codes, counts = _merge_counts(numpy.concatenate([codes, chunk_codes]),
+                                      numpy.concatenate([counts, chunk_counts]))
+
+    sources, targets = codes // tgt_vocab_size, codes % tgt_vocab_size
+    source_totals = numpy.array([source_counts[s] for s in sources], dtype=numpy.float64)
+    dice = 2.0 * counts / (source_totals + target_counts[targets])
+
+    # best translations first, grouped by source word
+    order = numpy.lexsort((-dice, sources))
+    sources, targets = sources[order], targets[order]
+
+    translations = {}
+    starts = numpy.flatnonzero(numpy.r_[True, sources[1:] != sources[:-1]])
+    ends = numpy.r_[starts[1:], len(sources)]
+    for start, end in zip(starts, ends):
+        translations[int(sources[start])] = targets[start:min(end, start + top_k)].tolist()
+
+    target_freqs[:special] = 0
+    frequent = [int(t) for t in numpy.argsort(-target_freqs, kind='mergesort')[:n_frequent] if target_freqs[t] > 0]
+
+    print('  lexical table: %d source words, %d translations each, %d frequent target words' %
+          (len(translations), top_k, len(frequent)))
+
+    return {FREQUENT: frequent, TRANSLATIONS: translations}
+
+
+def save_lexical_table(table, path):
+    with open(path, 'w') as f:
+        json.dump({FREQUENT: table[FREQUENT],
+                   TRANSLATIONS: dict((str(s), t) for s, t in table[TRANSLATIONS].items())}, f)
+
+
+def load_lexical_table(path):
+    with open(path) as f:
+        table = json.load(f)
+    # json keys are strings
+    table[TRANSLATIONS] = dict((int(s), t) for s, t in table[TRANSLATIONS].items())
+    return table
+
+
+def get_lexical_table(FLAGS):
+    """Load the lexical table from train_dir/shortlist_file, building it from the token-ids of the
+    training data (see data_utils.prepare_nmt_data) the first time."""
+    path = os.path.join(FLAGS.train_dir, FLAGS.shortlist_file)
+
+    if os.path.exists(path):
+        print('Reading lexical table from %s' % path)
+        return load_lexical_table(path)
+
+    train_data = FLAGS.data_dir + FLAGS.train_data
+    source_path = (train_data % str(FLAGS.src_vocab_size)) + ('.ids.%s' % FLAGS.source_lang)
+    target_path = (train_data % str(FLAGS.tgt_vocab_size)) + ('.ids.%s' % FLAGS.target_lang)
+
+    print('Building lexical table from %s and %s' % (source_path, target_path))
+    table = build_lexical_table(source_path, target_path, FLAGS.tgt_vocab_size,
+                                top_k=FLAGS.shortlist_top_k,
+                                n_frequent=FLAGS.shortlist_frequent,
+                                max_size=FLAGS.max_train_data_size)
+    save_lexical_table(table, path)
+
+    return table
+
+
+def sentence_shortlist(table, token_ids, min_size=0):
+    """Sorted target ids (int32 array) that the decoder may output for the source sentence
+    token_ids: the special symbols, the frequent target words and the translations of the source
+    words. If needed, less frequent words of the table are added up to min_size words."""
+    shortlist = set(range(len(data_utils._START_VOCAB)))
+    shortlist.update(table[FREQUENT])
+
+    for token_id in token_ids:
+        shortlist.update(table[TRANSLATIONS].get(token_id, ()))
+
+    if len(shortlist) < min_size:
+        for translations in table[TRANSLATIONS].values():
+            shortlist.update(translations)
+            if len(shortlist) >= min_size:
+                break
+
+    return numpy.array(sorted(shortlist), dtype=numpy.int32)
+
+
+def pad_shortlists(shortlists):
+    """Pad the shortlists of the sentences of a batch with PAD_ID to the longest one. Returns the
+    pair ([n_sentences, k] int32 array, int32 array of the true lengths) fed to the decoder."""
+    lengths = numpy.array([len(shortlist) for shortlist in shortlists], dtype=numpy.int32)
+
+    padded = data_utils.PAD_ID * numpy.ones([len(shortlists), max(lengths)], dtype=numpy.int32)
+    for row, shortlist in enumerate(shortlists):
+        padded[row, :len(shortlist)] = shortlist
+
+    return padded, lengths
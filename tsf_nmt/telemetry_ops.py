@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+    Training telemetry: wall-clock time spent in each phase of the training loop, token
+    throughput, padding ratio per bucket and memory usage, written as JSON lines and,
+    optionally, as a Prometheus textfile.
+
+"""
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import json
+import os
+import resource
+import time
+
+import numpy
+
+import data_utils
+
+FETCH = 'fetch'
+BATCH = 'batch'
+RUN = 'run'
+BOOKKEEPING = 'bookkeeping'
+VALIDATION = 'validation'
+CHECKPOINT = 'checkpoint'
+
+PHASES = (FETCH, BATCH, RUN, BOOKKEEPING, VALIDATION, CHECKPOINT)
+
+
+def get_rss():
+    """Return the resident set size of this process in bytes.
+
+    Reads /proc/self/statm when available (Linux) and falls back to the peak RSS reported
+    by getrusage otherwise.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class TrainingTelemetry(object):
+    """Collect per-phase timings and throughput of the training loop.
+
+    Statistics are accumulated over a reporting window (usually 'steps_verbosity' steps).
+    Each call to report closes the window, writes one JSON record and starts a new one. The
+    step time and the throughput leave out the validation and checkpoint phases of the window,
+    which are reported on their own.
+
+    """
+
+    def __init__(self, jsonl_path=None, prometheus_path=None):
+        """
+
+        Parameters
+        ----------
+        jsonl_path : string
+            File where one JSON record per report is appended. If None, nothing is written.
+        prometheus_path : string
+            Prometheus textfile rewritten at every report (for the node exporter textfile
+            collector). If None, it is not written.
+
+        """
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+
+        self._jsonl = None
+        if jsonl_path:
+            self._jsonl = open(jsonl_path, 'a')
+
+        self._reset()
+
+    def _reset(self):
+        self._window_start = time.time()
+        self.phase_time = dict((p, 0.0) for p in PHASES)
+        self.steps = 0
+        self.src_tokens = 0
+        self.tgt_tokens = 0
+        # bucket_id -> [real tokens, token slots (real + padding)]
+        self.bucket_tokens = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager adding the time spent inside it to the given phase."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phase_time[name] += time.time() - start
+
+    def add_batch(self, bucket_id, encoder_inputs, target_weights):
+        """Account for one training batch.
+
+        Parameters
+        ----------
+        bucket_id : int
+            Bucket the batch was taken from.
+        encoder_inputs : list
+            List of batch-major int vectors fed to the encoder.
+        target_weights : list
+            List of batch-major float vectors with 0 on padded target positions.
+
+        """
+        src = sum(int(numpy.count_nonzero(e != data_utils.PAD_ID)) for e in encoder_inputs)
+        tgt = int(round(sum(float(numpy.sum(w)) for w in target_weights)))
+
+        batch_size = len(encoder_inputs[0])
+        slots = (len(encoder_inputs) + len(target_weights)) * batch_size
+
+        self.steps += 1
+        self.src_tokens += src
+        self.tgt_tokens += tgt
+
+        tokens = self.bucket_tokens.setdefault(bucket_id, [0, 0])
+        tokens[0] += src + tgt
+        tokens[1] += slots
+
+    def report(self, global_step, **extra):
+        """Close the current window, write its record and return it as a dict.
+
+        Parameters
+        ----------
+        global_step : int
+            Global step at the end of the window.
+        extra : dict
+            Additional values to include in the record (e.g., loss, learning rate).
+
+        """
+        now = time.time()
+        window = max(now - self._window_start, 1e-8)
+        train_time = max(window - self.phase_time[VALIDATION] - self.phase_time[CHECKPOINT], 1e-8)
+        steps = max(self.steps, 1)
+        run_time = max(self.phase_time[RUN], 1e-8)
+
+        record = {
+            'time': now,
+            'global_step': int(global_step),
+            'steps': self.steps,
+            'window_sec': window,
+            'train_sec': train_time,
+            'step_time': train_time / steps,
+            'phases': dict((p, self.phase_time[p]) for p in PHASES),
+            'src_tokens_per_sec': self.src_tokens / train_time,
+            'tgt_tokens_per_sec': self.tgt_tokens / train_time,
+            'tgt_tokens_per_run_sec': self.tgt_tokens / run_time,
+            'padding_ratio': dict((str(b), 1.0 - (t[0] / t[1]) if t[1] > 0 else 0.0)
+                                  for b, t in self.bucket_tokens.items()),
+            'rss_bytes': get_rss()
+        }
+        self._base_keys = set(record)
+        record.update(extra)
+
+        if self._jsonl is not None:
+            self._jsonl.write(json.dumps(record, sort_keys=True) + '\n')
+            self._jsonl.flush()
+
+        if self.prometheus_path:
+            self._write_prometheus(record)
+
+        self._reset()
+
+        return record
+
+    def _write_prometheus(self, record):
+        lines = []
+
+        def gauge(name, value, labels=None, help_str=None):
+            if help_str is not None:
+                lines.append('# HELP tsf_nmt_%s %s' % (name, help_str))
+                lines.append('# TYPE tsf_nmt_%s gauge' % name)
+            if labels:
+                lbl = ','.join('%s="%s"' % (k, v) for k, v in sorted(labels.items()))
+                lines.append('tsf_nmt_%s{%s} %r' % (name, lbl, float(value)))
+            else:
+                lines.append('tsf_nmt_%s %r' % (name, float(value)))
+
+        gauge('global_step', record['global_step'], help_str='Global training step.')
+        gauge('step_time_seconds', record['step_time'], help_str='Average wall time per step (validation and checkpoints excluded).')
+
+        for i, p in enumerate(PHASES):
+            gauge('phase_seconds', record['phases'][p], {'phase': p},
+                  help_str='Wall time spent in each phase of the last window.' if i == 0 else None)
+
+        gauge('tokens_per_second', record['src_tokens_per_sec'], {'side': 'source'},
+              help_str='Token throughput over the last window.')
+        gauge('tokens_per_second', record['tgt_tokens_per_sec'], {'side': 'target'})
+
+        for i, b in enumerate(sorted(record['padding_ratio'], key=int)):
+            gauge('padding_ratio', record['padding_ratio'][b], {'bucket': b},
+                  help_str='Fraction of padded positions per bucket.' if i == 0 else None)
+
+        gauge('rss_bytes', record['rss_bytes'], help_str='Resident set size of the trainer.')
+
+        # extra values given to report (loss, learning rate, ...)
+        for k in sorted(set(record) - self._base_keys):
+            if isinstance(record[k], (int, float)):
+                gauge(k, record[k], help_str='Reported %s.' % k.replace('_', ' '))
+
+        # write to a temporary file and rename it so the collector never reads a partial file
+        tmp_path = self.prometheus_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp_path, self.prometheus_path)
+
+    def close(self):
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
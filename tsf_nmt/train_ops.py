@@ -8,7 +8,13 @@ import tensorflow as tf
 import time
 import sys
 import build_ops
+import eval_ops
+import schedule_ops
+import session_ops
+import telemetry_ops
+from checkpoint_ops import CheckpointManager
 from data_utils import read_nmt_data
+from eval_ops import evaluate_nmt
 # from six.moves import xrange
 
 
@@ -24,7 +30,7 @@ def train_nmt(FLAGS=None, buckets=None, save_before_training=False):
 
     # summary_op = tf.merge_all_summaries()
 
-    with tf.Session(config=tf.ConfigProto(allow_soft_placement=True, log_device_placement=False)) as sess:
+    with tf.Session(config=session_ops.get_session_config(FLAGS, log_device_placement=False)) as sess:
 
         nan_detected = False
 
@@ -36,292 +42,301 @@ def train_nmt(FLAGS=None, buckets=None, save_before_training=False):
         else:
             model = build_ops.create_nmt_model(sess, False, FLAGS=FLAGS, buckets=buckets)
 
-        if save_before_training:
-            # Save checkpoint
-            checkpoint_path = os.path.join(FLAGS.train_dir, FLAGS.model_name)
-            model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-
-        # tf.train.write_graph(sess.graph_def, '/home/gian/train2', 'graph.pbtxt')
-
-        # Read data into buckets and compute their sizes.
-        print('Reading development and training data (limit: %d).' % FLAGS.max_train_data_size)
-        dev_set = read_nmt_data(src_dev, tgt_dev, FLAGS=FLAGS, buckets=buckets)
-        train_set = read_nmt_data(src_train, tgt_train, max_size=FLAGS.max_train_data_size, FLAGS=FLAGS,
-                                  buckets=buckets)
-        train_bucket_sizes = [len(train_set[b]) for b in xrange(len(buckets))]
-        train_total_size = float(sum(train_bucket_sizes))
-
-        print("Total number of steps per epoch: %d" % (train_total_size / FLAGS.batch_size))
-
-        # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
-        # to select a bucket. Length of [scale[i], scale[i+1]] is proportional to
-        # the size if i-th training bucket, as used later.
-        train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
-                               for i in xrange(len(train_bucket_sizes))]
-
-        # This is the training loop.
-        step_time = 0.0
-        words_time = 0.0
-        n_target_words = 0
-
-        summary_writer = None
-        if FLAGS.log_tensorboard:
-            summary_writer = tf.train.SummaryWriter(FLAGS.train_dir, sess.graph_def)
-
-        print("Optimization started...")
-        while model.epoch.eval() < FLAGS.max_epochs:
-
-            saved = False
-
-            start_time = time.time()
-
-            # Choose a bucket according to data distribution. We pick a random number
-            # in [0, 1] and use the corresponding interval in train_buckets_scale.
-            random_number_01 = numpy.random.random_sample()
-            bucket_id = min([i for i in xrange(len(train_buckets_scale))
-                             if train_buckets_scale[i] > random_number_01])
-
-            # Get a batch and make a step.
-            encoder_inputs, decoder_inputs, target_weights, n_words = model.get_train_batch(
-                train_set, bucket_id
-            )
-
-            n_target_words += n_words
-
-            # session, encoder_inputs, decoder_inputs, target_weights, bucket_id
-            # note: step loss is averaged across the batch
-            gradient_norm, step_loss, _ = model.train_step(session=sess, encoder_inputs=encoder_inputs,
-                                                           decoder_inputs=decoder_inputs,
-                                                           target_weights=target_weights,
-                                                           bucket_id=bucket_id,
-                                                           validation_step=False)
-
-            current_step = model.global_step.eval()
-
-            if summary_writer is not None:
-                summary_str = sess.run(model.summary_op)
-                summary_writer.add_summary(summary_str, current_step)
-
-            # step_loss = numpy.nan
-
-            if numpy.isnan(step_loss) or numpy.isinf(step_loss):
+        # snapshots the variables and writes the checkpoints in a background thread
+        checkpoints = CheckpointManager(tf.all_variables(), FLAGS.train_dir, FLAGS.best_models_dir,
+                                        FLAGS.model_name, keep_last=FLAGS.keep_checkpoints,
+                                        keep_best=FLAGS.keep_best_checkpoints,
+                                        asynchronous=FLAGS.async_checkpoints)
+
+        try:
+            scheduler = None
+            if FLAGS.start_decay == 0:
+                # no fixed decay epochs: warmup, then the learning rate follows the validation loss
+                scheduler = schedule_ops.PlateauScheduler(model, FLAGS.learning_rate, patience=FLAGS.lr_rate_patience,
+                                                          factor=FLAGS.lr_reduce_factor,
+                                                          min_lr=FLAGS.min_learning_rate,
+                                                          warmup_steps=FLAGS.lr_warmup_steps)
+                scheduler.step(sess, model.global_step.eval() + 1)
+
+            if FLAGS.external_validation:
+                # training (re)started: the evaluator must keep watching for checkpoints, and an early
+                # stop signalled to a previous run does not apply to this one
+                eval_ops.mark_training_finished(FLAGS.train_dir, finished=False)
+                eval_ops.reset_early_stop(FLAGS.train_dir)
+
+                # the scheduler is fed the validation losses the evaluator records from now on
+                _, results_offset = eval_ops.read_validation_results(FLAGS.train_dir)
+
+            if save_before_training:
+                # Save checkpoint
+                checkpoints.save(sess, model.global_step.eval())
+
+            # tf.train.write_graph(sess.graph_def, '/home/gian/train2', 'graph.pbtxt')
+
+            # Read data into buckets and compute their sizes.
+            print('Reading development and training data (limit: %d).' % FLAGS.max_train_data_size)
+            dev_set = read_nmt_data(src_dev, tgt_dev, FLAGS=FLAGS, buckets=buckets)
+            candidates = None
+            if FLAGS.target_candidates > 0:
+                # each batch is taken from a single partition and shares its target candidate set
+                train_set, candidates = read_nmt_data(src_train, tgt_train, max_size=FLAGS.max_train_data_size,
+                                                      FLAGS=FLAGS, buckets=buckets,
+                                                      candidate_size=FLAGS.target_candidates)
+                train_partitions = data_utils.group_by_partition(train_set)
+            else:
+                train_set = read_nmt_data(src_train, tgt_train, max_size=FLAGS.max_train_data_size, FLAGS=FLAGS,
+                                          buckets=buckets)
+            train_bucket_sizes = [len(train_set[b]) for b in xrange(len(buckets))]
+            train_total_size = float(sum(train_bucket_sizes))
+
+            print("Total number of steps per epoch: %d" % (train_total_size / FLAGS.batch_size))
+
+            # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
+            # to select a bucket. Length of [scale[i], scale[i+1]] is proportional to
+            # the size if i-th training bucket, as used later.
+            train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
+                                   for i in xrange(len(train_bucket_sizes))]
+
+            # This is the training loop.
+            telemetry_file = os.path.join(FLAGS.train_dir, FLAGS.telemetry_file) if FLAGS.telemetry_file else None
+            prometheus_file = FLAGS.prometheus_file if FLAGS.prometheus_file else None
+            telemetry = telemetry_ops.TrainingTelemetry(jsonl_path=telemetry_file, prometheus_path=prometheus_file)
+
+            summary_writer = None
+            if FLAGS.log_tensorboard:
+                summary_writer = tf.train.SummaryWriter(FLAGS.train_dir, sess.graph_def)
+
+            print("Optimization started...")
+            while model.epoch.eval() < FLAGS.max_epochs:
+
+                with telemetry.phase(telemetry_ops.FETCH):
+                    # Choose a bucket according to data distribution. We pick a random number
+                    # in [0, 1] and use the corresponding interval in train_buckets_scale.
+                    random_number_01 = numpy.random.random_sample()
+                    bucket_id = min([i for i in xrange(len(train_buckets_scale))
+                                     if train_buckets_scale[i] > random_number_01])
+
+                with telemetry.phase(telemetry_ops.BATCH):
+                    # Get a batch and make a step.
+                    if candidates is not None:
+                        # pick the partition of a random pair, so partitions are chosen by their size
+                        partition = random.choice(train_set[bucket_id])[2]
+                        target_candidates = candidates[partition]
+                        encoder_inputs, decoder_inputs, target_weights, _, source_lengths = model.get_train_batch(
+                            train_partitions, bucket_id, partition=partition
+                        )
+                    else:
+                        target_candidates = None
+                        encoder_inputs, decoder_inputs, target_weights, _, source_lengths = model.get_train_batch(
+                            train_set, bucket_id
+                        )
 
-                numpy.set_printoptions(linewidth=200)
+                telemetry.add_batch(bucket_id, encoder_inputs, target_weights)
 
-                print('\nNaN detected\n')
-                nan_detected = True
+                with telemetry.phase(telemetry_ops.RUN):
+                    # session, encoder_inputs, decoder_inputs, target_weights, bucket_id
+                    # note: step loss is averaged across the batch
+                    gradient_norm, step_loss, _ = model.train_step(session=sess, encoder_inputs=encoder_inputs,
+                                                                   decoder_inputs=decoder_inputs,
+                                                                   target_weights=target_weights,
+                                                                   bucket_id=bucket_id,
+                                                                   validation_step=False,
+                                                                   source_lengths=source_lengths,
+                                                                   target_candidates=target_candidates)
 
-                print("\nStep loss:")
-                print(step_loss)
+                bookkeeping_start = time.time()
 
-                print("\nEncoder inputs: ")
-                print(encoder_inputs)
+                current_step = model.global_step.eval()
 
-                print("\nDecoder inputs: ")
-                print(decoder_inputs)
+                if summary_writer is not None:
+                    summary_str = sess.run(model.summary_op)
+                    summary_writer.add_summary(summary_str, current_step)
 
-                print("\nTarget weights inputs: ")
-                print(target_weights)
+                # step_loss = numpy.nan
 
-                print("\nGradient norm: ")
-                print(gradient_norm)
+                if numpy.isnan(step_loss) or numpy.isinf(step_loss):
 
-                break
+                    numpy.set_printoptions(linewidth=200)
 
-            currloss = model.current_loss.eval()
-            sess.run(model.current_loss.assign(currloss + step_loss))
+                    print('\nNaN detected\n')
+                    nan_detected = True
 
-            # increase the number of seen samples
-            sess.run(model.samples_seen_update_op)
+                    print("\nStep loss:")
+                    print(step_loss)
 
-            if current_step % FLAGS.steps_verbosity == 0:
+                    print("\nEncoder inputs: ")
+                    print(encoder_inputs)
 
-                closs = model.current_loss.eval()
-                gstep = model.global_step.eval()
-                avgloss = closs / gstep
-                sess.run(model.avg_loss.assign(avgloss))
+                    print("\nDecoder inputs: ")
+                    print(decoder_inputs)
 
-                target_words_speed = n_target_words / words_time
+                    print("\nTarget weights inputs: ")
+                    print(target_weights)
 
-                loss = model.avg_loss.eval()
-                ppx = math.exp(loss) if loss < 300 else float('inf')
+                    print("\nGradient norm: ")
+                    print(gradient_norm)
 
-                if ppx > 1000.0:
-                    print(
-                    'epoch %d gl.step %d lr.rate %.4f steps-time %.2f avg.loss %.8f avg.ppx > %.8f - avg. %.2f K target words/sec' %
-                    (model.epoch.eval(), model.global_step.eval(), model.learning_rate.eval(),
-                     step_time, loss, 1000.0, (target_words_speed / 1000.0)))
-                else:
-                    print(
-                    'epoch %d gl.step %d lr.rate %.4f steps-time %.2f avg.loss %.8f avg.ppx %.8f - avg. %.2f K target words/sec' %
-                    (model.epoch.eval(), model.global_step.eval(), model.learning_rate.eval(),
-                     step_time, loss, ppx, (target_words_speed / 1000.0)))
+                    break
 
-                n_target_words = 0
-                step_time = 0.0
-                words_time = 0.0
+                currloss = model.current_loss.eval()
+                sess.run(model.current_loss.assign(currloss + step_loss))
 
-            # Once in a while, we save checkpoint, print statistics, and run evals.
-            if current_step % FLAGS.steps_per_checkpoint == 0:
-                # Save checkpoint
-                checkpoint_path = os.path.join(FLAGS.train_dir, FLAGS.model_name)
-                model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-                saved = True
+                # increase the number of seen samples
+                sess.run(model.samples_seen_update_op)
 
-                # update epoch number
-            if model.samples_seen.eval() >= train_total_size:
-                sess.run(model.epoch_update_op)
-                ep = model.epoch.eval()
-                print("Epoch %d finished..." % (ep - 1))
+                if scheduler is not None:
+                    # learning rate of the next step (only changes during warmup)
+                    scheduler.step(sess, current_step + 1)
 
-                # Save checkpoint
-                checkpoint_path = os.path.join(FLAGS.train_dir, FLAGS.model_name)
-                model.saver.save(sess, checkpoint_path, global_step=model.global_step)
+                telemetry.phase_time[telemetry_ops.BOOKKEEPING] += time.time() - bookkeeping_start
 
-                if ep >= FLAGS.max_epochs:
-                    if not saved:
+                # Once in a while, we save checkpoint, print statistics, and run evals.
+                if current_step % FLAGS.steps_per_checkpoint == 0:
+                    with telemetry.phase(telemetry_ops.CHECKPOINT):
                         # Save checkpoint
-                        checkpoint_path = os.path.join(FLAGS.train_dir, FLAGS.model_name)
-                        model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-                    finished = True
-                    break
+                        checkpoints.save(sess, current_step)
 
-                print("Epoch %d started..." % ep)
-                sess.run(model.samples_seen_reset_op)
+                    # update epoch number
+                if model.samples_seen.eval() >= train_total_size:
+                    sess.run(model.epoch_update_op)
+                    ep = model.epoch.eval()
+                    print("Epoch %d finished..." % (ep - 1))
 
-                if FLAGS.start_decay > 0:
+                    with telemetry.phase(telemetry_ops.CHECKPOINT):
+                        # Save checkpoint - skipped if this step was already saved above
+                        checkpoints.save(sess, current_step)
 
-                    if FLAGS.stop_decay > 0:
+                    if ep >= FLAGS.max_epochs:
+                        finished = True
+                        break
 
-                        if FLAGS.start_decay <= model.epoch.eval() <= FLAGS.stop_decay:
-                            sess.run(model.learning_rate_decay_op)
+                    print("Epoch %d started..." % ep)
+                    sess.run(model.samples_seen_reset_op)
 
-                    else:
+                    if FLAGS.start_decay > 0:
 
-                        if FLAGS.start_decay <= model.epoch.eval():
-                            sess.run(model.learning_rate_decay_op)
+                        if FLAGS.stop_decay > 0:
 
-            if current_step % FLAGS.steps_per_validation == 0:
+                            if FLAGS.start_decay <= model.epoch.eval() <= FLAGS.stop_decay:
+                                sess.run(model.learning_rate_decay_op)
 
-                total_eval_loss = 0.0
-                total_ppx = 0.0
+                        else:
 
-                print('\n')
+                            if FLAGS.start_decay <= model.epoch.eval():
+                                sess.run(model.learning_rate_decay_op)
 
-                # Run evals on development set and print their perplexity.
-                for bucket_id in xrange(len(buckets)):
+                if FLAGS.external_validation and current_step % FLAGS.steps_per_validation == 0:
 
-                    n_steps = len(dev_set[bucket_id]) / model.batch_size
+                    # validation, best model promotion and early stop are handled by the evaluator
+                    # process (see eval_ops.watch_checkpoints) - we only check if it asked us to stop
+                    # and feed the losses of the checkpoints it evaluated meanwhile to the scheduler
+                    if scheduler is not None:
+                        records, results_offset = eval_ops.read_validation_results(FLAGS.train_dir,
+                                                                                   results_offset)
+                        for record in records:
+                            scheduler.validate(sess, record['global_step'], record['loss'])
 
-                    bucket_loss = 0.0
+                    if eval_ops.early_stop_requested(FLAGS.train_dir):
+                        print('\nEARLY STOP! (requested by the evaluator)\n')
+                        finished = True
+                        break
 
-                    for _ in xrange(n_steps):
-                        encoder_inputs, decoder_inputs, target_weights, _ = model.get_train_batch(dev_set,
-                                                                                                  bucket_id)
+                elif current_step % FLAGS.steps_per_validation == 0:
 
-                        _, eval_loss, _ = model.train_step(session=sess, encoder_inputs=encoder_inputs,
-                                                           decoder_inputs=decoder_inputs, target_weights=target_weights,
-                                                           bucket_id=bucket_id, validation_step=True)
+                    with telemetry.phase(telemetry_ops.VALIDATION):
+                        avg_eval_loss, _ = evaluate_nmt(sess, model, dev_set, buckets)
 
-                        bucket_loss += eval_loss
+                    if scheduler is not None:
+                        scheduler.validate(sess, current_step, avg_eval_loss)
 
-                    bucket_avg_loss = bucket_loss / n_steps
-                    total_eval_loss += bucket_avg_loss
+                    estop = FLAGS.early_stop_patience
 
-                    eval_ppx = math.exp(bucket_avg_loss) if eval_loss < 300 else float('inf')
-                    total_ppx += eval_ppx
-                    print('  eval: bucket %d perplexity %.4f' % (bucket_id, eval_ppx))
+                    # check early stop - if early stop patience is greater than 0, test it
+                    if estop > 0:
 
-                avg_eval_loss = total_eval_loss / len(buckets)
-                avg_ppx = math.exp(avg_eval_loss) if avg_eval_loss < 300 else float('inf')
+                        if avg_eval_loss < model.best_eval_loss.eval():
+                            sess.run(model.best_eval_loss.assign(avg_eval_loss))
+                            sess.run(model.estop_counter_reset_op)
+                            # Save checkpoint
+                            print('Saving the best model so far...')
+                            with telemetry.phase(telemetry_ops.CHECKPOINT):
+                                checkpoints.save(sess, current_step, best=True)
 
-                if avg_ppx > 1000.0:
-                    print('\n  eval: averaged perplexity > 1000.0')
-                else:
-                    print('\n  eval: averaged perplexity %.8f' % avg_ppx)
-                print('  eval: averaged loss %.8f\n' % avg_eval_loss)
+                        else:
 
-                sys.stdout.flush()
+                            # if FLAGS.early_stop_after_epoch is equal to 0, it will monitor from the beginning
+                            if model.epoch.eval() >= FLAGS.early_stop_after_epoch:
 
-                estop = FLAGS.early_stop_patience
+                                sess.run(model.estop_counter_update_op)
 
-                # check early stop - if early stop patience is greater than 0, test it
-                if estop > 0:
+                                if model.estop_counter.eval() >= estop:
+                                    print('\nEARLY STOP!\n')
+                                    finished = True
+                                    break
 
-                    if avg_eval_loss < model.best_eval_loss.eval():
-                        sess.run(model.best_eval_loss.assign(avg_eval_loss))
-                        sess.run(model.estop_counter_reset_op)
-                        # Save checkpoint
-                        print('Saving the best model so far...')
-                        best_model_path = os.path.join(FLAGS.best_models_dir, FLAGS.model_name + '-best')
-                        model.saver_best.save(sess, best_model_path, global_step=model.global_step)
+                        print('\n   best valid. loss: %.8f' % model.best_eval_loss.eval())
+                        print('early stop patience: %d - max %d\n' % (int(model.estop_counter.eval()), estop))
 
-                    else:
-
-                        # if FLAGS.early_stop_after_epoch is equal to 0, it will monitor from the beginning
-                        if model.epoch.eval() >= FLAGS.early_stop_after_epoch:
-
-                            sess.run(model.estop_counter_update_op)
-
-                            if model.estop_counter.eval() >= estop:
-                                print('\nEARLY STOP!\n')
-                                finished = True
-                                break
-
-                    print('\n   best valid. loss: %.8f' % model.best_eval_loss.eval())
-                    print('early stop patience: %d - max %d\n' % (int(model.estop_counter.eval()), estop))
+                if current_step % FLAGS.steps_verbosity == 0:
 
-            step_time += (time.time() - start_time) / FLAGS.steps_verbosity
-            words_time += (time.time() - start_time)
+                    closs = model.current_loss.eval()
+                    gstep = model.global_step.eval()
+                    avgloss = closs / gstep
+                    sess.run(model.avg_loss.assign(avgloss))
 
-        print("\nTraining finished!!\n")
+                    loss = model.avg_loss.eval()
+                    ppx = math.exp(loss) if loss < 300 else float('inf')
+                    epoch = model.epoch.eval()
+                    lr_rate = model.learning_rate.eval()
 
-        if not nan_detected:
+                    # closes the telemetry window at the end of the step, after its checkpoint and validation
+                    # phases: step_time is the average wall time of one training step of this window
+                    stats = telemetry.report(current_step, epoch=int(epoch), learning_rate=float(lr_rate),
+                                             avg_loss=float(loss))
 
-            # # Save checkpoint
-            checkpoint_path = os.path.join(FLAGS.train_dir, FLAGS.model_name)
-            model.saver.save(sess, checkpoint_path, global_step=model.global_step)
+                    phases = ' '.join(['%s %.2f' % (p, stats['phases'][p]) for p in telemetry_ops.PHASES])
 
-            print("Final validation:")
+                    if ppx > 1000.0:
+                        print(
+                        'epoch %d gl.step %d lr.rate %.4f step-time %.3f avg.loss %.8f avg.ppx > %.8f - avg. %.2f K target words/sec' %
+                        (epoch, current_step, lr_rate, stats['step_time'], loss, 1000.0,
+                         (stats['tgt_tokens_per_sec'] / 1000.0)))
+                    else:
+                        print(
+                        'epoch %d gl.step %d lr.rate %.4f step-time %.3f avg.loss %.8f avg.ppx %.8f - avg. %.2f K target words/sec' %
+                        (epoch, current_step, lr_rate, stats['step_time'], loss, ppx,
+                         (stats['tgt_tokens_per_sec'] / 1000.0)))
 
-            total_eval_loss = 0.0
-            total_ppx = 0.0
+                    print('  phases (sec): %s - rss %.1f MB' % (phases, stats['rss_bytes'] / (1024.0 * 1024.0)))
 
-            print('\n')
+            telemetry.close()
 
-            # Run evals on development set and print their perplexity.
-            for bucket_id in xrange(len(buckets)):
+            print("\nTraining finished!!\n")
 
-                n_steps = len(dev_set[bucket_id]) / model.batch_size
+            if not nan_detected:
 
-                bucket_loss = 0.0
+                # # Save checkpoint
+                checkpoints.save(sess, model.global_step.eval())
 
-                for _ in xrange(n_steps):
-                    encoder_inputs, decoder_inputs, target_weights, _ = model.get_train_batch(dev_set,
-                                                                                              bucket_id)
+                if FLAGS.external_validation:
 
-                    _, eval_loss, _ = model.train_step(session=sess, encoder_inputs=encoder_inputs,
-                                                       decoder_inputs=decoder_inputs, target_weights=target_weights,
-                                                       bucket_id=bucket_id)
+                    print("Final validation is left to the evaluator.")
 
-                    bucket_loss += eval_loss
+                else:
 
-                bucket_avg_loss = bucket_loss / n_steps
-                total_eval_loss += bucket_avg_loss
+                    print("Final validation:")
 
-                eval_ppx = math.exp(bucket_avg_loss) if eval_loss < 300 else float('inf')
-                total_ppx += eval_ppx
-                print('  eval: bucket %d perplexity %.4f' % (bucket_id, eval_ppx))
+                    evaluate_nmt(sess, model, dev_set, buckets)
 
-            avg_eval_loss = total_eval_loss / len(buckets)
-            avg_ppx = math.exp(avg_eval_loss) if avg_eval_loss < 300 else float('inf')
+                    print('\n   best valid. loss during training: %.8f' % model.best_eval_loss.eval())
 
-            if avg_ppx > 1000.0:
-                print('\n  eval: averaged perplexity > 1000.0')
-            else:
-                print('\n  eval: averaged perplexity %.8f' % avg_ppx)
-            print('  eval: averaged loss %.8f\n' % avg_eval_loss)
+                sys.stdout.flush()
 
-            print('\n   best valid. loss during training: %.8f' % model.best_eval_loss.eval())
+        finally:
+            # make sure every pending checkpoint is written before leaving the session, also when
+            # training is interrupted - the writer is a daemon thread
+            checkpoints.close()
 
-            sys.stdout.flush()
+        if FLAGS.external_validation:
+            # the evaluator exits once it has seen the last checkpoint
+            eval_ops.mark_training_finished(FLAGS.train_dir)
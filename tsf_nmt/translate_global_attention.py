@@ -36,8 +36,10 @@ import content_functions
 import attention
 import nmt_models
 import decoders
+from eval_ops import watch_checkpoints
+from session_ops import autotune_threads
 from train_ops import train_nmt
-from translate_ops import decode_from_stdin, decode_from_file
+from translate_ops import decode_from_stdin, decode_from_file, decode_from_server
 
 flags = tf.flags
 
@@ -49,15 +51,33 @@ flags.DEFINE_float('learning_rate_decay_factor', 1.0, 'Learning rate decays by t
 flags.DEFINE_integer('start_decay', 0, 'Start learning rate decay at this epoch. Set to 0 to use patience.')
 flags.DEFINE_integer('stop_decay', 0, 'Stop learning rate decay at this epoch. Set to 0 to use patience.')
 flags.DEFINE_string('optimizer', 'adam', 'Name of the optimizer to use (adagrad, adam, rmsprop or sgd')
+flags.DEFINE_boolean('sparse_updates', False, 'Whether to deduplicate the sparse (embedding) gradients and, with adam, update only the slot rows they touch.')
 
 flags.DEFINE_float('max_gradient_norm', 5.0, 'Clip gradients to this norm.')
 flags.DEFINE_integer('batch_size', 32, 'Batch size to use during training.')
 flags.DEFINE_integer('beam_size', 12, 'Max size of the beam used for decoding.')
+flags.DEFINE_integer('decode_batch_size', 1, 'Number of sentences of a file translated at once by the batched beam search.')
+flags.DEFINE_integer('decode_workers', 1, 'Number of processes translating the chunks of a file in parallel, each with its own copy of the model.')
+flags.DEFINE_integer('decode_chunk_size', 100, 'Number of lines of a file handed at once to a decoding worker.')
+flags.DEFINE_boolean('sort_by_length', False, 'Whether to batch the sentences of a file by source length when translating it (the output keeps the order of the file).')
+flags.DEFINE_integer('sort_window', 100000, 'Maximum number of sentences of a file read and sorted by length at once (0: the whole file).')
+flags.DEFINE_boolean('greedy_decoding', False, 'Whether to translate with a batched greedy search (best word of each step) instead of the beam search.')
+flags.DEFINE_boolean('beam_early_stop', False, 'Whether to stop the beam search of a sentence when none of its live hypotheses can beat its best finished one (same best translation, but not the same n-best list).')
+flags.DEFINE_boolean('check_early_stop', False, 'Whether to translate the files also without early stopping and report the sentences whose best translation differs.')
+flags.DEFINE_float('beam_length_ratio', 0.0, 'If > 0, early stopping assumes translations are at most this ratio of the source length, instead of max_len (faster, not exact).')
+flags.DEFINE_integer('shortlist_top_k', 0, 'Number of translations of each source word in the target vocabulary shortlist of a sentence (0: decode over the whole target vocabulary).')
+flags.DEFINE_integer('shortlist_frequent', 100, 'Number of most frequent target words always in the shortlist.')
+flags.DEFINE_string('shortlist_file', 'lexical_table.json', 'File in train_dir with the lexical table of the shortlists (built from the training data if missing).')
+flags.DEFINE_integer('translation_cache_size', 0, 'Number of translations kept in memory to skip the decoding of repeated sentences (0: no memory cache).')
+flags.DEFINE_string('translation_cache_file', '', 'File in train_dir with the on-disk translation cache, kept across runs (empty: no disk cache).')
 flags.DEFINE_integer('num_samples_loss', 512, 'Number of samples to use in sampled softmax. Set to 0 to use regular loss.')
+flags.DEFINE_integer('target_candidates', 0, 'Size of the target candidate set of each corpus partition (Jean et al., 2015). Set to 0 to disable it.')
+flags.DEFINE_boolean('fused_loss', False, 'Whether to project the non-padded decoder outputs of a bucket and compute their loss at once (regular loss only).')
 flags.DEFINE_integer('max_len', 120, 'Max size of the beam used for decoding.')
 flags.DEFINE_integer('max_epochs', 20,  'Max number of epochs to use during training. The actual value will be (max_epochs-1) as it is 0-based.')
 flags.DEFINE_integer('max_train_data_size', 0, 'Limit on the size of training data (0: no limit).')
 flags.DEFINE_boolean('cpu_only', False, 'Whether or not to use GPU only.')
+flags.DEFINE_boolean('lazy_buckets', False, 'Whether to build the graph of each bucket only the first time it is used.')
 
 # flags related to model architecture
 flags.DEFINE_string('model', 'seq2seq', 'one of these models: seq2seq')
@@ -68,6 +88,7 @@ flags.DEFINE_boolean('use_lstm', False, 'Whether to use LSTM units. Default to F
 flags.DEFINE_boolean('input_feeding', False, 'Whether to input the attention states as part of input to the decoder at each timestep. Default to False.')
 flags.DEFINE_boolean('informed_decoder', True, 'Whether to use the previous word embedding info to the softmax. Default to False.')
 flags.DEFINE_string('output_attention', content_functions.DECODER_TYPE_2, 'Whether to pay attention on the decoder outputs. Default to False.')
+flags.DEFINE_boolean('dynamic_decoder', False, 'Whether to run the decoder time steps with a while loop instead of unrolling them for every bucket.')
 flags.DEFINE_integer('proj_size', 500, 'Size of words projection.')
 flags.DEFINE_integer('hidden_size', 500, 'Size of each layer.')
 flags.DEFINE_integer('num_layers', 1, 'Number of layers in each component of the model.')
@@ -93,19 +114,47 @@ flags.DEFINE_string('target_lang', 'pt', 'Target language extension.')
 
 # verbosity and checkpoints
 flags.DEFINE_integer('steps_per_checkpoint', 500, 'How many training steps to do per checkpoint.')
+flags.DEFINE_integer('keep_checkpoints', 5, 'How many of the most recent checkpoints to keep in train_dir.')
+flags.DEFINE_integer('keep_best_checkpoints', 5, 'How many of the best model checkpoints to keep in best_models_dir.')
+flags.DEFINE_boolean('async_checkpoints', True, 'Whether to write the checkpoints from a background thread while training continues.')
 flags.DEFINE_integer('steps_per_validation', 1000, 'How many training steps to do between each validation.')
 flags.DEFINE_integer('steps_verbosity', 10, 'How many training steps to do between each information print.')
 flags.DEFINE_boolean('log_tensorboard', False, 'Whether or not to use Tensorboard to log info about training. Default to False.')
+flags.DEFINE_string('telemetry_file', 'telemetry.jsonl', 'File (inside train_dir) where per-phase timings and throughput are written as JSON lines. Empty to disable.')
+flags.DEFINE_string('prometheus_file', '', 'Prometheus textfile where the training telemetry is exported. Empty to disable.')
+flags.DEFINE_integer('trace_every', 0, 'Write an execution trace for one in every N train/decode steps. Set to 0 to turn tracing off.')
+flags.DEFINE_string('trace_dir', '', 'Directory for the execution traces and the op summary. Default to train_dir/traces.')
 
 # pacience flags (learning_rate decay and early stop)
-flags.DEFINE_integer('lr_rate_patience', 3, 'How many training steps to monitor.')
+flags.DEFINE_integer('lr_rate_patience', 3, 'How many validations without improvement before reducing the learning rate (when start_decay is 0).')
+flags.DEFINE_float('lr_reduce_factor', 0.5, 'The learning rate is multiplied by this factor when the validation loss stops improving (when start_decay is 0).')
+flags.DEFINE_integer('lr_warmup_steps', 0, 'Number of steps over which the learning rate grows linearly up to its value (when start_decay is 0).')
+flags.DEFINE_float('min_learning_rate', 0.0, 'The learning rate is never reduced below this value.')
 flags.DEFINE_integer('early_stop_patience', 20, 'How many training steps to monitor.')
 flags.DEFINE_integer('early_stop_after_epoch', 20, 'Start monitoring early_stop after this epoch.')
 flags.DEFINE_boolean('save_best_model', True, 'Set to True to save the best model even if not using early stop.')
 
+# out-of-band validation (run a second process with --evaluator to watch train_dir)
+flags.DEFINE_boolean('external_validation', False, 'Set to True to leave validation, best model saving and early stop to a separate evaluator process.')
+flags.DEFINE_boolean('evaluator', False, 'Set to True to run as the evaluator that validates every new checkpoint in train_dir.')
+flags.DEFINE_integer('eval_batch_size', 128, 'Batch size used by the evaluator.')
+flags.DEFINE_integer('eval_poll_secs', 60, 'How many seconds the evaluator waits between checks for new checkpoints.')
+
+# session threading (0 uses the setting tuned for this host with --autotune, if any, or tensorflow's default)
+flags.DEFINE_integer('intra_op_threads', 0, 'Number of threads used inside each op (0 for the tuned/default value).')
+flags.DEFINE_integer('inter_op_threads', 0, 'Number of ops run in parallel (0 for the tuned/default value).')
+flags.DEFINE_string('threads_file', 'threads.json', 'File in train_dir where the tuned thread settings are kept.')
+flags.DEFINE_boolean('autotune', False, 'Set to True to benchmark the thread settings for this host and save the best ones.')
+flags.DEFINE_integer('autotune_steps', 20, 'Number of training steps timed for each thread setting.')
+
 # decoding/testing flags
 flags.DEFINE_boolean('decode_file', False, 'Set to True for decoding sentences in a file.')
 flags.DEFINE_boolean('decode_input', False, 'Set to True for interactive decoding.')
+flags.DEFINE_boolean('decode_server', False, 'Set to True to serve translations over HTTP, decoding the requests in micro-batches.')
+flags.DEFINE_string('server_host', '127.0.0.1', 'Address the translation server listens on.')
+flags.DEFINE_integer('server_port', 8080, 'Port the translation server listens on.')
+flags.DEFINE_integer('server_batch_size', 16, 'Maximum number of requests translated in one micro-batch.')
+flags.DEFINE_integer('server_max_wait', 10, 'Maximum time (milliseconds) the first request of a micro-batch waits for others.')
 
 FLAGS = flags.FLAGS
 
@@ -129,6 +178,15 @@ def main(_):
                          model_path=model_path, use_best=True, FLAGS=FLAGS,
                          buckets=_buckets)
 
+    elif FLAGS.decode_server:
+        decode_from_server(FLAGS=FLAGS, buckets=_buckets)
+
+    elif FLAGS.evaluator:
+        watch_checkpoints(FLAGS=FLAGS, buckets=_buckets)
+
+    elif FLAGS.autotune:
+        autotune_threads(FLAGS=FLAGS, buckets=_buckets)
+
     else:
         train_nmt(FLAGS=FLAGS, buckets=_buckets)
 
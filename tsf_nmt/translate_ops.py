@@ -1,22 +1,181 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
+import multiprocessing
 import numpy
+import os
 import tensorflow as tf
 import sys
 import time
 from tensorflow.python.platform import gfile
 
+import cache_ops
 import data_utils
+import server_ops
+import session_ops
+import shortlist_ops
 from build_ops import create_seq2seq_model
 
 
+def _load_vocabularies(FLAGS):
+    source_vocab_file = FLAGS.data_dir + \
+                        (FLAGS.train_data % str(FLAGS.src_vocab_size)) + \
+                        ('.vocab.%s' % FLAGS.source_lang)
+
+    target_vocab_file = FLAGS.data_dir + \
+                        (FLAGS.train_data % str(FLAGS.tgt_vocab_size)) + \
+                        ('.vocab.%s' % FLAGS.target_lang)
+
+    src_vocab, _ = data_utils.initialize_vocabulary(source_vocab_file)
+    _, rev_tgt_vocab = data_utils.initialize_vocabulary(target_vocab_file)
+
+    return src_vocab, rev_tgt_vocab
+
+
+def _batch_translations(sess, model, batch_token_ids, lexical_table, FLAGS, cache=None):
+    """Translate a batch of sentences (lists of token ids) and return the pair (samples, scores) of
+    each. The sentences found in the cache are not translated again."""
+
+    # the target words the decoder may output for each sentence
+    shortlists = [None] * len(batch_token_ids)
+    if lexical_table is not None:
+        shortlists = [shortlist_ops.sentence_shortlist(lexical_table, token_ids, min_size=FLAGS.beam_size)
+                      for token_ids in batch_token_ids]
+
+    translations = [None] * len(batch_token_ids)
+    if cache is not None:
+        translations = [cache.get(token_ids, shortlist) for token_ids, shortlist in zip(batch_token_ids, shortlists)]
+
+    missing = [i for i, translation in enumerate(translations) if translation is None]
+
+    if missing:
+        missing_token_ids = [batch_token_ids[i] for i in missing]
+        missing_shortlists = [shortlists[i] for i in missing]
+
+        shortlist = None
+        if lexical_table is not None:
+            shortlist = shortlist_ops.pad_shortlists(missing_shortlists)
+
+        # Get output logits for the sentences.
+        if FLAGS.greedy_decoding:
+            new_translations = model.greedy_translation_step(sess, missing_token_ids, normalize=True,
+                                                             shortlist=shortlist)
+        else:
+            new_translations = model.translation_batch_step(sess,
+                                                            missing_token_ids,
+                                                            FLAGS.beam_size,
+                                                            normalize=True,
+                                                            dump_remaining=True,
+                                                            shortlist=shortlist,
+                                                            early_stop=FLAGS.beam_early_stop,
+                                                            length_ratio=FLAGS.beam_length_ratio)
+
+        for i, translation in zip(missing, new_translations):
+            translations[i] = translation
+
+        if cache is not None:
+            cache.put_many(missing_token_ids, new_translations, missing_shortlists)
+
+    return translations
+
+
+def _translate_batch(sess, model, batch_token_ids, lexical_table, FLAGS, cache=None):
+    """Translate a batch of sentences (lists of token ids) and return the best translation of each."""
+    return [output_hypotheses[0] for output_hypotheses, output_scores in
+            _batch_translations(sess, model, batch_token_ids, lexical_table, FLAGS, cache=cache)]
+
+
+def _translate_sentences(sess, model, sentences_token_ids, lexical_table, FLAGS, cache=None):
+    """Translate the sentences in batches of decode_batch_size and return the best translation of
+    each, in the order of sentences_token_ids. With sort_by_length, the batches are made of
+    sentences of similar length: the encoder stops at the longest source of a batch, and the
+    beams of a batch finish at about the same step."""
+    batch_size = max(FLAGS.decode_batch_size, 1)
+
+    order = range(len(sentences_token_ids))
+    if FLAGS.sort_by_length:
+        order = sorted(order, key=lambda i: len(sentences_token_ids[i]))
+
+    translations = [None] * len(sentences_token_ids)
+    for start in xrange(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+
+        for i, outputs in zip(batch, _translate_batch(sess, model, [sentences_token_ids[i] for i in batch],
+                                                      lexical_table, FLAGS, cache=cache)):
+            translations[i] = outputs
+
+    return translations
+
+
+def check_early_stop(sess, model, sentences_token_ids, lexical_table, FLAGS):
+    """Translate the sentences with and without early stopping of the beam search and return the
+    indices of those whose best translation differs - none when the bound is exact (beam_length_ratio
+    set to 0)."""
+    batch_size = max(FLAGS.decode_batch_size, 1)
+
+    different = []
+    for start in xrange(0, len(sentences_token_ids), batch_size):
+        batch_token_ids = sentences_token_ids[start:start + batch_size]
+
+        shortlist = None
+        if lexical_table is not None:
+            shortlist = shortlist_ops.pad_shortlists(
+                [shortlist_ops.sentence_shortlist(lexical_table, token_ids, min_size=FLAGS.beam_size)
+                 for token_ids in batch_token_ids])
+
+        best = []
+        for early_stop in (False, True):
+            translations = model.translation_batch_step(sess,
+                                                        batch_token_ids,
+                                                        FLAGS.beam_size,
+                                                        normalize=True,
+                                                        dump_remaining=True,
+                                                        shortlist=shortlist,
+                                                        early_stop=early_stop,
+                                                        length_ratio=FLAGS.beam_length_ratio)
+            best.append([list(output_hypotheses[0]) for output_hypotheses, output_scores in translations])
+
+        different.extend(start + i for i, (exhaustive, stopped) in enumerate(zip(*best)) if exhaustive != stopped)
+
+    return different
+
+
+def _sentence_token_ids(sentence, src_vocab, get_ids):
+    if get_ids:
+        # Get token-ids for the input sentence.
+        return data_utils.sentence_to_token_ids(sentence, src_vocab)
+
+    # if sentence is already converted, just split the ids
+    return [int(ss) for ss in sentence.strip().split()]
+
+
+def _read_chunks(source, chunk_size):
+    """Yield (index, lines) for consecutive chunks of chunk_size lines of source (all of them if
+    chunk_size is None)."""
+    chunk_id = 0
+    lines = []
+    line = source.readline()
+    while line:
+        lines.append(line)
+        if len(lines) == chunk_size:
+            yield chunk_id, lines
+            chunk_id += 1
+            lines = []
+        line = source.readline()
+    if lines:
+        yield chunk_id, lines
+
+
 def decode_from_file(files, model_path=None, use_best=False, get_ids=True, FLAGS=None, buckets=None):
 
     assert FLAGS is not None
     assert buckets is not None
 
-    with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+    if FLAGS.decode_workers > 1:
+        return parallel_decode_from_file(files, model_path=model_path, use_best=use_best, get_ids=get_ids,
+                                         FLAGS=FLAGS, buckets=buckets)
+
+    with tf.Session(config=session_ops.get_session_config(FLAGS, session_ops.DECODE)) as sess:
 
         # load model parameters.
         model = create_seq2seq_model(sess, model_path=model_path, forward_only=True,
@@ -24,60 +183,57 @@ def decode_from_file(files, model_path=None, use_best=False, get_ids=True, FLAGS
                                      translate=True)
 
         # Load vocabularies.
-        source_vocab_file = FLAGS.data_dir + \
-                            (FLAGS.train_data % str(FLAGS.src_vocab_size)) + \
-                            ('.vocab.%s' % FLAGS.source_lang)
+        src_vocab, rev_tgt_vocab = _load_vocabularies(FLAGS)
 
-        target_vocab_file = FLAGS.data_dir + \
-                            (FLAGS.train_data % str(FLAGS.tgt_vocab_size)) + \
-                            ('.vocab.%s' % FLAGS.target_lang)
+        lexical_table = shortlist_ops.get_lexical_table(FLAGS) if FLAGS.shortlist_top_k > 0 else None
 
-        src_vocab, _ = data_utils.initialize_vocabulary(source_vocab_file)
-        _, rev_tgt_vocab = data_utils.initialize_vocabulary(target_vocab_file)
+        cache = cache_ops.get_translation_cache(model, FLAGS)
 
         start_total_time = time.time()
         total_sentence_count = 0
 
+        # sentences compared with check_early_stop, and those whose best translation differs
+        checked_count, different_count = 0, 0
+
         for file_path in files:
 
             print("Translating file %s\n" % file_path)
 
             sentence_count = 0
 
+            # read decode_batch_size sentences and translate them at once - when sorting them by
+            # length, read windows of sort_window sentences (0: the whole file)
+            window_size = max(FLAGS.decode_batch_size, 1)
+            if FLAGS.sort_by_length:
+                window_size = FLAGS.sort_window if FLAGS.sort_window > 0 else None
+
             # Decode from file.
             with gfile.GFile(file_path, mode='r') as source:
                 with gfile.GFile(file_path + '.trans', mode='w') as destiny:
-                    sentence = source.readline()
 
                     start_time = time.time()
-                    while sentence:
-
-                        sentence_count += 1
-                        print("Translating sentence %d ", sentence_count)
+                    for _, lines in _read_chunks(source, window_size):
 
-                        if get_ids:
+                        print("Translating sentences %d to %d" % (sentence_count + 1, sentence_count + len(lines)))
+                        sentence_count += len(lines)
 
-                            # Get token-ids for the input sentence.
-                            token_ids = data_utils.sentence_to_token_ids(sentence, src_vocab)
+                        sentences_token_ids = [_sentence_token_ids(sentence, src_vocab, get_ids) for sentence in lines]
 
-                        else:
+                        if FLAGS.check_early_stop and not FLAGS.greedy_decoding:
+                            different = check_early_stop(sess, model, sentences_token_ids, lexical_table, FLAGS)
+                            for i in different:
+                                print("Early stopping changed the best translation of sentence %d"
+                                      % (sentence_count - len(lines) + i + 1))
+                            checked_count += len(sentences_token_ids)
+                            different_count += len(different)
 
-                            # if sentence is already converted, just split the ids
-                            token_ids = [int(ss) for ss in sentence.strip().split()]
+                        # the translations come back in the order of the file
+                        for outputs in _translate_sentences(sess, model, sentences_token_ids, lexical_table, FLAGS,
+                                                            cache=cache):
 
-                        # Get output logits for the sentence.
-                        output_hypotheses, output_scores = model.translation_step(sess,
-                                                                                  token_ids,
-                                                                                  FLAGS.beam_size,
-                                                                                  normalize=True,
-                                                                                  dump_remaining=True)
-
-                        outputs = output_hypotheses[0]
-
-                        # Print out sentence corresponding to outputs.
-                        destiny.write(" ".join([rev_tgt_vocab[output] for output in outputs]))
-                        destiny.write("\n")
-                        sentence = source.readline()
+                            # Print out sentence corresponding to outputs.
+                            destiny.write(" ".join([rev_tgt_vocab[output] for output in outputs]))
+                            destiny.write("\n")
 
                     end_time = time.time() - start_time
 
@@ -91,6 +247,141 @@ def decode_from_file(files, model_path=None, use_best=False, get_ids=True, FLAGS
         print("\nDone!")
         print("Avg. %.3f sentences/sec" % (total_sentence_count / end_total_time))
 
+        if checked_count > 0:
+            print("Early stopping: %d of %d best translations differ from the exhaustive search" %
+                  (different_count, checked_count))
+
+        if cache is not None:
+            print(cache.report())
+            cache.close()
+
+
+# state of a decoding worker process, set once by _init_decode_worker
+_worker = {}
+
+
+def _init_decode_worker(model_path, use_best, get_ids, FLAGS, buckets, n_workers):
+
+    config = session_ops.get_session_config(FLAGS, session_ops.DECODE)
+    if config.intra_op_parallelism_threads == 0:
+        # the cores are shared by the workers
+        config.intra_op_parallelism_threads = max(1, multiprocessing.cpu_count() // n_workers)
+
+    sess = tf.Session(config=config)
+
+    # each worker restores its own copy of the model
+    model = create_seq2seq_model(sess, model_path=model_path, forward_only=True,
+                                 use_best=use_best, FLAGS=FLAGS, buckets=buckets,
+                                 translate=True)
+
+    src_vocab, rev_tgt_vocab = _load_vocabularies(FLAGS)
+
+    _worker.update(sess=sess, model=model, src_vocab=src_vocab, rev_tgt_vocab=rev_tgt_vocab,
+                   lexical_table=shortlist_ops.get_lexical_table(FLAGS) if FLAGS.shortlist_top_k > 0 else None,
+                   cache=cache_ops.get_translation_cache(model, FLAGS),
+                   get_ids=get_ids, FLAGS=FLAGS)
+
+
+def _decode_chunk(chunk):
+    """Translate a chunk of lines in a worker. Returns (chunk index, worker pid, translations, seconds,
+    cache lookups, cache hits)."""
+    chunk_id, lines = chunk
+    FLAGS = _worker['FLAGS']
+    cache = _worker['cache']
+
+    lookups, hits = (cache.lookups, cache.hits) if cache is not None else (0, 0)
+
+    start_time = time.time()
+
+    sentences_token_ids = [_sentence_token_ids(sentence, _worker['src_vocab'], _worker['get_ids'])
+                           for sentence in lines]
+
+    translations = []
+    for outputs in _translate_sentences(_worker['sess'], _worker['model'], sentences_token_ids,
+                                        _worker['lexical_table'], FLAGS, cache=cache):
+        translations.append(" ".join([_worker['rev_tgt_vocab'][output] for output in outputs]))
+
+    if cache is not None:
+        lookups, hits = cache.lookups - lookups, cache.hits - hits
+
+    return chunk_id, os.getpid(), translations, time.time() - start_time, lookups, hits
+
+
+def parallel_decode_from_file(files, model_path=None, use_best=False, get_ids=True, FLAGS=None, buckets=None):
+    """Translate the files with decode_workers processes, each with its own session and restored
+    model. The lines of a file are split in chunks of decode_chunk_size lines handed to the
+    workers; the translations are written to file_path + '.trans' in the input order.
+
+    The workers are forked with the flags, so this must be called before any session is created
+    in this process.
+    """
+
+    assert FLAGS is not None
+    assert buckets is not None
+
+    n_workers = FLAGS.decode_workers
+
+    pool = multiprocessing.Pool(n_workers, initializer=_init_decode_worker,
+                                initargs=(model_path, use_best, get_ids, FLAGS, buckets, n_workers))
+
+    # pid -> [sentences, seconds spent translating, cache lookups, cache hits]
+    worker_stats = {}
+
+    start_total_time = time.time()
+    total_sentence_count = 0
+
+    try:
+        for file_path in files:
+
+            print("Translating file %s with %d workers\n" % (file_path, n_workers))
+
+            sentence_count = 0
+
+            with gfile.GFile(file_path, mode='r') as source:
+                with gfile.GFile(file_path + '.trans', mode='w') as destiny:
+
+                    start_time = time.time()
+
+                    # imap returns the chunks in input order, whatever the order the workers finish them
+                    for chunk_id, pid, translations, seconds, lookups, hits in pool.imap(
+                            _decode_chunk, _read_chunks(source, FLAGS.decode_chunk_size)):
+                        for translation in translations:
+                            destiny.write(translation)
+                            destiny.write("\n")
+
+                        stats = worker_stats.setdefault(pid, [0, 0.0, 0, 0])
+                        stats[0] += len(translations)
+                        stats[1] += seconds
+                        stats[2] += lookups
+                        stats[3] += hits
+
+                        sentence_count += len(translations)
+                        print("Translated %d sentences (chunk %d, worker %d)" % (sentence_count, chunk_id, pid))
+
+                    end_time = time.time() - start_time
+
+            print("\nDone file %s" % file_path)
+            print("Avg. %.3f sentences/sec" % (sentence_count / end_time))
+
+            total_sentence_count += sentence_count
+
+    finally:
+        pool.close()
+        pool.join()
+
+    end_total_time = time.time() - start_total_time
+
+    print("\nDone!")
+    for pid in sorted(worker_stats):
+        sentences, seconds, lookups, hits = worker_stats[pid]
+        print("Worker %d: %d sentences - avg. %.3f sentences/sec" % (pid, sentences, sentences / max(seconds, 1e-6)))
+    print("Avg. %.3f sentences/sec (%d workers)" % (total_sentence_count / end_total_time, n_workers))
+
+    lookups = sum(stats[2] for stats in worker_stats.values())
+    if lookups > 0:
+        hits = sum(stats[3] for stats in worker_stats.values())
+        print("translation cache: %d lookups - hit rate %.3f" % (lookups, hits / lookups))
+
 
 def decode_from_stdin(show_all_n_best=False, FLAGS=None, buckets=None):
 
@@ -98,22 +389,17 @@ def decode_from_stdin(show_all_n_best=False, FLAGS=None, buckets=None):
     assert buckets is not None
 
     # with tf.Session(config=tf.ConfigProto(allow_soft_placement=True, log_device_placement=True)) as sess:
-    with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+    with tf.Session(config=session_ops.get_session_config(FLAGS, session_ops.DECODE)) as sess:
 
         # Create model and load parameters.
         model = create_seq2seq_model(sess, True, FLAGS, buckets, translate=True)
 
         # Load vocabularies.
-        source_vocab_file = FLAGS.data_dir + \
-                            (FLAGS.train_data % str(FLAGS.src_vocab_size)) + \
-                            ('.vocab.%s' % FLAGS.source_lang)
+        src_vocab, rev_tgt_vocab = _load_vocabularies(FLAGS)
 
-        target_vocab_file = FLAGS.data_dir + \
-                            (FLAGS.train_data % str(FLAGS.tgt_vocab_size)) + \
-                            ('.vocab.%s' % FLAGS.target_lang)
+        lexical_table = shortlist_ops.get_lexical_table(FLAGS) if FLAGS.shortlist_top_k > 0 else None
 
-        src_vocab, _ = data_utils.initialize_vocabulary(source_vocab_file)
-        _, rev_tgt_vocab = data_utils.initialize_vocabulary(target_vocab_file)
+        cache = cache_ops.get_translation_cache(model, FLAGS, dump_remaining=False)
 
         # Decode from standard input.
         sys.stdout.write("> ")
@@ -124,8 +410,30 @@ def decode_from_stdin(show_all_n_best=False, FLAGS=None, buckets=None):
             # Get token-ids for the input sentence.
             token_ids = data_utils.sentence_to_token_ids(sentence, src_vocab)
 
-            # Get output logits for the sentence.
-            output_hypotheses, output_scores = model.translation_step(sess, token_ids, beam_size=FLAGS.beam_size, dump_remaining=False)
+            sentence_shortlist = None
+            if lexical_table is not None:
+                sentence_shortlist = shortlist_ops.sentence_shortlist(lexical_table, token_ids,
+                                                                      min_size=FLAGS.beam_size)
+
+            translation = cache.get(token_ids, sentence_shortlist) if cache is not None else None
+
+            if translation is None:
+
+                shortlist = None
+                if sentence_shortlist is not None:
+                    shortlist = shortlist_ops.pad_shortlists([sentence_shortlist])
+
+                # Get output logits for the sentence.
+                if FLAGS.greedy_decoding:
+                    translation = model.greedy_translation_step(sess, [token_ids], shortlist=shortlist)[0]
+                else:
+                    translation = model.translation_step(sess, token_ids, beam_size=FLAGS.beam_size, dump_remaining=False, shortlist=shortlist,
+                                                         early_stop=FLAGS.beam_early_stop, length_ratio=FLAGS.beam_length_ratio)
+
+                if cache is not None:
+                    cache.put(token_ids, translation, sentence_shortlist)
+
+            output_hypotheses, output_scores = translation
 
             outputs = []
 
@@ -152,3 +460,50 @@ def decode_from_stdin(show_all_n_best=False, FLAGS=None, buckets=None):
             print("> ", end="")
             sys.stdout.flush()
             sentence = sys.stdin.readline()
+
+        if cache is not None:
+            print(cache.report())
+            cache.close()
+
+
+def decode_from_server(FLAGS=None, buckets=None):
+    """Load the model once and serve translations over HTTP (see server_ops), translating the
+    requests in micro-batches of at most server_batch_size sentences. The first request of a
+    micro-batch waits at most server_max_wait milliseconds for others."""
+
+    assert FLAGS is not None
+    assert buckets is not None
+
+    with tf.Session(config=session_ops.get_session_config(FLAGS, session_ops.DECODE)) as sess:
+
+        # Create model and load parameters.
+        model = create_seq2seq_model(sess, True, FLAGS=FLAGS, buckets=buckets, translate=True, batch_size=1)
+
+        # Load vocabularies.
+        src_vocab, rev_tgt_vocab = _load_vocabularies(FLAGS)
+
+        lexical_table = shortlist_ops.get_lexical_table(FLAGS) if FLAGS.shortlist_top_k > 0 else None
+
+        cache = cache_ops.get_translation_cache(model, FLAGS)
+
+        # runs in the thread of the batcher only
+        def translate_texts(texts):
+            batch_token_ids = [data_utils.sentence_to_token_ids(text, src_vocab) for text in texts]
+            return _batch_translations(sess, model, batch_token_ids, lexical_table, FLAGS, cache=cache)
+
+        def translation_reply(translation):
+            output_hypotheses, output_scores = translation
+            outputs = [output for output in output_hypotheses[0] if output != data_utils.EOS_ID]
+            return {'translation': " ".join([rev_tgt_vocab[output] for output in outputs]),
+                    'score': float(numpy.exp(-output_scores[0]))}
+
+        batcher = server_ops.MicroBatcher(translate_texts,
+                                          max_batch_size=FLAGS.server_batch_size,
+                                          max_wait=FLAGS.server_max_wait / 1000.0)
+
+        server_ops.serve(batcher, host=FLAGS.server_host, port=FLAGS.server_port,
+                         translate_request=translation_reply)
+
+        if cache is not None:
+            print(cache.report())
+            cache.close()